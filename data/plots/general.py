@@ -195,26 +195,8 @@ Plot(
 )
 
 Leaf('met', 'f', 'result = met.Pt()')
-Leaf('ht_old', 'f', """
-float ht = 0.;
-for (const auto& j: jets)
-    ht += j.p4().Pt();
-for (const auto& t: taus)
-    ht += t.p4().Pt();
-for (const auto& l: leptons)
-    ht += l.p4().Pt();
-result = ht
-""")
-Leaf('ht', 'f', """
-float ht = 0.;
-for (const auto& j: jets)
-    ht += j.p4().Pt();
-for (const auto& t: all_taus)
-    ht += t.p4().Pt();
-for (const auto& l: leptons)
-    ht += l.p4().Pt();
-result = ht
-""")
+Leaf('ht_old', 'f', 'result = sum_pt(jets, taus, leptons)')
+Leaf('ht', 'f', 'result = sum_pt(jets, all_taus, leptons)')
 Leaf('ht_notau', 'f', """
 float ht = 0.;
 for (const auto& j: jets)
@@ -69,10 +69,7 @@ result = ht.Pt()
 """)
 
 Leaf('jet_deltaRavg', 'f',
-     '''std::vector<float> drs;
-        for (auto i = 0; i < jets.size(); ++i)
-            for (auto j = i + 1; j < jets.size(); ++j)
-                drs.push_back(dR(jets[i], jets[j]));
+     '''const auto& drs = jet_dRs(jets);
         result = std::accumulate(drs.begin(), drs.end(), 0.) / drs.size()''')
 Plot(
     name="jets/JJ_AvgDeltaR",
@@ -83,10 +80,7 @@ Plot(
 )
 
 Leaf('jet_deltaRmin', 'f',
-     '''std::vector<float> drs;
-        for (auto i = 0; i < jets.size(); ++i)
-            for (auto j = i + 1; j < jets.size(); ++j)
-                drs.push_back(dR(jets[i], jets[j]));
+     '''const auto& drs = jet_dRs(jets);
         result = drs.size() > 0 ? *std::min_element(drs.begin(), drs.end()) : -666.''')
 Plot(
     name="jets/JJ_MinDeltaR",
@@ -96,10 +90,7 @@ Plot(
 )
 
 Leaf('jet_deltaRmax', 'f',
-     '''std::vector<float> drs;
-        for (auto i = 0; i < jets.size(); ++i)
-            for (auto j = i + 1; j < jets.size(); ++j)
-                drs.push_back(dR(jets[i], jets[j]));
+     '''const auto& drs = jet_dRs(jets);
         result = drs.size() > 0 ? *std::max_element(drs.begin(), drs.end()) : -666.''')
 Plot(
     name="jets/JJ_MaxDeltaR",
@@ -143,8 +134,8 @@ Leaf('jet_mistag', '[i]',
 
 pspace = [
     ("", "jets"),
-    ("Untagged", "notags(jets)"),
-    ("Tagged", "tags(jets)")
+    ("Untagged", "untagged_jets(jets)"),
+    ("Tagged", "tagged_jets(jets)")
 ]
 
 jspace = [
@@ -171,7 +162,7 @@ for i in range(2):
         binning=[20, 20, 250]
     )
 
-    Leaf('tag{}_pt'.format(i + 1), 'f', 'result = tags(jets).at({}).p4().Pt()'.format(i))
+    Leaf('tag{}_pt'.format(i + 1), 'f', 'result = tagged_jets(jets).at({}).p4().Pt()'.format(i))
     Plot(
         name="jets/kinematic/Tag{}_Pt".format(i + 1),
         values=['tag{}_pt'.format(i + 1)],
@@ -179,7 +170,7 @@ for i in range(2):
         binning=[20, 20, 250]
     )
 
-    Leaf('notag{}_pt'.format(i + 1), 'f', 'result = notags(jets).size() > {0} ? notags(jets).at({0}).p4().Pt() : -666.'.format(i))
+    Leaf('notag{}_pt'.format(i + 1), 'f', 'result = untagged_jets(jets).size() > {0} ? untagged_jets(jets).at({0}).p4().Pt() : -666.'.format(i))
     Plot(
         name="jets/kinematic/NTag{}_Pt".format(i + 1),
         values=['notag{}_pt'.format(i + 1)],
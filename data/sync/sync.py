@@ -81,43 +81,16 @@ Leaf('ntaus', 'i', 'result = std::count_if(std::begin(taus), std::end(taus), [](
 
 Leaf('njets_inclusive', 'f', 'result = jets.size()')
 Leaf('ntags_loose', 'f', 'result = btags(jets, true)')
-Leaf('ht', 'f', """
-float ht = 0.;
-for (const auto& j: jets)
-    ht += j.p4().Pt();
-for (const auto& t: all_taus)
-    ht += t.p4().Pt();
-for (const auto& l: leptons)
-    ht += l.p4().Pt();
-result = ht
-""")
-Leaf('HT', 'f', """
-float HT = 0.;
-for (const auto& j: jets)
-    HT += j.p4().Pt();
-for (const auto& t: all_taus)
-    HT += t.p4().Pt();
-for (const auto& l: leptons)
-    HT += l.p4().Pt();
-result = HT
-""")
+Leaf('ht', 'f', 'result = sum_pt(jets, all_taus, leptons)')
+Leaf('HT', 'f', 'result = sum_pt(jets, all_taus, leptons)')
 Leaf('avg_dr_jet', 'f',
-     '''std::vector<float> drs;
-        for (auto i = 0; i < jets.size(); ++i)
-            for (auto j = i + 1; j < jets.size(); ++j)
-                drs.push_back(dR(jets[i], jets[j]));
+     '''const auto& drs = jet_dRs(jets);
         result = std::accumulate(drs.begin(), drs.end(), 0.) / drs.size()''')
 Leaf('jet_deltaRavg', 'f',
-     '''std::vector<float> drs;
-        for (auto i = 0; i < jets.size(); ++i)
-            for (auto j = i + 1; j < jets.size(); ++j)
-                drs.push_back(dR(jets[i], jets[j]));
+     '''const auto& drs = jet_dRs(jets);
         result = std::accumulate(drs.begin(), drs.end(), 0.) / drs.size()''')
 Leaf('jet_deltaRmax', 'f',
-     '''std::vector<float> drs;
-        for (auto i = 0; i < jets.size(); ++i)
-            for (auto j = i + 1; j < jets.size(); ++j)
-                drs.push_back(dR(jets[i], jets[j]));
+     '''const auto& drs = jet_dRs(jets);
         result = drs.size() > 0 ? *std::max_element(drs.begin(), drs.end()) : -666.''')
 Leaf('tt_deltaR', 'f', 'result = taus.size() >= 2 ? dR(taus.at(0), taus.at(1)) : -9999.')
 Leaf('tt_mvis', 'f', 'result = taus.size() >= 2 ? (taus.at(0).p4() + taus.at(1).p4()).M() : -9999.')
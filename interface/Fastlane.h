@@ -4,8 +4,10 @@
 // Components to process the slim event trees (with superslim components)
 // faster than possible in python
 
+#include <cstdio>
 #include <memory>
 #include <string>
+#include <tuple>
 #include <unordered_map>
 #include <vector>
 
@@ -17,6 +19,65 @@ struct _object;
 typedef _object PyObject;
 
 namespace fastlane {
+   // Weights of an event.  Names are lower-cased and assigned a dense slot
+   // once, so that the event loop only has to deal with indices.  Weights
+   // that have not been set for an event are zero.
+   //
+   // Calculated weights are filled by providers, which are only called
+   // when one of their weights is accessed, at most once per event.
+   class Weights {
+      public:
+         // Sets the weights in the slots it was registered for
+         typedef void (*provider_t)(Weights&, const std::vector<int>& slots);
+
+         Weights() : event_(0), process_(0), sys_(0), id_(0) {};
+
+         // Slot of the weight `name`, assigned on first use
+         static int slot(const std::string& name);
+         // Let `p` calculate the weights `names`
+         static void provide(const std::vector<std::string>& names, provider_t p);
+
+         double& operator[](int slot) {
+            if (slot >= static_cast<int>(values_.size()))
+               grow(slot);
+            if (event_ and provider_[slot] >= 0 and not done_[provider_[slot]])
+               evaluate(provider_[slot]);
+            return values_[slot];
+         };
+         // Looks up the slot of `name` for every access
+         double& operator[](const std::string& name) { return (*this)[slot(name)]; };
+
+         // Reset and copy the weights stored in the event
+         void fill(const superslim::Event& e);
+         // Calculate weights for the event when they are accessed.  All
+         // arguments have to outlive the use of the weights.
+         void calculate(const superslim::Event& e, const std::string& process, const std::string& sys, const std::string& id);
+         // Map of all weights, calculating the missing ones
+         std::unordered_map<std::string, double> map();
+
+         const superslim::Event& event() const { return *event_; };
+         const std::string& process() const { return *process_; };
+         const std::string& sys() const { return *sys_; };
+         const std::string& id() const { return *id_; };
+      private:
+         void grow(int slot);
+         void sync();
+         void evaluate(int provider);
+
+         std::vector<double> values_;
+         // Provider of every slot, or -1, and if it has been called
+         std::vector<int> provider_;
+         std::vector<bool> done_;
+         std::vector<std::pair<provider_t, std::vector<int>>> providers_;
+
+         const superslim::Event* event_;
+         const std::string* process_;
+         const std::string* sys_;
+         const std::string* id_;
+   };
+
+   class Dump;
+
    class BasicCut {
       public:
          BasicCut() {};
@@ -43,13 +104,41 @@ namespace fastlane {
                const std::vector<superslim::Jet>&,
                const superslim::LorentzVector&);
 
-         Cut() : BasicCut(), callback_(0) {};
-         Cut(const std::string& name, fct_t eval) : BasicCut(name), fct_(eval), last_(std::make_tuple(-1, -1, -1)), callback_(0) {};
+         Cut() : BasicCut(), group_(0) {};
+         Cut(const std::string& name, fct_t eval) : BasicCut(name), fct_(eval), group_(0) {};
          virtual ~Cut() {};
 
-         bool operator()(const std::string& process, const superslim::Event& e, const std::string& sys);
+         bool operator()(const std::string& process, const superslim::Event& e, const std::string& sys) {
+            bool passed = test(e, sys);
+            if (passed)
+               count(process, e, sys);
+            return passed;
+         };
+         // Evaluate without counting, and count a passing event.
+         bool test(const superslim::Event& e, const std::string& sys) const;
+         void count(const std::string& process, const superslim::Event& e, const std::string& sys);
+
+         // Consecutive cuts of the same, non-zero group commute, and may
+         // be evaluated in any order.
+         void setGroup(int group) { group_ = group; };
+         int group() const { return group_; };
 
-         void setCallback(PyObject* callback) { callback_ = callback; };
+         // Pass the events counted for `process` to `callback`, or write
+         // them to `dump`, which has to outlive processing.  Cuts are
+         // shared between the processes of a cutflow, so every process
+         // has its own.
+         void setCallback(const std::string& process, PyObject* callback) { callbacks_[process] = callback; };
+         bool hasCallback() const { return not callbacks_.empty(); };
+         void setDump(const std::string& process, Dump* dump);
+         bool hasDump() const { return not dumps_.empty(); };
+
+         // Copy without counts, and add the counts of a copy back in.
+         Cut* fork() const {
+            auto res = new Cut(name(), fct_);
+            res->group_ = group_;
+            return res;
+         };
+         void merge(const Cut& other);
 
          virtual std::vector<std::string> processes() const override;
          virtual int& operator[](const std::string& process) { return counts_[process]; };
@@ -58,8 +147,12 @@ namespace fastlane {
 
          std::unordered_map<std::string, int> counts_;
          fct_t fct_;
-         event_t last_;
-         PyObject *callback_;
+         // Last event counted, per process: cutflows are shared between
+         // the processes of a group
+         std::unordered_map<std::string, event_t> last_;
+         std::unordered_map<std::string, PyObject*> callbacks_;
+         std::unordered_map<std::string, Dump*> dumps_;
+         int group_;
    };
 
    class StaticCut : public BasicCut {
@@ -68,29 +161,59 @@ namespace fastlane {
          StaticCut(const std::string& name) : BasicCut(name) {};
          virtual ~StaticCut() {};
 
+         StaticCut* fork() const { return new StaticCut(name()); };
+         void merge(const StaticCut& other);
+
          virtual std::vector<std::string> processes() const override;
          virtual double& operator[](const std::string& process) { return counts_[process]; };
       private:
          std::unordered_map<std::string, double> counts_;
    };
 
+   // Buffered dump of events for synchronization, in the formats of the
+   // exercises: comma separated values with one lepton, and fixed width
+   // columns with two leptons.
+   class Dump {
+      public:
+         Dump(const std::string& filename, int leptons, const std::string& sys="NA");
+         Dump(const Dump&) = delete;
+         Dump& operator=(const Dump&) = delete;
+         ~Dump();
+
+         void write(const superslim::Event& e, Weights& ws);
+         void flush();
+      private:
+         std::FILE *file_;
+         std::string buffer_;
+         int leptons_;
+         std::string sys_;
+   };
+
    class BasicLeaf {
       public:
          BasicLeaf() {};
          BasicLeaf(const std::string& name) : name_(name) {};
          virtual ~BasicLeaf() {};
 
-         virtual void pick(const superslim::Event& e, std::unordered_map<std::string, double>& w, const std::string& sys) = 0;
+         virtual void pick(const superslim::Event& e, fastlane::Weights& w, const std::string& sys) = 0;
          const std::string& name() const { return name_; };
 
+         // Unregistered copy for a worker thread, which keeps the values
+         // picked with `stash` until they are copied back with `unstash`.
+         virtual BasicLeaf* clone() const = 0;
+         virtual void stash() = 0;
+         virtual void unstash(const BasicLeaf& other, std::size_t i) = 0;
+         virtual void clear() = 0;
+
          static std::vector<BasicLeaf*>& leaves() { return leaves_; };
          static void update_cache(const superslim::Event& e);
       protected:
          std::string name_;
 
          static std::vector<BasicLeaf*> leaves_;
-         static std::vector<superslim::Lepton> cached_electrons_;
-         static std::vector<superslim::Lepton> cached_muons_;
+         // Per thread
+         static std::vector<superslim::Lepton>& cached_electrons();
+         static std::vector<superslim::Lepton>& cached_muons();
    };
 
    template<typename T>
@@ -106,7 +229,7 @@ namespace fastlane {
                const std::vector<superslim::Lepton>&,
                const std::vector<superslim::Jet>&,
                const superslim::LorentzVector&,
-               std::unordered_map<std::string, double>&,
+               fastlane::Weights&,
                T& result);
 
          Leaf() : BasicLeaf(), val_(0) {};
@@ -114,22 +237,110 @@ namespace fastlane {
          virtual ~Leaf() {};
 
          void grow(TTree& t) { t.Branch(name_.c_str(), &val_); };
-         virtual void pick(const superslim::Event& e, std::unordered_map<std::string, double>& w, const std::string& sys) override {
+         virtual void pick(const superslim::Event& e, fastlane::Weights& w, const std::string& sys) override {
             val_ = T();
-            fct_(e, e.taus(), e.allTaus(), e.leptons(), cached_electrons_, cached_muons_, e.allLeptons(), e.jets(sys), e.met(sys), w, val_);
+            fct_(e, e.taus(), e.allTaus(), e.leptons(), cached_electrons(), cached_muons(), e.allLeptons(), e.jets(sys), e.met(sys), w, val_);
          };
 
+         virtual BasicLeaf* clone() const override { return new Leaf<T>(*this); };
+         virtual void stash() override { stash_.push_back(val_); };
+         virtual void unstash(const BasicLeaf& other, std::size_t i) override { val_ = dynamic_cast<const Leaf<T>&>(other).stash_[i]; };
+         virtual void clear() override { stash_.clear(); };
+
       private:
          fct_t fct_;
          T val_;
+         std::vector<T> stash_;
    };
 
-   template<> void Leaf<std::vector<float>>::pick(const superslim::Event& e, std::unordered_map<std::string, double>& w, const std::string& sys);
-   template<> void Leaf<std::vector<int>>::pick(const superslim::Event& e, std::unordered_map<std::string, double>& w, const std::string& sys);
+   // Number of the event processed by the current thread, to invalidate
+   // values derived from the previous one.
+   unsigned long event_generation();
+   void next_event();
+
+   // Keeps the value of `Fct` for the current event, to be shared between
+   // leaves and cuts.  Inputs are compared by address, and thus have to be
+   // collections of the event, like `jets` or `taus`, and not temporaries.
+   template<typename T, typename... Inputs>
+   class Memo {
+      public:
+         template<T (*Fct)(const Inputs&...)>
+         static const T& get(const Inputs&... inputs)
+         {
+            static thread_local unsigned long generation = 0;
+            static thread_local std::tuple<const Inputs*...> last;
+            static thread_local T value;
+
+            auto current = std::make_tuple(&inputs...);
+            if (generation != event_generation() or last != current) {
+               value = Fct(inputs...);
+               generation = event_generation();
+               last = current;
+            }
+            return value;
+         };
+   };
+
+   template<> void Leaf<std::vector<float>>::pick(const superslim::Event& e, fastlane::Weights& w, const std::string& sys);
+   template<> void Leaf<std::vector<int>>::pick(const superslim::Event& e, fastlane::Weights& w, const std::string& sys);
 
    const TH1* get_cuts(const std::string& label, const std::vector<std::string>& files);
    void process(const std::string& process, const std::string& channel, const std::vector<std::string>& files, TTree& t, std::vector<fastlane::Cut*>& cuts, std::vector<fastlane::StaticCut*>& weights, const std::string& sys, const std::string& id, PyObject* log, int max, bool calculate_weights);
-   void update_weights(const std::string&, std::unordered_map<std::string, double>& ws, const superslim::Event& e, const std::string& sys, const std::string& id);
+   void process(const std::string& process, const std::string& channel, const std::vector<std::string>& files, std::vector<TTree*>& trees, std::vector<std::vector<fastlane::Cut*>>& cuts, std::vector<std::vector<fastlane::StaticCut*>>& weights, const std::vector<std::string>& sys, const std::string& id, PyObject* log, int max, bool calculate_weights);
+   // Process several selections in one pass over the events.  Selection
+   // `n` belongs to `processes[n]`, uses the systematic `sys[n]`, and
+   // fills `trees[n]`.  Trees may be null, in which case only the cuts
+   // and weights are evaluated.  With more than one thread, the files are
+   // split into contiguous ranges and the trees filled in file order.
+   void process(const std::vector<std::string>& processes, const std::string& channel, const std::vector<std::string>& files, std::vector<TTree*>& trees, std::vector<std::vector<fastlane::Cut*>>& cuts, std::vector<std::vector<fastlane::StaticCut*>>& weights, const std::vector<std::string>& sys, const std::string& id, PyObject* log, int max, const std::vector<int>& calculate_weights, int threads=1);
+   // Calls and wall time spent in cuts, leaves, weights, and filling
+   // trees, as recorded when profiling.  Cuts also count passing calls.
+   struct Timing {
+      Timing() : calls(0), passed(0), seconds(0.) {};
+
+      std::string kind;
+      std::string name;
+      long calls;
+      long passed;
+      double seconds;
+   };
+
+   void setProfiling(bool profile);
+   bool profiling();
+
+   // Number of events reaching a group of commuting cuts to measure their
+   // cost and rejection on, before evaluating them in the most efficient
+   // order.  Zero keeps the order of the cuts.
+   void setCutReordering(int sample);
+   int cutReordering();
+   // Timings recorded since the last call, summed over all threads
+   std::vector<Timing> timings();
+
+   // Only process a sample of `amount` of the events: a fraction, if at
+   // most one, or a number of events.  Files are split into blocks of
+   // `block` consecutive entries, or taken whole if `block` is zero, and
+   // blocks drawn with `seed` from every file in the same proportion.
+   // Zero processes all events.
+   void setSampling(double amount, unsigned int seed=0, long block=1000);
+   // Events in the sample of the last call to `process`, or -1
+   long sampledEvents();
+   // Number of events in `files`, known from a catalog, so that sampling
+   // does not need to open them
+   void setFileEntries(const std::vector<std::string>& files, const std::vector<long>& entries);
+
+   // Write events passing `cuts` for any systematic processed into the
+   // branch `event` of `tree` while processing, or stop with a null tree.
+   // Writing a skim requires processing serially.
+   void setSkimOutput(TTree* tree, const std::vector<fastlane::Cut*>& cuts);
+   // Read events from files with skims, rather than from ntuples.
+   void setSkimInput(bool skim);
+
+   // Check scale factor tables against the ROOT objects they are created
+   // from when loading them.
+   void setTableValidation(bool validate);
+   bool tableValidation();
+   // Have the weights of `e` calculated when they are accessed in `ws`.
+   void update_weights(const std::string&, fastlane::Weights& ws, const superslim::Event& e, const std::string& sys, const std::string& id);
 }
 
 #endif
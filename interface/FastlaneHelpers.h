@@ -8,6 +8,7 @@
 #include "TGraphAsymmErrors.h"
 #include "TH2F.h"
 
+#include "FastlaneTables.h"
 #include "SuperSlim.h"
 
 namespace fastlane {
@@ -17,6 +18,11 @@ namespace fastlane {
          virtual ~CSVHelper() {};
 
          float weight(const std::vector<superslim::Jet>&, const std::string& sys="central");
+         // The weight for `sys`, followed by the weights of all
+         // `variations()`, calculated in a single pass over the jets.
+         std::vector<float> weights(const std::vector<superslim::Jet>&, const std::string& sys="central");
+
+         static const std::vector<std::string>& variations();
 
       private:
          BTagCalibrationReader reader_;
@@ -30,12 +36,12 @@ namespace fastlane {
 
          float weight(const std::vector<superslim::Tau>&,
                       const std::vector<superslim::Lepton>&,
-                      const std::string& sys="central");
+                      const std::string& sys="central") const;
       private:
-         std::array<std::auto_ptr<TGraphAsymmErrors>, 2> tau;
-         std::array<std::map<std::string, TF1>, 2> ratio;
-         std::auto_ptr<TH2F> ele_fake;
-         std::auto_ptr<TH2F> mu_fake;
+         std::array<Graph, 2> tau;
+         std::array<std::map<std::string, Function>, 2> ratio;
+         Table2D ele_fake;
+         Table2D mu_fake;
 
          superslim::id::value id_;
    };
@@ -43,26 +49,25 @@ namespace fastlane {
    class LeptonHelper {
       public:
          LeptonHelper();
-         LeptonHelper(const LeptonHelper&);
          virtual ~LeptonHelper() {};
 
-         float weight(const superslim::Lepton&);
+         float weight(const superslim::Lepton&) const;
       private:
-         float recoSF(const superslim::Lepton&);
-         float tightSF(const superslim::Lepton&);
+         float recoSF(const superslim::Lepton&) const;
+         float tightSF(const superslim::Lepton&) const;
 
-         std::auto_ptr<TH2F> tight_el_;
-         std::auto_ptr<TH2F> tight_mu_;
+         Table2D tight_el_;
+         Table2D tight_mu_;
 
-         std::auto_ptr<TH2F> reco_mu1_;
-         std::auto_ptr<TH2F> reco_mu2_;
-         std::auto_ptr<TH2F> reco_mu3_;
-         std::auto_ptr<TGraphAsymmErrors> reco_mu4_;
+         Table2D reco_mu1_;
+         Table2D reco_mu2_;
+         Table2D reco_mu3_;
+         Graph reco_mu4_;
 
-         std::auto_ptr<TH2F> reco_el1_;
-         std::auto_ptr<TH2F> reco_el2_;
-         std::auto_ptr<TH2F> reco_el3_;
-         std::auto_ptr<TH2F> reco_el4_;
+         Table2D reco_el1_;
+         Table2D reco_el2_;
+         Table2D reco_el3_;
+         Table2D reco_el4_;
    };
 
    class TriggerHelper {
@@ -70,20 +75,20 @@ namespace fastlane {
          TriggerHelper(const std::string& id);
          virtual ~TriggerHelper() {};
 
-         float weight(const superslim::Event&);
+         float weight(const superslim::Event&) const;
       private:
-         std::array<std::array<std::auto_ptr<TGraphAsymmErrors>, 2>, 11> eff_et_tau_leg_mc_;
-         std::array<std::array<std::auto_ptr<TGraphAsymmErrors>, 2>, 11> eff_et_tau_leg_data_;
-         std::array<std::auto_ptr<TGraphAsymmErrors>, 2> eff_mt_tau_leg_mc_;
-         std::array<std::auto_ptr<TGraphAsymmErrors>, 2> eff_mt_tau_leg_data_;
-         std::array<std::auto_ptr<TGraphAsymmErrors>, 3> eff_et_lep_leg_mc_;
-         std::array<std::auto_ptr<TGraphAsymmErrors>, 3> eff_et_lep_leg_data_;
-         std::array<std::auto_ptr<TGraphAsymmErrors>, 3> eff_mt_lep_leg_mc_;
-         std::array<std::auto_ptr<TGraphAsymmErrors>, 3> eff_mt_lep_leg_data_;
-         std::array<std::auto_ptr<TGraphAsymmErrors>, 3> eff_e_mc_;
-         std::array<std::auto_ptr<TGraphAsymmErrors>, 3> eff_e_data_;
-         std::array<std::auto_ptr<TGraphAsymmErrors>, 3> eff_m_mc_;
-         std::array<std::auto_ptr<TGraphAsymmErrors>, 3> eff_m_data_;
+         std::array<std::array<Graph, 2>, 11> eff_et_tau_leg_mc_;
+         std::array<std::array<Graph, 2>, 11> eff_et_tau_leg_data_;
+         std::array<Graph, 2> eff_mt_tau_leg_mc_;
+         std::array<Graph, 2> eff_mt_tau_leg_data_;
+         std::array<Graph, 3> eff_et_lep_leg_mc_;
+         std::array<Graph, 3> eff_et_lep_leg_data_;
+         std::array<Graph, 3> eff_mt_lep_leg_mc_;
+         std::array<Graph, 3> eff_mt_lep_leg_data_;
+         std::array<Graph, 3> eff_e_mc_;
+         std::array<Graph, 3> eff_e_data_;
+         std::array<Graph, 3> eff_m_mc_;
+         std::array<Graph, 3> eff_m_data_;
    };
 }
 
@@ -0,0 +1,89 @@
+#ifndef __FastlaneSnippets_h
+#define __FastlaneSnippets_h
+
+// Helpers available to the code of leaves and cuts, both when compiled
+// into cached libraries and when declared to the interpreter
+
+#include <algorithm>
+#include <numeric>
+
+#include "DataFormats/Math/interface/deltaR.h"
+
+#include "Fastlane.h"
+
+template<typename T, typename U> double dR(T t, U u) {
+   return reco::deltaR(t, u);
+}
+
+template<typename T> int len(T t) { return t.size(); }
+template<typename T> bool btag(T j, bool loose=false) { return j.csv() > (loose ? 0.5426 : 0.8484); }
+template<typename T> int btags(T js, bool loose=false) {
+   int res = 0;
+   for (const auto& j: js)
+      res += btag(j, loose);
+   return res;
+}
+template<typename T> T tags(T js) {
+   T res;
+   for (const auto& j: js)
+      if (btag(j))
+         res.push_back(j);
+   return res;
+}
+template<typename T> T notags(T js) {
+   T res;
+   for (const auto& j: js)
+      if (!btag(j))
+         res.push_back(j);
+   return res;
+}
+template<typename S, typename T> float metLD(float met, S js, T ls) {
+   superslim::LorentzVector mht;
+   for (const auto& j: js)
+      if (j.pt() >= 25.)
+         mht += j.p4();
+   for (const auto& l: ls)
+      mht += l.p4();
+   return 0.00397 * met + 0.00265 * mht.pt();
+}
+
+// Quantities shared by several leaves, calculated once per event
+
+namespace derived {
+   inline std::vector<float> jet_dRs(const std::vector<superslim::Jet>& js) {
+      std::vector<float> res;
+      for (unsigned int i = 0; i < js.size(); ++i)
+         for (unsigned int j = i + 1; j < js.size(); ++j)
+            res.push_back(dR(js[i], js[j]));
+      return res;
+   }
+   inline std::vector<superslim::Jet> tagged_jets(const std::vector<superslim::Jet>& js) { return tags(js); }
+   inline std::vector<superslim::Jet> untagged_jets(const std::vector<superslim::Jet>& js) { return notags(js); }
+   inline float sum_pt(const std::vector<superslim::Jet>& js, const std::vector<superslim::Tau>& ts, const std::vector<superslim::Lepton>& ls) {
+      float res = 0.;
+      for (const auto& j: js)
+         res += j.p4().pt();
+      for (const auto& t: ts)
+         res += t.p4().pt();
+      for (const auto& l: ls)
+         res += l.p4().pt();
+      return res;
+   }
+}
+
+// ΔR of all jet pairs
+inline const std::vector<float>& jet_dRs(const std::vector<superslim::Jet>& js) {
+   return fastlane::Memo<std::vector<float>, std::vector<superslim::Jet>>::get<&derived::jet_dRs>(js);
+}
+inline const std::vector<superslim::Jet>& tagged_jets(const std::vector<superslim::Jet>& js) {
+   return fastlane::Memo<std::vector<superslim::Jet>, std::vector<superslim::Jet>>::get<&derived::tagged_jets>(js);
+}
+inline const std::vector<superslim::Jet>& untagged_jets(const std::vector<superslim::Jet>& js) {
+   return fastlane::Memo<std::vector<superslim::Jet>, std::vector<superslim::Jet>>::get<&derived::untagged_jets>(js);
+}
+// Scalar sum of the transverse momenta
+inline float sum_pt(const std::vector<superslim::Jet>& js, const std::vector<superslim::Tau>& ts, const std::vector<superslim::Lepton>& ls) {
+   return fastlane::Memo<float, std::vector<superslim::Jet>, std::vector<superslim::Tau>, std::vector<superslim::Lepton>>::get<&derived::sum_pt>(js, ts, ls);
+}
+
+#endif
@@ -0,0 +1,99 @@
+#ifndef __FastlaneTables_h
+#define __FastlaneTables_h
+
+// Flat copies of histograms, graphs, and functions used for scale factors,
+// to be evaluated without touching ROOT objects.  All tables are read-only
+// after construction and can be shared between threads.
+
+#include <memory>
+#include <mutex>
+#include <string>
+#include <vector>
+
+#include "TAxis.h"
+#include "TF1.h"
+#include "TGraph.h"
+#include "TH2.h"
+
+namespace fastlane {
+   // Bin edges of a histogram axis, finding bins like TAxis::FindBin
+   class Axis {
+      public:
+         Axis() : fixed_(true) {};
+         Axis(const TAxis& axis);
+
+         int bins() const { return edges_.size() - 1; };
+         int find(double x) const;
+         double min() const { return edges_.front(); };
+         double max() const { return edges_.back(); };
+      private:
+         std::vector<double> edges_;
+         bool fixed_;
+   };
+
+   // Bin contents of a 2D histogram, including under- and overflow bins
+   class Table2D {
+      public:
+         Table2D() {};
+         Table2D(const TH2& h);
+
+         const Axis& x() const { return x_; };
+         const Axis& y() const { return y_; };
+
+         double content(int x, int y) const { return values_[y * (x_.bins() + 2) + x]; };
+         // Like GetBinContent(FindBin(x, y))
+         double value(double x, double y) const { return content(x_.find(x), y_.find(y)); };
+         // Uses the first or last bin for values outside of the axes
+         double clamped(double x, double y) const;
+      private:
+         Axis x_;
+         Axis y_;
+         std::vector<double> values_;
+   };
+
+   // Points of a graph, evaluated like TGraph::Eval with linear
+   // interpolation and extrapolation
+   class Graph {
+      public:
+         Graph() {};
+         Graph(const TGraph& g);
+
+         double eval(double x) const;
+         // Range of the x-axis ROOT would draw the graph with
+         double min() const { return min_; };
+         double max() const { return max_; };
+      private:
+         std::vector<double> x_;
+         std::vector<double> y_;
+         double min_;
+         double max_;
+   };
+
+   // Function sampled on a regular grid over its range, and interpolated
+   // linearly.  Values outside the range are evaluated with the function.
+   class Function {
+      public:
+         Function() {};
+         Function(const TF1& f, unsigned int points=10000);
+
+         double eval(double x) const;
+      private:
+         double min_;
+         double step_;
+         std::vector<double> values_;
+
+         std::shared_ptr<TF1> fct_;
+         std::shared_ptr<std::mutex> lock_;
+   };
+
+   // Largest deviations of tables from the ROOT objects they were created
+   // from, probed at bin edges and centers, and between points.
+   double compare(const Table2D& t, const TH2& h);
+   double compare(const Graph& t, const TGraph& g);
+   double compare(const Function& t, const TF1& f);
+
+   // Throw if `deviation` exceeds `tolerance`.
+   void validate(const std::string& name, double deviation, double tolerance=1e-9);
+}
+
+#endif
@@ -439,7 +439,7 @@ namespace superslim {
 
    class Event {
       public:
-         Event() {};
+         Event() : hf_category_(0) {};
          Event(const std::map<std::string, std::vector<superslim::Tau>>&,
                const std::map<std::string, std::vector<superslim::Tau>>&,
                const std::vector<superslim::Lepton>&,
@@ -483,6 +483,8 @@ namespace superslim {
          int nBadMuons() const { return nmu_; };
 
          int higgsDecay() const { return hdecay_; };
+         // ttbar heavy flavor category, i.e., genTtbarId % 100
+         int hfCategory() const { return hf_category_; };
 
          const std::vector<superslim::Vertex>& pv() const { return pv_; };
          const Trigger& trigger() const { return trigger_; };
@@ -491,6 +493,7 @@ namespace superslim {
 
          void setGenParticles(const std::vector<GenObject>& v) { gen_particles_ = v; };
          void setGenJets(const std::vector<GenJet>& v) { gen_jets_ = v; };
+         void setHFCategory(int c) { hf_category_ = c; };
 
          bool dileptonVeto() const;
       private:
@@ -519,6 +522,7 @@ namespace superslim {
          int nmu_;
 
          int hdecay_;
+         int hf_category_;
 
          std::vector<superslim::Vertex> pv_;
          superslim::Trigger trigger_;
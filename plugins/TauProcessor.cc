@@ -161,6 +161,7 @@ class TauProcessor : public edm::one::EDProducer<edm::BeginRunProducer, edm::End
       edm::EDGetTokenT<pat::METCollection> met_token_;
       edm::EDGetTokenT<edm::TriggerResults> trig_token_;
       edm::EDGetTokenT<int> badmu_token_;
+      edm::EDGetTokenT<int> ttbar_id_token_;
 
       unsigned int evt_;
       std::vector<unsigned int> evt_list_;
@@ -227,6 +228,7 @@ TauProcessor::TauProcessor(const edm::ParameterSet& config) :
    met_token_ = consumes<pat::METCollection>(edm::InputTag("slimmedMETs"));
    trig_token_ = consumes<edm::TriggerResults>(edm::InputTag("TriggerResults", "", config.getParameter<std::string>("triggerResults")));
    badmu_token_ = consumes<int>(edm::InputTag("removeBadAndCloneGlobalMuons"));
+   ttbar_id_token_ = consumes<int>(edm::InputTag("categorizeGenTtbar", "genTtbarId"));
 
    genJetsToken_ = consumes<reco::GenJetCollection>(edm::InputTag("ak4GenJetsCustom"));
 
@@ -590,6 +592,12 @@ TauProcessor::produce(edm::Event& event, const edm::EventSetup& setup)
    ptr->setWeight("Generator", genweight);
 
    if (!data_) {
+      // Only available when the heavy flavor categorization is run
+      edm::Handle<int> ttbar_id;
+      event.getByToken(ttbar_id_token_, ttbar_id);
+      if (ttbar_id.isValid())
+         ptr->setHFCategory(*ttbar_id % 100);
+
       auto lheinfo = get_collection(*this, event, lheinfo_token_);
       if (lheinfo->weights().size() > 6) {
          ptr->setWeight("CMS_ttHl_thu_shape_" + sample_ + "_x1Down", genweight * lheinfo->weights()[2].wgt / lheinfo->originalXWGTUP());
@@ -2,18 +2,23 @@ from contextlib import contextmanager
 from itertools import groupby
 
 import codecs
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import re
 import shutil
 import yaml
 
 import ROOT as r
 
-from ttH.TauRoast import useful
-from ttH.TauRoast.botany import Forest
+from ttH.TauRoast import profiling, training, useful
+from ttH.TauRoast.botany import Forest, Leaf, drop, fsck, graft
 from ttH.TauRoast.cutting import StaticCut, Cut, Cutflows, cutflow, normalize
+from ttH.TauRoast.indexing import Catalog
 from ttH.TauRoast.plotting import Plot
-from ttH.TauRoast.processing import Process
+from ttH.TauRoast.processing import NTUPLE_GLOB, BasicProcess, Process
 
 
 def expand_systematics(systematics, weights):
@@ -48,8 +53,14 @@ def setup_cuts(config):
             cuts = [Cut("Ntuple analyzed", "true")]
             weights = []
 
+            # Nested lists are groups of cuts that commute
             for cfg in config.get('baseline cuts', []) + config[name + ' cuts']:
-                cuts.append(Cut(*cfg.items()[0]))
+                if isinstance(cfg, list):
+                    group = len(cuts)
+                    for c in cfg:
+                        cuts.append(Cut(*c.items()[0], group=group))
+                else:
+                    cuts.append(Cut(*cfg.items()[0]))
 
             for weight in config[name + ' weights']:
                 weights.append(StaticCut(weight))
@@ -124,36 +135,180 @@ def dump_cuts(args, config):
             cutflow(cuts, config["plot"], f=fd, weighed=True)
 
 
+def load_provenance(config):
+    try:
+        with open(os.path.join(config["outdir"], "provenance.json")) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_provenance(config, provenance):
+    fn = os.path.join(config["outdir"], "provenance.json")
+    with open(fn + '.tmp', 'w') as f:
+        json.dump(provenance, f, indent=2, sort_keys=True)
+    os.rename(fn + '.tmp', fn)
+
+
+def counts_of(cutflows):
+    """Return the counts of all cuts in `cutflows`, by cutflow, position,
+    and process.
+    """
+    res = {}
+    for name, (counts, cuts, weights) in cutflows.items():
+        for n, c in enumerate(counts + cuts + weights):
+            for p in c.processes():
+                res[(name, n, p)] = c[p]
+    return res
+
+
+def code_fingerprint(proc, cuts, weights):
+    """Hash of the leaves, cuts, and weights that the trees and counts of
+    `proc` depend on.
+    """
+    h = hashlib.sha1(useful.fingerprint())
+    h.update(Leaf.fingerprint())
+    for cfg in proc.additional_cuts:
+        h.update(repr(list(cfg)))
+    for c in cuts:
+        h.update(u'{0}:{1}:{2};'.format(c, c._code, c._group).encode('utf-8'))
+    for w in weights:
+        h.update(u'{0};'.format(w).encode('utf-8'))
+    return h.hexdigest()
+
+
 def analyze(args, config):
     fn = os.path.join(config["outdir"], "ntuple.root")
-
-    if args.reuse:
+    incremental = config.get('incremental', False)
+    previous = os.path.join(config["outdir"], "cutflow.pkl")
+
+    if incremental and (config.get('sample') or config.get('event limit', -1) >= 0):
+        raise ValueError("can't analyze incrementally when sampling or with an event limit")
+
+    provenance = {}
+    if incremental and os.path.exists(previous):
+        fsck(fn)
+        cutflows = split_cuts(Cutflows(previous))
+        provenance = load_provenance(config)
+    elif args.reuse:
+        fsck(fn)
         cutflows = split_cuts(load_cutflows(config))
     else:
-        if os.path.exists(fn):
-            os.unlink(fn)
+        for f in (fn, os.path.join(config["outdir"], "provenance.json")):
+            if os.path.exists(f):
+                os.unlink(f)
         cutflows = setup_cuts(config)
 
+    # When analyzing incrementally, the files of every process and
+    # systematic are compared to the ones analyzed before.  Only new files
+    # are analyzed, and their counts added to the previous ones, unless
+    # files changed or disappeared, or the code of leaves and cuts
+    # changed, which requires starting over.
+    catalog = Catalog.get(config, NTUPLE_GLOB.format(channel=useful.config.channel))
+    updated = {}
+    previous_counts = {}
+    redo = set()
+    unchanged = counts_of(cutflows)
+
+    tasks = []
     for proc in set(sum((Process.expand(p) for p in config['plot'] + config['limits']), [])):
         uncertainties = ['NA']
         if args.systematics:
             weights = config.get(proc.cutflow + ' weights')
             systematics = config.get(proc.cutflow + ' systematics', [])
-            uncertainties = [s for s, w in expand_systematics(systematics, weights)]
+            # Weight systematics are all evaluated with the nominal trees
+            uncertainties = []
+            for unc, _ in expand_systematics(systematics, weights):
+                if unc not in uncertainties:
+                    uncertainties.append(unc)
+        todo = []
         for unc in uncertainties:
             suffix = '' if unc == 'NA' else '_' + unc
             counts, cuts, weights = cutflows[proc.cutflow + suffix]
 
-            if len(counts) > 0 and str(proc) in counts[0].processes():
+            done = len(counts) > 0 and str(proc) in counts[0].processes()
+            files = None
+            if incremental:
+                key = u"{0}:{1}:{2}".format(proc, unc, proc.cutflow + suffix)
+                current = {
+                    'files': catalog.stats(proc.paths, refresh=True),
+                    'fingerprint': code_fingerprint(proc, cuts, weights)
+                }
+                record = provenance.get(key, {})
+                previous_files = record.get('files', {})
+                if done and record.get('fingerprint') == current['fingerprint'] and \
+                        all(current['files'].get(f) == s for f, s in previous_files.items()):
+                    files = tuple(sorted(set(current['files']) - set(previous_files)))
+                    if len(files) == 0:
+                        continue
+                    logging.info("adding {0} files to {1} with systematic {2}".format(len(files), proc, unc))
+                    for c in counts[1:] + weights:
+                        if str(proc) in c.processes():
+                            previous_counts[(id(c), str(proc))] = (c, proc, c[proc])
+                elif done:
+                    logging.info("inputs of {0} changed, analyzing again with systematic {1}".format(proc, unc))
+                    for c in counts + cuts + weights:
+                        if str(proc) in c.processes():
+                            c[proc] = 0
+                    tree = 'NA' if str(proc).startswith("collisions") or str(proc).startswith("fakes") else unc
+                    redo.add(str(proc) + ('' if tree == 'NA' else '_' + tree))
+                updated[key] = current
+            elif done:
                 continue
-
-            logging.info("using systematics: " + unc)
-
-            local_cuts = list(cuts)
-            for cfg in proc.additional_cuts:
-                local_cuts.insert(0, Cut(*cfg))
-
-            proc.analyze(config, fn, counts, local_cuts, weights, unc, args.debug_cuts)
+            if any(u == unc for u, _ in todo):
+                continue
+            todo.append((unc, files))
+        for files in set(f for _, f in todo):
+            tasks.append((proc, [u for u, f in todo if f == files], files))
+    catalog.save()
+
+    # Processes reading the same datasets, e.g., the signal and fake
+    # cutflows of a sample, are analyzed in one pass.
+    groups = []
+    inputs = []
+    for (_, files), group in groupby(sorted(tasks, key=lambda t: (t[0].paths, t[2], str(t[0]))), key=lambda t: (t[0].paths, t[2])):
+        groups.append([(proc, uncertainties) for proc, uncertainties, _ in group])
+        inputs.append(None if files is None else list(files))
+
+    # New trees are written separately first, to be appended to the
+    # existing ones.  Their columnar copies are only written once
+    # appended.
+    output = fn
+    settings = config
+    if incremental:
+        drop(fn, redo)
+        output = os.path.join(config["outdir"], "ntuple-incremental.root")
+        if os.path.exists(output):
+            os.unlink(output)
+        settings = dict(config, columnar=None)
+
+    if args.jobs > 1:
+        timings = analyze_parallel(settings, output, cutflows, groups, args.jobs, args.debug_cuts, inputs)
+    else:
+        for group, files in zip(groups, inputs):
+            analyze_single(settings, output, cutflows, group, args.debug_cuts, files)
+        timings = profiling.collect()
+
+    for cut, proc, count in previous_counts.values():
+        cut[proc] = cut[proc] + count
+
+    if incremental and len(tasks) == 0 and counts_of(cutflows) != unchanged:
+        raise RuntimeError("cutflow changed without analyzing any new files")
+
+    if incremental:
+        if os.path.exists(output):
+            logging.info("appending new trees to {0}".format(fn))
+            graft(fn, [output], append=True, columnar=config.get('columnar'))
+        provenance.update(updated)
+        save_provenance(config, provenance)
+
+    if config.get('profile', False):
+        codes = {}
+        for counts, cuts, weights in cutflows.values():
+            codes.update((unicode(c), c._code) for c in cuts)
+        for proc, _, _ in tasks:
+            codes.update((unicode(name), code) for name, code in proc.additional_cuts)
+        profiling.save(timings, config["outdir"], {'cut': codes})
 
     concatenated_cutflows = Cutflows()
     for name, (counts, cuts, weights) in cutflows.items():
@@ -164,6 +319,122 @@ def analyze(args, config):
     concatenated_cutflows.save(config)
 
 
+def analyze_single(config, filename, cutflows, group, debug=False, files=None):
+    for proc, uncertainties in group:
+        logging.info("analyzing {} using systematics: {}".format(proc, ", ".join(uncertainties)))
+
+    selections = []
+    for proc, uncertainties in group:
+        for unc in uncertainties:
+            suffix = '' if unc == 'NA' else '_' + unc
+            counts, cuts, weights = cutflows[proc.cutflow + suffix]
+
+            local_cuts = list(cuts)
+            for cfg in proc.additional_cuts:
+                local_cuts.insert(0, Cut(*cfg))
+
+            selections.append((proc, unc, counts, local_cuts, weights))
+
+    # Keep selections with the same systematic together, so that weights
+    # and leaves can be shared between them.
+    selections.sort(key=lambda s: (s[1] != 'NA', s[1]))
+    BasicProcess.analyze(config, filename, selections, debug, files)
+
+    results = []
+    for proc, uncertainties in group:
+        for unc in uncertainties:
+            suffix = '' if unc == 'NA' else '_' + unc
+            results.append(cutflows[proc.cutflow + suffix])
+    return results
+
+
+# State shared with the worker processes of `analyze_parallel`, which
+# inherit it when forking.
+_shared = None
+
+
+def _analyze_shard(task):
+    config, cutflows, debug = _shared
+    names, filename, files = task
+
+    if os.path.exists(filename):
+        os.unlink(filename)
+
+    group = [(Process.get(name), uncertainties) for name, uncertainties in names]
+    results = analyze_single(config, filename, cutflows, group, debug, files)
+
+    def pick(cut, name):
+        if name in cut.processes():
+            return cut[name]
+        return None
+    values = []
+    pairs = [(name, unc) for name, uncertainties in names for unc in uncertainties]
+    for (name, _), (counts, cuts, weights) in zip(pairs, results):
+        values.append([pick(c, name) for c in counts + cuts + weights])
+    return values, profiling.collect()
+
+
+def analyze_parallel(config, filename, cutflows, groups, jobs, debug=False, inputs=None):
+    """Analyze groups of processes in a pool of `jobs` workers, restricted
+    to the files in `inputs` for each group, if given.
+
+    Every worker writes the trees of its processes into a separate shard
+    file and returns their cut counts for all systematics.  Both are
+    merged back into `filename` and `cutflows`, respectively.  Returns
+    the timings recorded by the workers.
+
+    Groups are started from the largest to the smallest input, so that
+    the slowest ones don't come last.
+    """
+    global _shared
+    _shared = (config, cutflows, debug)
+
+    # Compile all leaves and cuts up front, so that the workers only load
+    # the library instead of all compiling it at the same time.
+    for counts, cuts, weights in cutflows.values():
+        for cut in cuts:
+            cut.raw()
+    for group in groups:
+        for proc, _ in group:
+            for cfg in proc.additional_cuts:
+                Cut(*cfg).raw()
+    useful.finalize()
+
+    catalog = Catalog.get(config, NTUPLE_GLOB.format(channel=useful.config.channel))
+    order = sorted(zip(groups, inputs or [None] * len(groups)), key=lambda g: -catalog.size(g[0][0][0].paths))
+    catalog.save()
+
+    groups = []
+    shards = []
+    for n, (group, files) in enumerate(order):
+        groups.append(group)
+        shard = os.path.join(os.path.dirname(filename), "ntuple-{}-{}.root".format(n, group[0][0]))
+        shards.append(([(str(proc), uncertainties) for proc, uncertainties in group], shard, files))
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.map(_analyze_shard, shards, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        _shared = None
+
+    for group, (values, _) in zip(groups, results):
+        pairs = [(proc, unc) for proc, uncertainties in group for unc in uncertainties]
+        for (proc, unc), vs in zip(pairs, values):
+            suffix = '' if unc == 'NA' else '_' + unc
+            counts, cuts, weights = cutflows[proc.cutflow + suffix]
+            proc._setup_counts(counts, config.get('sample', 0))
+            for cut, value in zip(counts + cuts + weights, vs):
+                if value is not None:
+                    cut[proc] = value
+
+    logging.info("merging {} shards into {}".format(len(shards), filename))
+    graft(filename, [shard for _, shard, _ in shards])
+
+    return profiling.merge(*[timings for _, timings in results])
+
+
 def add_mva(args, config):
     fn = os.path.join(config["outdir"], "ntuple.root")
     for proc in set(sum((Process.expand(p) for p in config['plot'] + config['limits']), [])):
@@ -187,6 +458,35 @@ def get_categories(config):
     return categories, definitions
 
 
+def prune_leaves(config):
+    """Only keep leaves referenced by plots, categories, weights or MVAs.
+
+    Leaves listed in `pinned leaves` are kept, too.
+    """
+    exprs = list(config.get('pinned leaves', []))
+    for p in Plot.plots():
+        exprs += p.expressions
+    exprs += [d for d in get_categories(config)[1] if d]
+
+    for key, values in config.items():
+        if key.endswith(' weights'):
+            exprs += ['w_' + w.lower() for w in values or []]
+        elif key.endswith(' systematics'):
+            exprs += ['w_' + s.lower() + d for s in values or [] for d in ('up', 'down')]
+
+    mvadict = config.get('mvadict', {})
+    for name in config.get('mvas', []):
+        setup = training.load(config, name.split("_")[1])
+        exprs += [mvadict.get(v, v) for v in setup['variables']]
+        for cfg in setup.get('signals', []) + setup.get('backgrounds', []):
+            exprs += [w for w in cfg.values() if isinstance(w, basestring)]
+
+    names = set(re.findall(r'[A-Za-z_]\w*', ' '.join(exprs)))
+    before = len(list(Leaf.leaves()))
+    Leaf.prune(names)
+    logging.info("pruned leaves: keeping {0} of {1}".format(len(list(Leaf.leaves())), before))
+
+
 @contextmanager
 def open_rootfile(fn, mode="UPDATE"):
     f = r.TFile(fn, mode)
@@ -1,8 +1,11 @@
+import fnmatch
+import hashlib
 import logging
+import os
 
 import ROOT as r
 
-from ttH.TauRoast.useful import code2leaf
+from ttH.TauRoast.useful import code2leaf, discard, finalize, snippet
 
 
 class Leaf(object):
@@ -36,7 +39,17 @@ class Leaf(object):
         elif kind.lower() == '[d]':
             typename = 'std::vector<double>'
 
-        self._r = code2leaf(name, typename, code)
+        self.__fct = code2leaf(typename, code)
+        self.__r = None
+
+    @property
+    def _r(self):
+        """The C++ leaf, created when first needed, so that all leaves can
+        be compiled together.
+        """
+        if self.__r is None:
+            self.__r = snippet(self.__fct)(self.__name)
+        return self.__r
 
     @property
     def name(self):
@@ -59,6 +72,21 @@ class Leaf(object):
     def grow(self, tree):
         self._r.grow(tree)
 
+    @classmethod
+    def prune(cls, names):
+        """Remove all leaves not in `names`, so that they are neither
+        compiled, evaluated, nor written."""
+        removed = []
+        for registry in (cls.__leaves, cls.__finals):
+            for name in list(registry.keys()):
+                if name not in names:
+                    if registry[name].__r is not None:
+                        raise RuntimeError("can't prune leaf {0} already in use".format(name))
+                    removed.append(registry.pop(name))
+        used = set(l.__fct for l in cls.leaves())
+        for fct in set(l.__fct for l in removed) - used:
+            discard(fct)
+
     @classmethod
     def leaves(cls):
         for k in sorted(cls.__leaves.keys()):
@@ -66,24 +94,167 @@ class Leaf(object):
         for k in sorted(cls.__finals.keys()):
             yield cls.__finals[k]
 
+    @classmethod
+    def fingerprint(cls):
+        """Hash of the names, types, and code of all leaves.
+        """
+        h = hashlib.sha1()
+        for l in cls.leaves():
+            h.update('{0}:{1}:{2};'.format(l.__name, l.__kind, l.__fct))
+        return h.hexdigest()
+
+
+# Titles of trees while being written and when closed properly
+INCOMPLETE = 'ntuple (incomplete)'
+COMPLETE = 'ntuple'
+
+# ROOT compression algorithms, see ROOT::ECompressionAlgorithm
+COMPRESSION = {'zlib': 1, 'lzma': 2, 'lz4': 4}
+
+
+def compression(settings):
+    """Return the ROOT compression settings for the `compression` and
+    `compression level` of `settings`, or `None` to keep the default.
+    """
+    if 'compression' not in settings and 'compression level' not in settings:
+        return None
+    algorithm = settings.get('compression', 'zlib').lower()
+    if algorithm not in COMPRESSION:
+        raise ValueError("unknown compression algorithm '{0}'".format(algorithm))
+    return COMPRESSION[algorithm] * 100 + settings.get('compression level', 1)
+
+
+def order(leaves, patterns):
+    """Sort `leaves` by the first of `patterns` matching their name, keeping
+    leaves matching no pattern last, in their original order.
+    """
+    def rank(leaf):
+        for n, pattern in enumerate(patterns):
+            if fnmatch.fnmatchcase(leaf.name, pattern):
+                return n
+        return len(patterns)
+    return sorted(leaves, key=rank)
+
+
+def setup_io(tree, settings):
+    """Apply the basket size, auto flush, and auto save of `settings` to
+    `tree`, after its branches have been created.
+    """
+    if 'basket size' in settings:
+        tree.SetBasketSize('*', settings['basket size'])
+    if 'auto flush' in settings:
+        tree.SetAutoFlush(settings['auto flush'])
+    if 'auto save' in settings:
+        tree.SetAutoSave(settings['auto save'])
+
+
+def drop(filename, names):
+    """Remove the trees `names` and their MVA friends from `filename`,
+    together with their columnar copies.
+    """
+    from ttH.TauRoast import columnar
+
+    if not os.path.exists(filename):
+        return
+    f = r.TFile(filename, 'UPDATE')
+    keys = set(k.GetName() for k in f.GetListOfKeys())
+    for name in names:
+        for n in (name, name + '_mva'):
+            if n in keys:
+                f.Delete(n + ';*')
+            columnar.remove(os.path.dirname(filename), n)
+    f.Close()
+
+
+def fsck(filename):
+    """Remove trees left incomplete by an interrupted analysis, and their
+    MVA friends, from `filename`.  Returns the names of the trees removed.
+
+    Files that ROOT can't recover are moved aside.
+    """
+    if not os.path.exists(filename):
+        return []
+    f = r.TFile(filename, 'UPDATE')
+    if f.IsZombie():
+        os.rename(filename, filename + '.broken')
+        logging.error("can't recover '{0}', moved to '{0}.broken'".format(filename))
+        return []
+    keys = set(k.GetName() for k in f.GetListOfKeys())
+    removed = []
+    for name in sorted(keys):
+        tree = f.Get(name)
+        if isinstance(tree, r.TTree) and tree.GetTitle() == INCOMPLETE:
+            removed.append(name)
+    for name in removed:
+        logging.warning("removing incomplete tree {0} from '{1}'".format(name, filename))
+        f.Delete(name + ';*')
+        if name + '_mva' in keys:
+            f.Delete(name + '_mva;*')
+    f.Close()
+    return removed
+
 
 class Tree(object):
+    __files = {}
+
+    def __init__(self, filename, name, read=False, columnar=None, io=None):
+        """Create the tree `name` in `filename`, or read it if `read` is set.
+
+        With `columnar` set to `parquet` or `arrow`, a columnar copy of the
+        trees written is saved next to `filename` when done.  The dictionary
+        `io` may contain the `compression`, `compression level`, `basket
+        size`, `auto flush`, `auto save`, and `branch order` to create the
+        tree with.
 
-    def __init__(self, filename, name, read=False):
-        self.__f = r.TFile(filename, 'UPDATE')
+        New trees are marked as incomplete until closed, so that the ones
+        saved by ROOT before a crash can be removed with `fsck`.
+        """
+        self.__filename = filename
+        self.__read = read
+        self.__columnar = columnar
+        self.__f = Tree._open(filename)
+        self.__f.cd()
         self.__b = None
         if read:
             self.__t = self.__f.Get(name)
             if not isinstance(self.__t, r.TTree):
                 raise ValueError("can't read {} from file '{}'".format(name, filename))
         else:
-            self.__t = r.TTree(str(name), 'ntuple')
-            for l in Leaf.leaves():
+            io = io or {}
+            settings = compression(io)
+            if settings is not None:
+                self.__f.SetCompressionSettings(settings)
+            self.__t = r.TTree(str(name), INCOMPLETE)
+            finalize()
+            for l in order(Leaf.leaves(), io.get('branch order', [])):
                 l.grow(self.__t)
+            setup_io(self.__t, io)
+
+    @classmethod
+    def _open(cls, filename):
+        """Open `filename` for updating, sharing it between trees."""
+        f, count = cls.__files.get(filename, (None, 0))
+        if f is None:
+            f = r.TFile(filename, 'UPDATE')
+        cls.__files[filename] = (f, count + 1)
+        return f
+
+    @classmethod
+    def _close(cls, filename):
+        f, count = cls.__files.pop(filename)
+        if count > 1:
+            cls.__files[filename] = (f, count - 1)
+        else:
+            f.Close()
 
     def raw(self):
         return self.__t
 
+    def cd(self):
+        """Make the file of the tree the current directory.
+        """
+        self.__f.cd()
+
     def reset(self, tree):
         name = self.__t.GetName()
         self.__t.SetName("foo")
@@ -94,11 +265,39 @@ class Tree(object):
         self.__b = tree
         self.__b.SetName(self.__t.GetName() + "_mva")
 
-    def __del__(self):
+    def close(self):
+        """Write the trees and release the file.
+        """
+        if self.__f is None:
+            return
         if self.__b:
             self.__f.WriteObject(self.__b, self.__b.GetName())
-        self.__f.WriteObject(self.__t, self.__t.GetName())
-        self.__f.Close()
+        if self.__read:
+            self.__f.WriteObject(self.__t, self.__t.GetName())
+        else:
+            # Replace the cycle auto saved by ROOT
+            self.__t.SetTitle(COMPLETE)
+            self.__f.WriteObject(self.__t, self.__t.GetName(), 'Overwrite')
+        if self.__columnar:
+            self._export()
+        Tree._close(self.__filename)
+        self.__f = None
+
+    def __del__(self):
+        self.close()
+
+    def _export(self):
+        from ttH.TauRoast import columnar
+
+        outdir = os.path.dirname(self.__filename)
+        trees = [] if self.__read else [self.__t]
+        if self.__b:
+            trees.append(self.__b)
+        for tree in trees:
+            try:
+                columnar.export(tree, outdir, self.__columnar)
+            except Exception as e:
+                logging.error("can't export {0}: {1}".format(tree.GetName(), e))
 
 
 class Forest(object):
@@ -130,3 +329,46 @@ class Forest(object):
     @classmethod
     def draw(cls, name, *args, **kwargs):
         cls.__instance._draw(name, *args)
+
+
+def graft(filename, shards, append=False, columnar=None):
+    """Copy the trees contained in `shards` into `filename`.  With `append`
+    set, the entries of trees already in `filename` are extended.  With
+    `columnar` set to `parquet` or `arrow`, the trees copied are exported
+    again, as columnar copies of the shards would be incomplete.
+
+    The shard files are removed afterwards.
+    """
+    from ttH.TauRoast import columnar as col
+
+    outdir = os.path.dirname(filename)
+    f = r.TFile(filename, 'UPDATE')
+    for shard in shards:
+        s = r.TFile(shard, 'READ')
+        if not s.IsOpen():
+            raise IOError("Can't read file '{0}'".format(shard))
+        for name in sorted(set(k.GetName() for k in s.GetListOfKeys())):
+            tree = s.Get(name)
+            if not isinstance(tree, r.TTree):
+                continue
+            f.cd()
+            existing = f.Get(name) if append else None
+            if isinstance(existing, r.TTree):
+                existing.CopyEntries(tree)
+                f.WriteObject(existing, name, 'Overwrite')
+                # MVA outputs don't cover the new entries
+                f.Delete(name + '_mva;*')
+                col.remove(outdir, name + '_mva')
+                copy = existing
+            else:
+                copy = tree.CloneTree(-1, 'fast')
+                f.WriteObject(copy, name)
+            if columnar:
+                try:
+                    col.export(copy, outdir, columnar)
+                except Exception as e:
+                    col.remove(outdir, name)
+                    logging.error("can't export {0}: {1}".format(name, e))
+        s.Close()
+        os.unlink(shard)
+    f.Close()
@@ -0,0 +1,88 @@
+import logging
+import os
+
+from root_numpy import tree2array
+
+# File extensions of the supported formats, in order of preference when
+# reading
+FORMATS = [('parquet', '.parquet'), ('arrow', '.arrow')]
+
+
+def filename(outdir, name, fmt):
+    """Return the path of the columnar copy of tree `name` in `outdir`.
+    """
+    ext = dict(FORMATS)[fmt]
+    return os.path.join(outdir, 'columnar', str(name) + ext)
+
+
+def export(tree, outdir, fmt='parquet'):
+    """Write all branches of `tree` to a columnar file in `outdir`, as
+    Parquet or Arrow IPC, depending on `fmt`.
+    """
+    import pyarrow as pa
+
+    fn = filename(outdir, tree.GetName(), fmt)
+    if not os.path.exists(os.path.dirname(fn)):
+        try:
+            os.makedirs(os.path.dirname(fn))
+        except OSError:
+            # Created by another worker in the meantime
+            pass
+
+    data = tree2array(tree)
+    columns = []
+    for name in data.dtype.names:
+        column = data[name]
+        if column.dtype == object:
+            # Vector branches: one array per event
+            column = [v.tolist() for v in column]
+        columns.append(pa.array(column))
+    table = pa.Table.from_arrays(columns, list(data.dtype.names))
+
+    tmp = '{0}.{1}'.format(fn, os.getpid())
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, tmp)
+    else:
+        sink = pa.OSFile(tmp, 'wb')
+        writer = pa.RecordBatchFileWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+        sink.close()
+    os.rename(tmp, fn)
+    logging.debug("exported {0} to {1}".format(tree.GetName(), fn))
+
+
+def remove(outdir, name):
+    """Remove the columnar copies of tree `name` in `outdir`, in any format.
+    """
+    for fmt, _ in FORMATS:
+        fn = filename(outdir, name, fmt)
+        if os.path.exists(fn):
+            os.unlink(fn)
+
+
+def read(outdir, name, columns=None):
+    """Return the `columns` of tree `name` as a pandas DataFrame, read from
+    its columnar copy in `outdir`.  All columns are read if `columns` is
+    `None`.  Raises an `IOError` if there is no columnar copy.
+    """
+    import pyarrow as pa
+
+    for fmt, _ in FORMATS:
+        fn = filename(outdir, name, fmt)
+        if os.path.exists(fn):
+            break
+    else:
+        raise IOError("no columnar copy of {0} in '{1}'".format(name, outdir))
+
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        table = pq.read_table(fn, columns=columns, memory_map=True)
+    else:
+        table = pa.RecordBatchFileReader(pa.memory_map(fn, 'r')).read_all()
+        if columns is not None:
+            table = pa.Table.from_arrays(
+                [table.column(table.schema.get_field_index(c)) for c in columns],
+                columns)
+    return table.to_pandas()
@@ -7,7 +7,7 @@ import ROOT as r
 r.gSystem.Load("libttHTauRoast")
 
 from ttH.TauRoast.processing import Process
-from ttH.TauRoast.useful import code2cut, print_cuts
+from ttH.TauRoast.useful import code2cut, print_cuts, snippet
 
 
 class Cutflows(dict):
@@ -43,14 +43,38 @@ class Cutflows(dict):
 
 class Cut(object):
 
-    def __init__(self, name, code=None):
-        self._r = code2cut(name.encode('utf-8', 'ignore'), code) if code else None
+    def __init__(self, name, code=None, group=0):
+        """Create a cut called `name` from `code`.
+
+        Consecutive cuts with the same, non-zero `group` commute, and may
+        be evaluated in a different order.
+        """
         self._name = name
         self._code = code
+        self._group = group
+        self._fct = code2cut(code) if code else None
+        self._raw = None
+        self._counts = {}
+
+    @property
+    def _r(self):
+        """The C++ cut, created when first needed, so that all cuts can be
+        compiled together.
+        """
+        if self._raw is None and self._fct:
+            self._raw = snippet(self._fct)(self._name.encode('utf-8', 'ignore'))
+            self._raw.setGroup(self._group)
+            for p, count in self._counts.items():
+                self._raw[p] = count
+            self._counts = {}
+        return self._raw
 
     def __getitem__(self, key):
         return self._r[str(key)]
 
+    def __setitem__(self, key, value):
+        self._r[str(key)] = value
+
     def __unicode__(self):
         return self._name
 
@@ -59,18 +83,22 @@ class Cut(object):
 
     def __getstate__(self):
         counts = dict([(p, self[p]) for p in self.processes()])
-        return self._name, counts, self._code
+        return self._name, counts, self._code, self._group
 
     def __setstate__(self, state):
-        name, counts, code = state
+        name, counts, code = state[:3]
         self._name = name
         self._code = code
+        self._group = state[3] if len(state) > 3 else 0
         if code:
-            self._r = code2cut(name.encode('utf-8', 'ignore'), code)
+            self._fct = code2cut(code)
+            self._raw = None
+            self._counts = counts
         else:
-            self._r = r.fastlane.StaticCut(name.encode('ascii', 'ignore'))
-        for p, count in counts.items():
-            self._r[p] = count
+            self._fct = None
+            self._raw = r.fastlane.StaticCut(name.encode('ascii', 'ignore'))
+            for p, count in counts.items():
+                self._raw[p] = count
 
     def __add__(self, other):
         if self._name != str(other):
@@ -78,8 +106,14 @@ class Cut(object):
         for p in other.processes():
             self._r[p] += float(other[p])
 
-    def callback(self, fct):
-        self._r.setCallback(fct)
+    def callback(self, process, fct):
+        self._r.setCallback(str(process), fct)
+
+    def dump(self, process, d):
+        """Write events counted for `process` to the `fastlane::Dump` `d`,
+        or stop with `None`.
+        """
+        self._r.setDump(str(process), d if d is not None else r.MakeNullPointer(r.fastlane.Dump))
 
     def raw(self):
         return self._r
@@ -92,10 +126,7 @@ class StaticCut(Cut):
 
     def __init__(self, name):
         super(StaticCut, self).__init__(name)
-        self._r = r.fastlane.StaticCut(name)
-
-    def __setitem__(self, key, value):
-        self._r[str(key)] = value
+        self._raw = r.fastlane.StaticCut(name)
 
 
 def normalize(cuts, lumi, limit=None):
@@ -104,6 +135,7 @@ def normalize(cuts, lumi, limit=None):
 
     ntuplized = None
     analyzed = None
+    sampled = None
 
     for cut in cuts:
         if str(cut).lower() == "dataset processed":
@@ -114,19 +146,30 @@ def normalize(cuts, lumi, limit=None):
             ntuplized = cut
         elif str(cut).lower() == "ntuple analyzed":
             analyzed = cut
+        elif str(cut).lower() == "ntuple sampled":
+            sampled = cut
         elif processed and weights and ntuplized and analyzed:
             break
 
     dsetnorm = StaticCut("Dataset norm")
     luminorm = StaticCut("Luminosity norm")
     for proc in cuts[-1].processes():
+        # Sampled events are drawn evenly from all files, and the fraction
+        # analyzed is exact
+        sample = 1.
+        if sampled and proc in sampled.processes() and 0 < sampled[proc] < ntuplized[proc]:
+            sample = sampled[proc] / float(ntuplized[proc])
+            logging.warning("scaling {} by {} to compensate for sampling".format(proc, 1. / sample))
+
         if str(proc).startswith("collisions") or str(proc).startswith("fakes"):
-            dsetnorm[proc] = cuts[-1][proc]
-            luminorm[proc] = cuts[-1][proc]
+            dsetnorm[proc] = cuts[-1][proc] / sample
+            luminorm[proc] = cuts[-1][proc] / sample
         else:
             p = Process.get(proc)
             scale = processed[proc] / float(weights[proc])
-            if ntuplized[proc] == 0 or analyzed[proc] == 0:
+            if sample < 1.:
+                fraction = sample
+            elif ntuplized[proc] == 0 or analyzed[proc] == 0:
                 logging.warning("0 event count for {}".format(proc))
                 fraction = 1.
             elif (not limit) or analyzed[proc] < limit:
@@ -0,0 +1,231 @@
+import glob
+import json
+import logging
+import os
+import re
+
+import ROOT as r
+r.gSystem.Load("libttHTauRoast")
+
+from ttH.TauRoast.useful import vectorize
+
+# Name of the index kept next to the ntuples of a directory, and the
+# version of its format
+INDEX = '.roast-index.json'
+VERSION = 1
+
+# Name of the catalog of a file pattern kept in the ntuple directory, and
+# the version of its format
+CATALOG = '.roast-catalog-{0}.json'
+CATALOG_VERSION = 1
+
+
+def events(fn):
+    """Return the number of events in the ntuple `fn`.
+    """
+    f = r.TFile(fn)
+    if f.IsZombie():
+        raise IOError("can't open file '{0}'".format(fn))
+    t = f.Get('Events')
+    res = t.GetEntries() if isinstance(t, r.TTree) else 0
+    f.Close()
+    return res
+
+
+class Index(object):
+    """Sidecar index of the ntuples in a directory.
+
+    For every file, keeps its size, modification time, number of events,
+    and cut histograms summed over its runs.  Files are only read when
+    they are new or changed.
+    """
+
+    def __init__(self, directory):
+        self.__fn = os.path.join(directory, INDEX)
+        self.__changed = False
+        self.__files = {}
+        try:
+            with open(self.__fn) as f:
+                data = json.load(f)
+            if data.get('version') == VERSION:
+                self.__files = data['files']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def entry(self, fn):
+        """Return the up-to-date entry of `fn`, reading the file if needed.
+        """
+        stat = os.stat(fn)
+        name = os.path.basename(fn)
+        e = self.__files.get(name)
+        if e is None or e['size'] != stat.st_size or e['mtime'] != stat.st_mtime:
+            e = {'size': stat.st_size, 'mtime': stat.st_mtime, 'events': events(fn), 'cuts': {}}
+            self.__files[name] = e
+            self.__changed = True
+        return e
+
+    def cuts(self, fn, label):
+        """Return the binning and contents of the cut histogram `label` of
+        `fn`, or `None` if it has none.
+        """
+        e = self.entry(fn)
+        if label not in e['cuts']:
+            h = r.fastlane.get_cuts(label, vectorize([fn], 'std::string'))
+            if h is None:
+                e['cuts'][label] = None
+            else:
+                e['cuts'][label] = [
+                    h.GetNbinsX(), h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax(),
+                    [h.GetBinContent(n) for n in range(h.GetNbinsX() + 2)]
+                ]
+            self.__changed = True
+        return e['cuts'][label]
+
+    def save(self):
+        """Write the index if it changed.  Failing to do so, e.g., in a
+        read-only directory, only costs rereading the files next time.
+        """
+        if not self.__changed:
+            return
+        tmp = '{0}.{1}'.format(self.__fn, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': VERSION, 'files': self.__files}, f)
+            os.rename(tmp, self.__fn)
+            self.__changed = False
+        except (IOError, OSError) as e:
+            logging.warning("can't save index '{0}': {1}".format(self.__fn, e))
+
+
+def get_cuts(label, files):
+    """Return the cut histogram `label` summed over `files`, like
+    `fastlane::get_cuts`, but using the index of their directories.
+    """
+    indices = {}
+    res = None
+    for fn in files:
+        d = os.path.dirname(fn)
+        if d not in indices:
+            indices[d] = Index(d)
+        spec = indices[d].cuts(fn, label)
+        if spec is None:
+            continue
+        bins, low, high, contents = spec
+        if res is None:
+            res = r.TH1F("cuts", "Cut counts", bins, low, high)
+            res.SetDirectory(0)
+        for n, c in enumerate(contents):
+            res.AddBinContent(n, c)
+    for index in indices.values():
+        index.save()
+    return res
+
+
+class Catalog(object):
+    """Listing of the ntuples matching `pattern` in the dataset paths below
+    `basedir`, with their sizes and numbers of events.
+
+    The listing of a path is kept in `filename` and reused while the
+    modification time of its directory stays the same, or until it is
+    refreshed explicitly.  Changes to files that keep the modification
+    time of their directory require a refresh, see `stats`.
+    """
+    __catalogs = {}
+
+    def __init__(self, filename, basedir, pattern, refresh=False):
+        self.__fn = filename
+        self.__basedir = basedir
+        self.__pattern = pattern
+        self.__refresh = refresh
+        self.__refreshed = set()
+        self.__changed = False
+        self.__paths = {}
+        try:
+            with open(self.__fn) as f:
+                data = json.load(f)
+            if data.get('version') == CATALOG_VERSION and data.get('pattern') == pattern:
+                self.__paths = data['paths']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    @classmethod
+    def get(cls, cfg, pattern):
+        """Return the catalog for the `ntupledir` of `cfg`, shared between
+        calls.
+        """
+        basedir = cfg['ntupledir']
+        fn = os.path.join(cfg.get('catalog') or basedir, CATALOG.format(re.sub(r'\W', '_', pattern)))
+        if (fn, pattern) not in cls.__catalogs:
+            cls.__catalogs[(fn, pattern)] = Catalog(fn, basedir, pattern, cfg.get('refresh catalog', False))
+        return cls.__catalogs[(fn, pattern)]
+
+    def _entry(self, path, refresh=False):
+        d = os.path.join(self.__basedir, path)
+        mtime = os.stat(d).st_mtime
+        e = self.__paths.get(path)
+        refresh = (refresh or self.__refresh) and path not in self.__refreshed
+        if refresh or e is None or e['mtime'] != mtime:
+            logging.debug("listing files in {0}".format(d))
+            old = dict((f['name'], f) for f in e['files']) if e else {}
+            files = []
+            for fn in sorted(glob.glob(os.path.join(d, self.__pattern))):
+                stat = os.stat(fn)
+                f = old.get(os.path.basename(fn))
+                if f is None or f['size'] != stat.st_size or f['mtime'] != stat.st_mtime:
+                    f = {
+                        'name': os.path.basename(fn),
+                        'size': stat.st_size,
+                        'mtime': stat.st_mtime,
+                        'events': events(fn)
+                    }
+                files.append(f)
+            e = self.__paths[path] = {'mtime': mtime, 'files': files}
+            self.__refreshed.add(path)
+            self.__changed = True
+        return e
+
+    def files(self, paths):
+        """Return the full names of the files in `paths`.
+        """
+        res = []
+        for p in paths:
+            d = os.path.join(self.__basedir, p)
+            res += [os.path.join(d, f['name']) for f in self._entry(p)['files']]
+        return res
+
+    def stats(self, paths, refresh=False):
+        """Return the size and modification time of every file in `paths`,
+        by full name.  With `refresh` set, the files are listed again once
+        per run, to also notice changes that keep the modification time of
+        their directory.
+        """
+        res = {}
+        for p in paths:
+            d = os.path.join(self.__basedir, p)
+            for f in self._entry(p, refresh)['files']:
+                res[os.path.join(d, f['name'])] = [f['size'], f['mtime']]
+        return res
+
+    def events(self, paths):
+        """Return the number of events of every file in `paths`.
+        """
+        return sum([[f['events'] for f in self._entry(p)['files']] for p in paths], [])
+
+    def size(self, paths):
+        """Return the total size of the files in `paths`, in bytes.
+        """
+        return sum(f['size'] for p in paths for f in self._entry(p)['files'])
+
+    def save(self):
+        """Write the catalog if it changed.
+        """
+        if not self.__changed:
+            return
+        tmp = '{0}.{1}'.format(self.__fn, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'version': CATALOG_VERSION, 'pattern': self.__pattern, 'paths': self.__paths}, f)
+            os.rename(tmp, self.__fn)
+            self.__changed = False
+        except (IOError, OSError) as e:
+            logging.warning("can't save catalog '{0}': {1}".format(self.__fn, e))
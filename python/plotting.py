@@ -712,6 +712,11 @@ class Plot(object):
     def labels(self):
         return self.__axislabels
 
+    @property
+    def expressions(self):
+        """The expressions to draw, and weights overriding the default ones."""
+        return self.__values + (self.__weights if self.__weights else [])
+
     @classmethod
     def plots(cls):
         return cls.__plots.values()
@@ -1,4 +1,3 @@
-import glob
 import logging
 import math
 import os
@@ -8,7 +7,8 @@ import time
 import ROOT as r
 r.gSystem.Load("libttHTauRoast")
 
-from ttH.TauRoast import training
+from ttH.TauRoast import indexing, training
+from ttH.TauRoast.indexing import Catalog
 from ttH.TauRoast.botany import Tree
 from ttH.TauRoast.useful import vectorize
 
@@ -82,7 +82,7 @@ class BasicProcess(Process):
         self.__add_cuts = additional_cuts if additional_cuts else []
         self.relativesys(relativesys if relativesys else [])
 
-    def _setup_counts(self, counts):
+    def _setup_counts(self, counts, sampled=False):
         from ttH.TauRoast.cutting import StaticCut
         if len(counts) == 0:
             counts.append(StaticCut("Dataset"))
@@ -94,6 +94,8 @@ class BasicProcess(Process):
                     m = rx.search(line)
                     if m:
                         counts.append(StaticCut(m.group(1)))
+        if sampled and not any(str(c) == "Ntuple sampled" for c in counts):
+            counts.append(StaticCut("Ntuple sampled"))
 
     def copy(self, fct=lambda s: s, cutflow=None):
         return BasicProcess(fct(self._name), self.__paths, self.__events,
@@ -111,50 +113,154 @@ class BasicProcess(Process):
             self.__relativesys = math.sqrt(sum(s**2 for s in newsys))
         return self.__relativesys
 
-    def analyze(self, cfg, filename, counts, cuts, weights, systematics, debug=False):
+    @classmethod
+    def analyze(cls, cfg, filename, selections, debug=False, files=None):
+        """Analyze the datasets of processes in a single pass.
+
+        Every entry in `selections` is a tuple of the process, systematic,
+        counts, cuts and weights to use, and results in a tree in
+        `filename`.  All processes have to share the same paths.  Only
+        `files` of the datasets are analyzed, if given.
+        """
         from ttH.TauRoast.useful import config
         from ttH.TauRoast.printable import SyncSaver
+        from ttH.TauRoast.skimming import Skim
 
         tau_id = cfg.get(u"tau ID", "Tight")
         basedir = cfg['ntupledir']
         limit = cfg.get('event limit', -1)
-
-        if str(self).startswith("collisions") or str(self).startswith("fakes"):
-            systematics = "NA"
-
-        if debug:
-            for i, cut in enumerate(cuts):
-                cut.callback(SyncSaver(os.path.join(os.path.dirname(filename), "cut_{0}_{1}.txt".format(self, i)), systematics))
-
-        files = sum([glob.glob(os.path.join(basedir, p, NTUPLE_GLOB.format(channel=config.channel))) for p in self.__paths], [])
+        threads = cfg.get('threads', 1)
+
+        r.fastlane.setTableValidation(cfg.get('validate tables', False))
+        r.fastlane.setProfiling(cfg.get('profile', False))
+        r.fastlane.setCutReordering(cfg.get('reorder cuts', 0))
+        sampling = cfg.get('sample', 0)
+        if sampling and limit >= 0:
+            # The sampled events are counted over the whole sample, and
+            # would not match the entries read up to the limit
+            raise ValueError("can't sample events with an event limit")
+        r.fastlane.setSampling(sampling, cfg.get('sample seed', 0), cfg.get('sample block', 1000))
+
+        paths = selections[0][0].paths
+        if any(proc.paths != paths for proc, _, _, _, _ in selections):
+            raise ValueError("can only analyze processes with the same paths together")
+
+        catalog = Catalog.get(cfg, NTUPLE_GLOB.format(channel=config.channel))
+        partial = files is not None
+        if not partial:
+            files = catalog.files(paths)
+        catalog.save()
         cfiles = vectorize(files, 'std::string')
         if len(files) == 0:
-            raise IOError("could not find any files in {}".format(", ".join(self.__paths)))
-        hist = r.fastlane.get_cuts(config.channel + "Taus", cfiles)
+            raise IOError("could not find any files in {}".format(", ".join(paths)))
+        if sampling:
+            r.fastlane.setFileEntries(vectorize(catalog.files(paths), 'std::string'), vectorize(catalog.events(paths), 'long'))
+
+        # Skims have to contain all events passing the baseline cuts
+        skim = None
+        if cfg.get('skim store') and not sampling and limit < 0 and not partial:
+            skim = Skim(cfg, config.channel, files)
+        allsys = set("NA" if str(p).startswith("collisions") or str(p).startswith("fakes") else u for p, u, _, _, _ in selections)
+        skimmed = skim is not None and skim.valid(selections, allsys)
+
+        if skimmed:
+            logging.info("reading skim {0}".format(skim.filename))
+            cfiles = vectorize([skim.filename], 'std::string')
+            hist = skim.histogram()
+        elif cfg.get('ntuple index', True):
+            hist = indexing.get_cuts(config.channel + "Taus", files)
+        else:
+            hist = r.fastlane.get_cuts(config.channel + "Taus", cfiles)
         if hist is None:
-            raise IOError("Could not produce cutflow histogram from directory '{0}'".format(os.path.join(basedir, p)))
-
-        self._setup_counts(counts)
-        for n, cut in enumerate(counts[1:], 1):
-            cut[self] = hist.GetBinContent(n)
-
-        counts[0][self] = self.__events
-
-        for w in weights:
-            w[self] = 0
-
-        suffix = '' if systematics == 'NA' else '_' + systematics
-        tree = Tree(filename, str(self) + suffix)
-
-        ccuts = vectorize(cuts, 'fastlane::Cut*')
-        cweights = vectorize(weights, 'fastlane::StaticCut*')
-        doweights = cfg.get("weights", not str(self).startswith("collisions"))
+            raise IOError("Could not produce cutflow histogram from directories '{0}'".format(
+                ", ".join(os.path.join(basedir, p) for p in paths)))
+
+        processes = []
+        systematics = []
+        trees = []
+        names = set()
+        ccuts = r.std.vector('std::vector<fastlane::Cut*>')()
+        cweights = r.std.vector('std::vector<fastlane::StaticCut*>')()
+        doweights = r.std.vector('int')()
+        dumps = []
+        for proc, unc, counts, cuts, weights in selections:
+            # One file per cut, process, and cutflow
+            tag = '' if unc == 'NA' else '_' + unc
+            if str(proc).startswith("collisions") or str(proc).startswith("fakes"):
+                unc = "NA"
+
+            if debug:
+                for i, cut in enumerate(cuts):
+                    fn = os.path.join(os.path.dirname(filename), "cut_{0}{1}_{2}.txt".format(proc, tag, i))
+                    if cfg.get('debug format', 'native') == 'python':
+                        cut.callback(proc, SyncSaver(fn, unc))
+                    else:
+                        dumps.append(r.fastlane.Dump(fn, config.leptons, unc))
+                        cut.dump(proc, dumps[-1])
+
+            proc._setup_counts(counts, sampling)
+            for n, cut in enumerate(counts[1:], 1):
+                if str(cut) != "Ntuple sampled":
+                    cut[proc] = hist.GetBinContent(n)
+
+            counts[0][proc] = proc.__events
+
+            for w in weights:
+                w[proc] = 0
+
+            # Systematics are identical for collisions: only keep one
+            # tree, but still count the events passing each cutflow.
+            suffix = '' if unc == 'NA' else '_' + unc
+            if str(proc) + suffix in names:
+                trees.append(r.MakeNullPointer(r.TTree))
+            else:
+                trees.append(Tree(filename, str(proc) + suffix, columnar=cfg.get('columnar'), io=cfg.get('tree io')))
+                names.add(str(proc) + suffix)
+            processes.append(str(proc))
+            systematics.append(unc)
+            ccuts.push_back(vectorize(cuts, 'fastlane::Cut*'))
+            cweights.push_back(vectorize(weights, 'fastlane::StaticCut*'))
+            doweights.push_back(cfg.get("weights", not str(proc).startswith("collisions")))
+
+        cprocesses = vectorize(processes, 'std::string')
+        ctrees = vectorize(trees, 'TTree*')
+        csystematics = vectorize(systematics, 'std::string')
+
+        label = ", ".join(sorted(set(processes)))
 
         def log(i):
-            logging.info("processing {0}, event {1}".format(str(self), i))
+            logging.info("processing {0}, event {1}".format(label, i))
+
+        r.fastlane.setSkimInput(skimmed)
+        if skim and not skimmed:
+            skim.write()
         now = time.clock()
-        r.fastlane.process(str(self), config.channel, cfiles, tree.raw(), ccuts, cweights, systematics, tau_id, log, limit, doweights)
+        r.fastlane.process(cprocesses, config.channel, cfiles, ctrees, ccuts, cweights, csystematics, tau_id, log, limit, doweights, threads)
         logging.debug("time spent processing: {0}".format(time.clock() - now))
+        r.fastlane.setSkimInput(False)
+
+        if dumps:
+            for proc, _, _, cuts, _ in selections:
+                for cut in cuts:
+                    cut.dump(proc, None)
+            del dumps[:]
+
+        for tree in trees:
+            if isinstance(tree, Tree):
+                tree.close()
+
+        if skimmed:
+            skim.restore(selections)
+        elif skim:
+            skim.save(hist, selections, allsys)
+
+        if sampling:
+            sampled = r.fastlane.sampledEvents()
+            logging.info("sampled {0} events of {1}".format(sampled, label))
+            for proc, _, counts, _, _ in selections:
+                for cut in counts:
+                    if str(cut) == "Ntuple sampled":
+                        cut[proc] = sampled
 
     def add_mva(self, cfg, filename, systematics):
         if 'mvadict' in cfg:
@@ -164,13 +270,14 @@ class BasicProcess(Process):
         else:
             transform = None
         suffix = '' if systematics == 'NA' else '_' + systematics
-        tree = Tree(filename, str(self) + suffix, read=True)
+        tree = Tree(filename, str(self) + suffix, read=True, columnar=cfg.get('columnar'))
         logging.info("evaluating MVA for {}".format(self))
         now = time.clock()
         try:
             training.evaluate(cfg, tree, cfg.get('mvas', []), transform)
         except (IOError, ValueError) as e:
             logging.error("can't evaluate MVA: {}".format(e))
+        tree.close()
         logging.debug("time spent evaluating MVA: {0}".format(time.clock() - now))
 
     def process(self):
@@ -0,0 +1,59 @@
+import codecs
+import json
+import os
+
+import ROOT as r
+r.gSystem.Load("libttHTauRoast")
+
+
+def collect():
+    """Return the timings recorded by fastlane since the last call.
+    """
+    return [
+        dict(kind=str(t.kind), name=str(t.name).decode('utf-8'), calls=t.calls, passed=t.passed, seconds=t.seconds)
+        for t in r.fastlane.timings()
+    ]
+
+
+def merge(*timings):
+    """Sum lists of timings with the same kind and name.
+    """
+    res = {}
+    for ts in timings:
+        for t in ts:
+            key = (t['kind'], t['name'])
+            if key not in res:
+                res[key] = dict(t)
+            else:
+                for k in ('calls', 'passed', 'seconds'):
+                    res[key][k] += t[k]
+    return sorted(res.values(), key=lambda t: -t['seconds'])
+
+
+def save(timings, outdir, codes=None):
+    """Write `timings` to `profile.json` and `profile.txt` in `outdir`.
+
+    The optional dictionary `codes` maps names of cuts and leaves to their
+    definitions, which are added to the report.
+    """
+    timings = merge(timings)
+    total = sum(t['seconds'] for t in timings)
+    for t in timings:
+        if codes and t['name'] in codes.get(t['kind'], {}):
+            t['code'] = codes[t['kind']][t['name']]
+
+    with open(os.path.join(outdir, 'profile.json'), 'w') as f:
+        json.dump(timings, f, indent=2, sort_keys=True)
+
+    namelength = max([len(t['name']) for t in timings] + [4])
+    header = u"{{:7}}  {{:{0}}}  {{:>12}}  {{:>9}}  {{:>9}}  {{:>10}}  {{:>6}}\n".format(namelength)
+    body = u"{{:7}}  {{:{0}}}  {{:12,d}}  {{:9}}  {{:9.2f}}  {{:10.3f}}  {{:6.2f}}\n".format(namelength)
+    with codecs.open(os.path.join(outdir, 'profile.txt'), 'w', encoding='utf8') as f:
+        f.write(header.format("kind", "name", "calls", "passed", "time [s]", "time [us]", "share"))
+        f.write(header.format("", "", "", "", "", "per call", "[%]"))
+        for t in timings:
+            passed = "{:8.2f}%".format(100. * t['passed'] / t['calls']) if t['kind'] == 'cut' and t['calls'] > 0 else ""
+            f.write(body.format(
+                t['kind'], t['name'], t['calls'], passed, t['seconds'],
+                1e6 * t['seconds'] / max(t['calls'], 1),
+                100. * t['seconds'] / total if total > 0 else 0.))
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import logging
+import os
+
+import ROOT as r
+r.gSystem.Load("libttHTauRoast")
+
+from ttH.TauRoast.useful import fingerprint, vectorize
+
+
+def baseline(cfg):
+    """Return the baseline cuts of `cfg` as a list of names and code.
+    """
+    res = []
+    for entry in cfg.get('baseline cuts', []):
+        for cut in (entry if isinstance(entry, list) else [entry]):
+            res.append(cut.items()[0])
+    return res
+
+
+class Skim(object):
+    """Events of a set of ntuples passing the baseline cuts.
+
+    Skims are kept in the `skim store`, in a directory named after a hash
+    of the channel, the baseline cuts, and the names and modification
+    times of the ntuples.  Besides the events, they contain the cutflow
+    histogram of the ntuples, and the counts of the baseline cuts of every
+    selection analyzed when writing them.
+    """
+
+    def __init__(self, cfg, channel, files):
+        self.__baseline = baseline(cfg)
+
+        h = hashlib.sha1(fingerprint())
+        h.update(channel)
+        for name, code in self.__baseline:
+            h.update(name.encode('utf-8'))
+            h.update(code)
+        for fn in sorted(files):
+            h.update(fn)
+            h.update(str(os.path.getmtime(fn)))
+
+        self.__dir = os.path.join(cfg['skim store'], h.hexdigest()[:16])
+        self.__info = os.path.join(self.__dir, 'skim.json')
+        self.filename = os.path.join(self.__dir, 'skim.root')
+
+        self.__file = None
+        self.__tree = None
+        self.__cuts = None
+
+        try:
+            with open(self.__info) as f:
+                self.__data = json.load(f)
+        except (IOError, ValueError):
+            self.__data = {'systematics': [], 'counts': {}}
+
+    @staticmethod
+    def _key(proc, unc):
+        return u"{0}:{1}".format(proc, unc)
+
+    def _range(self, proc):
+        """Positions of the unskimmed cuts of `proc`: "Ntuple analyzed" and
+        the baseline, after the additional cuts."""
+        first = len(proc.additional_cuts)
+        return first, first + len(self.__baseline) + 1
+
+    def valid(self, selections, systematics):
+        """Check if the skim has the events and counts for `selections`.
+        """
+        if not os.path.exists(self.filename):
+            return False
+        if not set(systematics) <= set(self.__data['systematics']):
+            return False
+        return all(self._key(proc, unc) in self.__data['counts'] for proc, unc, _, _, _ in selections)
+
+    def histogram(self):
+        """Return the cutflow histogram of the ntuples.
+        """
+        f = r.TFile(self.filename)
+        hist = f.Get("cuts")
+        hist.SetDirectory(0)
+        f.Close()
+        return hist
+
+    def restore(self, selections):
+        """Set the counts of the cuts that events in the skim all passed.
+        """
+        for proc, unc, _, cuts, _ in selections:
+            first, last = self._range(proc)
+            for cut, count in zip(cuts[first:last], self.__data['counts'][self._key(proc, unc)]):
+                cut[proc] = count
+
+    def write(self):
+        """Start writing the skim while processing.
+        """
+        from ttH.TauRoast.cutting import Cut
+
+        if not os.path.exists(self.__dir):
+            os.makedirs(self.__dir)
+
+        self.__file = r.TFile('{0}.{1}'.format(self.filename, os.getpid()), 'RECREATE')
+        self.__tree = r.TTree('skim', 'events passing the baseline cuts')
+        self.__tree.SetDirectory(self.__file)
+        self.__cuts = [Cut(name, code) for name, code in self.__baseline]
+        r.fastlane.setSkimOutput(self.__tree, vectorize(self.__cuts, 'fastlane::Cut*'))
+
+    def save(self, hist, selections, systematics):
+        """Finish writing the skim, with the cutflow histogram `hist` and the
+        counts of `selections`.
+        """
+        r.fastlane.setSkimOutput(r.MakeNullPointer(r.TTree), r.std.vector('fastlane::Cut*')())
+        self.__file.WriteObject(self.__tree, 'skim')
+        self.__file.WriteObject(hist, 'cuts')
+        tmp = self.__file.GetName()
+        self.__file.Close()
+        self.__file = None
+        self.__tree = None
+        self.__cuts = None
+
+        # Counts of selections with other systematics stay valid, as they
+        # don't depend on the events in the skim.
+        counts = dict((k, v) for k, v in self.__data['counts'].items() if k.split(':')[-1] in systematics)
+        for proc, unc, _, cuts, _ in selections:
+            first, last = self._range(proc)
+            counts[self._key(proc, unc)] = [cut[proc] for cut in cuts[first:last]]
+        self.__data = {'systematics': sorted(set(systematics)), 'counts': counts}
+
+        os.rename(tmp, self.filename)
+        with open(self.__info, 'w') as f:
+            json.dump(self.__data, f, indent=2, sort_keys=True)
+        logging.info("saved skim {0}".format(self.filename))
@@ -44,21 +44,33 @@ def load(config, name):
     return setup
 
 
+def read_columns(config, name, columns):
+    """Return `columns` of the tree `name` as an array, from the columnar
+    copy of the ntuple if available.
+    """
+    indir = config.get("indir", config["outdir"])
+    if config.get('columnar'):
+        from ttH.TauRoast import columnar
+        try:
+            return columnar.read(indir, name, columns).values
+        except IOError as e:
+            logging.warning("{0}, falling back to ROOT".format(e))
+    return rec2array(root2array(os.path.join(indir, "ntuple.root"), str(name), columns))
+
+
 def read_inputs(config, setup):
     from ttH.TauRoast.processing import Process
 
-    fn = os.path.join(config.get("indir", config["outdir"]), "ntuple.root")
-
     signal = None
     signal_weights = None
     for proc, weight in sum([cfg.items() for cfg in setup['signals']], []):
         for p in sum([Process.expand(proc)], []):
             logging.debug('reading {}'.format(p))
-            d = rec2array(root2array(fn, str(p), setup['variables']))
+            d = read_columns(config, p, setup['variables'])
             if isinstance(weight, float) or isinstance(weight, int):
                 w = np.array([weight] * len(d))
             else:
-                w = rec2array(root2array(fn, str(p), [weight])).ravel()
+                w = read_columns(config, p, [weight]).ravel()
             w *= p.cross_section / p.events
             if signal is not None:
                 signal = np.concatenate((signal, d))
@@ -72,11 +84,11 @@ def read_inputs(config, setup):
     for proc, weight in sum([cfg.items() for cfg in setup['backgrounds']], []):
         for p in sum([Process.expand(proc)], []):
             logging.debug('reading {}'.format(p))
-            d = rec2array(root2array(fn, str(p), setup['variables']))
+            d = read_columns(config, p, setup['variables'])
             if isinstance(weight, float) or isinstance(weight, int):
                 w = np.array([weight] * len(d))
             else:
-                w = rec2array(root2array(fn, str(p), [weight])).ravel()
+                w = read_columns(config, p, [weight]).ravel()
             w *= p.cross_section / p.events
             if background is not None:
                 background = np.concatenate((background, d))
@@ -93,19 +105,32 @@ def read_inputs(config, setup):
 
 
 def evaluate(config, tree, names, transform=None):
-    output = []
-    dtype = []
+    """Evaluate the MVAs `names` for the events in `tree`, and add their
+    outputs as a friend tree.
+
+    The inputs of all MVAs are read together, in chunks of `mva chunk`
+    events, and every MVA is passed the columns it needs.  The outputs of
+    each chunk are appended to the friend tree, which is written to the
+    file of `tree`, so that memory use depends only on the chunk size.
+    """
+    setups = []
+    columns = []
     for name in names:
         setup = load(config, name.split("_")[1])
-        data = rec2array(tree2array(tree.raw(), list(transform(setup["variables"])) if transform else setup["variables"]))
+        variables = list(transform(setup["variables"])) if transform else setup["variables"]
+        setups.append((name, setup, variables))
+        columns += [v for v in variables if v not in columns]
+    indices = dict((v, n) for n, v in enumerate(columns))
+
+    models = []
+    dtype = []
+    for name, setup, variables in setups:
+        select = [indices[v] for v in variables]
         if name.startswith("sklearn"):
             fn = os.path.join(config["mvadir"], name + ".pkl")
             with open(fn, 'rb') as fd:
                 bdt, label = pickle.load(fd)
-            scores = []
-            if len(data) > 0:
-                scores = bdt.predict_proba(data)[:, 1]
-            output += [scores]
+            models.append((select, lambda data, bdt=bdt: bdt.predict_proba(data)[:, 1]))
             dtype += [(name, 'float64')]
 
         fn = os.path.join(config["mvadir"], name + ".xml")
@@ -113,10 +138,10 @@ def evaluate(config, tree, names, transform=None):
         for var in setup['variables']:
             reader.AddVariable(var, array('f', [0.]))
         reader.BookMVA("BDT", fn)
-        scores = evaluate_reader(reader, "BDT", data)
-        output += [scores]
+        models.append((select, lambda data, reader=reader: evaluate_reader(reader, "BDT", data)))
         dtype += [(name.replace("sklearn", "tmvalike"), 'float64')]
 
+    likelihood = None
     f = r.TFile(os.path.join(config.get("mvadir", config.get("indir", config["outdir"])), "mapping.root"), "READ")
     if f.IsOpen():
         likelihood = f.Get("hTargetBinning")
@@ -124,17 +149,31 @@ def evaluate(config, tree, names, transform=None):
         def lh(values):
             return likelihood.GetBinContent(likelihood.FindBin(*values))
         indices = dict((v, n) for n, (v, _) in enumerate(dtype))
-        tt = output[indices['tmvalike_tt']]
-        ttZ = output[indices['tmvalike_ttZ']]
-        if len(tt) == 0:
-            output += [[]]
-        else:
-            output += [np.apply_along_axis(lh, 1, np.array([tt, ttZ]).T)]
         dtype += [('tmvalike_likelihood', 'float64')]
-        f.Close()
 
-    data = np.array(zip(*output), dtype)
-    tree.mva(array2tree(data))
+    chunk = config.get('mva chunk', 100000)
+    entries = tree.raw().GetEntries() if models else 0
+    mva = None
+    for start in range(0, entries, chunk):
+        data = rec2array(tree2array(tree.raw(), columns, start=start, stop=start + chunk))
+        output = [fct(data[:, select]) for select, fct in models]
+        if likelihood:
+            tt = output[indices['tmvalike_tt']]
+            ttZ = output[indices['tmvalike_ttZ']]
+            output.append(np.apply_along_axis(lh, 1, np.array([tt, ttZ]).T))
+
+        scores = np.empty(len(data), dtype)
+        for (name, _), values in zip(dtype, output):
+            scores[name] = values
+        if mva is None:
+            tree.cd()
+        mva = array2tree(scores, tree=mva)
+
+    if mva is None:
+        tree.cd()
+        mva = array2tree(np.empty(0, dtype))
+    tree.mva(mva)
+    f.Close()
 
 
 def run_cross_validation(outdir, bdts, x, y):
@@ -1,14 +1,17 @@
 import hashlib
+import logging
 import math
 import os
+import re
 import ROOT as r
 import sys
-import time
 
 from collections import namedtuple
 
 Config = namedtuple('Config', ['channel', 'taus', 'leptons'])
 config = None
+# Directory to cache compiled leaves and cuts in, `None` to use the JIT
+cachedir = None
 
 
 def setup_processes(config):
@@ -34,12 +37,19 @@ def setup_processes(config):
 
 
 def setup(cfg):
-    global config
+    global cachedir, config
 
-    for k in ('indir', 'outdir', 'mvadir', 'ntupledir'):
-        if k in cfg:
+    cfg.setdefault('compile cache', os.path.join(os.environ.get("LOCALRT", "~"), 'tmp', 'roast'))
+    for k in ('indir', 'outdir', 'mvadir', 'ntupledir', 'compile cache', 'skim store', 'catalog'):
+        if cfg.get(k):
             cfg[k] = os.path.expanduser(os.path.expandvars(cfg[k]))
 
+    cachedir = cfg['compile cache']
+    if cachedir:
+        for base in ("CMSSW_BASE", "CMSSW_RELEASE_BASE"):
+            if base in os.environ:
+                r.gSystem.AddIncludePath("-I" + os.path.join(os.environ[base], 'src'))
+
     channel = cfg['channel']
     config = Config(
         channel=channel,
@@ -90,50 +100,101 @@ def btag(jet):
     return jet.csv() > 0.8484
 
 
-r.gInterpreter.Declare("""
-        #include "DataFormats/Math/interface/deltaR.h"
-        template<typename T, typename U> double dR(T t, U u) {
-            return reco::deltaR(t, u);
-        }
-
-        template<typename T> int len(T t) { return t.size(); }
-        template<typename T> bool btag(T j, bool loose=false) { return j.csv() > (loose ? 0.5426 : 0.8484); }
-        template<typename T> int btags(T js, bool loose=false) {
-            int res = 0;
-            for (const auto& j: js)
-                res += btag(j, loose);
-            return res;
-        }
-        template<typename T> T tags(T js) {
-            T res;
-            for (const auto& j: js)
-                if (btag(j))
-                    res.push_back(j);
-            return res;
-        }
-        template<typename T> T notags(T js) {
-            T res;
-            for (const auto& j: js)
-                if (!btag(j))
-                    res.push_back(j);
-            return res;
-        }
-        template<typename S, typename T> float metLD(float met, S js, T ls) {
-            superslim::LorentzVector mht;
-            for (const auto& j: js)
-                if (j.pt() >= 25.)
-                    mht += j.p4();
-            for (const auto& l: ls)
-                mht += l.p4();
-            return 0.00397 * met + 0.00265 * mht.pt();
-        }
-""")
-
-
-def code2cut(name, code):
-    stub = hashlib.sha1(code + "\n{0}".format(time.time())).hexdigest()[:7]
-    chunck = """
-        bool fct_{f}(const superslim::Event& event,
+r.gInterpreter.Declare('#include "ttH/TauRoast/interface/FastlaneSnippets.h"')
+
+_compiled = set()
+_fingerprint = None
+
+
+def fingerprint():
+    """Hash of everything besides their code that compiled snippets depend on.
+    """
+    global _fingerprint
+    if _fingerprint is None:
+        h = hashlib.sha1(r.gROOT.GetVersion())
+        h.update(os.environ.get('SCRAM_ARCH', ''))
+        incdir = os.path.join(os.environ.get("LOCALRT", ""), 'src', 'ttH', 'TauRoast', 'interface')
+        for header in ('Fastlane.h', 'FastlaneSnippets.h', 'SuperSlim.h'):
+            fn = os.path.join(incdir, header)
+            if os.path.exists(fn):
+                with open(fn) as f:
+                    h.update(f.read())
+        _fingerprint = h.hexdigest()
+    return _fingerprint
+
+
+def compile_unit(unit, chunck):
+    """Compile the C++ code in `chunck`.
+
+    With a `compile cache` configured, `chunck` is compiled into a shared
+    library in the cache directory, to be loaded again by later runs.
+    Library names contain a hash of the code, so any change results in a
+    new library.  Otherwise, `chunck` is declared to the interpreter.
+    """
+    if cachedir:
+        src = os.path.join(cachedir, unit + '.C')
+        lib = os.path.join(cachedir, '{0}_C.{1}'.format(unit, r.gSystem.GetSoExt()))
+        if os.path.exists(lib) and r.gSystem.Load(lib) >= 0:
+            return
+        if not os.path.exists(cachedir):
+            try:
+                os.makedirs(cachedir)
+            except OSError:
+                # Created by another process in the meantime
+                if not os.path.isdir(cachedir):
+                    raise
+        tmp = '{0}.{1}'.format(src, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(chunck)
+        os.rename(tmp, src)
+        logging.debug("compiling %s", src)
+        success = r.gSystem.CompileMacro(src, 'kfOs') == 1
+    else:
+        success = r.gInterpreter.Declare(chunck)
+
+    if not success:
+        raise RuntimeError("Can't compile:\n" + chunck)
+
+
+_pending = {}
+
+
+def finalize():
+    """Compile all snippets registered since the last call in one unit.
+    """
+    if not _pending:
+        return
+    fcts = sorted(_pending.keys())
+    unit = 'unit_' + hashlib.sha1(fingerprint() + ''.join(fcts)).hexdigest()[:12]
+    logging.info("compiling %d leaves and cuts", len(fcts))
+    compile_unit(unit, '#include "ttH/TauRoast/interface/FastlaneSnippets.h"\n' +
+                 ''.join(_pending[f] for f in fcts))
+    _compiled.update(fcts)
+    _pending.clear()
+
+
+def discard(fct):
+    """Drop the snippet `fct` if it has not been compiled yet.
+    """
+    _pending.pop(fct, None)
+
+
+def snippet(fct):
+    """Return the factory `fct`, compiling pending snippets if needed.
+    """
+    if fct not in _compiled:
+        finalize()
+    return getattr(r, fct)
+
+
+def code2cut(code):
+    """Register `code` as a cut and return the name of its factory.
+    """
+    stub = hashlib.sha1(fingerprint() + code).hexdigest()[:12]
+    fct = 'cut_' + stub
+    if fct not in _compiled:
+        _pending[fct] = """
+        bool cutfct_{f}(const superslim::Event& event,
                 const std::vector<superslim::Tau>& taus,
                 const std::vector<superslim::Tau>& all_taus,
                 superslim::Tau::id tau_id,
@@ -142,20 +203,42 @@ def code2cut(name, code):
                 superslim::Lepton::id lepton_id,
                 const std::vector<superslim::Jet>& jets,
                 const superslim::LorentzVector& met) {{ return {c}; }}
-        auto cut_{f} = fastlane::Cut("{n}", &fct_{f});
-    """.format(n=name, f=stub, c=code)
-    if not r.gInterpreter.Declare(chunck):
-        raise RuntimeError("Can't compile:\n" + chunck)
-    return getattr(r, 'cut_' + stub)
+        fastlane::Cut* cut_{f}(const std::string& name) {{
+            return new fastlane::Cut(name, &cutfct_{f});
+        }}
+        """.format(f=stub, c=code)
+    return fct
+
 
+_weight_lookup = re.compile(r'weights\[\s*"([^"]+)"\s*\]')
 
-def code2leaf(name, typename, code):
-    stub = hashlib.sha1(name + code).hexdigest()[:7]
-    chunck = """
-        #include <algorithm>
-        #include "ttH/TauRoast/interface/Fastlane.h"
 
-        void fct_{f}(const superslim::Event& event,
+def resolve_weights(code):
+    """Replace lookups of weights by name in `code` with slots, which are
+    resolved once when the code is first run.
+    """
+    names = []
+
+    def replace(m):
+        if m.group(1) not in names:
+            names.append(m.group(1))
+        return 'weights[weight_slot_{0}]'.format(names.index(m.group(1)))
+
+    code = _weight_lookup.sub(replace, code)
+    decls = ''.join('static const int weight_slot_{0} = fastlane::Weights::slot("{1}");\n'.format(n, name)
+                    for n, name in enumerate(names))
+    return decls + code
+
+
+def code2leaf(typename, code):
+    """Register `code` as a leaf and return the name of its factory.
+    """
+    code = resolve_weights(code)
+    stub = hashlib.sha1(fingerprint() + typename + code).hexdigest()[:12]
+    fct = 'leaf_' + stub
+    if fct not in _compiled:
+        _pending[fct] = """
+        void leaffct_{f}(const superslim::Event& event,
                 const std::vector<superslim::Tau>& taus,
                 const std::vector<superslim::Tau>& all_taus,
                 const std::vector<superslim::Lepton>& leptons,
@@ -164,15 +247,15 @@ def code2leaf(name, typename, code):
                 const std::vector<superslim::Lepton>& all_leptons,
                 const std::vector<superslim::Jet>& jets,
                 const superslim::LorentzVector& met,
-                std::unordered_map<std::string, double>& weights,
+                fastlane::Weights& weights,
                 {t}& result) {{
             {c};
         }}
-        fastlane::Leaf<{t}> leaf_{f}("{n}", &fct_{f});
-    """.format(n=name, f=stub, c=code, t=typename)
-    if not r.gInterpreter.Declare(chunck):
-        raise RuntimeError("Can't compile\n" + chunck)
-    return getattr(r, 'leaf_' + stub)
+        fastlane::Leaf<{t}>* leaf_{f}(const std::string& name) {{
+            return new fastlane::Leaf<{t}>(name, &leaffct_{f});
+        }}
+        """.format(f=stub, c=code, t=typename)
+    return fct
 
 
 def print_cuts(cuts, columns, cutdata=None, sum_columns=None, what="", f=sys.stdout, precision=2):
@@ -1,8 +1,19 @@
+#include <atomic>
 #include <cctype>
+#include <chrono>
 #include <cstdlib>
+#include <functional>
+#include <future>
+#include <map>
+#include <mutex>
+#include <numeric>
+#include <random>
+#include <stdexcept>
 
 #include "RooWorkspace.h"
+#include "TChain.h"
 #include "TFile.h"
+#include "TROOT.h"
 #include "TPython.h"
 #include "TPyArg.h"
 
@@ -20,19 +31,16 @@
 #include "ttH/TauRoast/interface/Fastlane.h"
 
 float
-get_factor(std::auto_ptr<TH2F>& h, const superslim::Lepton& l, bool swapped=false)
+get_factor(const fastlane::Table2D& h, const superslim::Lepton& l, bool swapped=false)
 {
-   int x = std::max(1, std::min(h->GetNbinsX(), h->GetXaxis()->FindBin(swapped ? l.eta() : l.pt())));
-   int y = std::max(1, std::min(h->GetNbinsY(), h->GetYaxis()->FindBin(swapped ? l.pt() : std::abs(l.eta()))));
-   return h->GetBinContent(x, y);
+   return h.clamped(swapped ? l.eta() : l.pt(), swapped ? l.pt() : std::abs(l.eta()));
 }
 
 float
-get_factor(std::auto_ptr<TGraphAsymmErrors>& g, float v)
+get_factor(const fastlane::Graph& g, float v)
 {
-   float x = std::max(float(g->GetXaxis()->GetXmin() + 1e-5),
-         std::min(float(g->GetXaxis()->GetXmax() - 1e-5), v));
-   return g->Eval(x);
+   float x = std::max(float(g.min() + 1e-5), std::min(float(g.max() - 1e-5), v));
+   return g.eval(x);
 }
 
 std::string
@@ -44,6 +52,88 @@ lower(const std::string& s)
    return res;
 }
 
+bool table_validation = false;
+
+void
+fastlane::setTableValidation(bool validate)
+{
+   table_validation = validate;
+}
+
+bool
+fastlane::tableValidation()
+{
+   return table_validation;
+}
+
+namespace {
+   typedef std::chrono::steady_clock profile_clock;
+
+   std::atomic<bool> profile_enabled(false);
+   std::mutex profile_lock;
+   std::map<std::pair<std::string, std::string>, fastlane::Timing> profile_totals;
+   // Per thread, keyed by the object timed
+   thread_local std::unordered_map<const void*, fastlane::Timing> profile_local;
+
+   fastlane::Timing&
+   timing(const void* key, const char* kind, const std::string& name)
+   {
+      auto& t = profile_local[key];
+      if (t.kind.empty()) {
+         t.kind = kind;
+         t.name = name;
+      }
+      return t;
+   }
+
+   void
+   record(fastlane::Timing& t, profile_clock::time_point start, bool passed=true)
+   {
+      t.calls += 1;
+      t.passed += passed;
+      t.seconds += std::chrono::duration<double>(profile_clock::now() - start).count();
+   }
+
+   // Add the timings of the current thread to the totals
+   void
+   flush_profile()
+   {
+      std::lock_guard<std::mutex> guard(profile_lock);
+      for (const auto& p: profile_local) {
+         auto& t = profile_totals[std::make_pair(p.second.kind, p.second.name)];
+         t.kind = p.second.kind;
+         t.name = p.second.name;
+         t.calls += p.second.calls;
+         t.passed += p.second.passed;
+         t.seconds += p.second.seconds;
+      }
+      profile_local.clear();
+   }
+}
+
+void
+fastlane::setProfiling(bool profile)
+{
+   profile_enabled = profile;
+}
+
+bool
+fastlane::profiling()
+{
+   return profile_enabled;
+}
+
+std::vector<fastlane::Timing>
+fastlane::timings()
+{
+   std::lock_guard<std::mutex> guard(profile_lock);
+   std::vector<fastlane::Timing> res;
+   for (const auto& p: profile_totals)
+      res.push_back(p.second);
+   profile_totals.clear();
+   return res;
+}
+
 #ifndef OLDCRAP
 fastlane::CSVHelper::CSVHelper()
    : reader_(BTagEntry::OP_RESHAPING, "central", {
@@ -66,8 +156,18 @@ fastlane::CSVHelper::CSVHelper()
    reader_.load(calib, BTagEntry::FLAV_UDSG, "iterativefit");
 }
 
-float
-fastlane::CSVHelper::weight(const std::vector<superslim::Jet>& jets, const std::string& sys)
+BTagEntry::JetFlavor
+csv_flavor(const superslim::Jet& j)
+{
+   if (std::abs(j.flavor()) == 5)
+      return BTagEntry::FLAV_B;
+   else if (std::abs(j.flavor()) == 4)
+      return BTagEntry::FLAV_C;
+   return BTagEntry::FLAV_UDSG;
+}
+
+bool
+csv_applies(BTagEntry::JetFlavor flavor, const std::string& sys)
 {
    static const std::vector<std::string> bsys{
       "up_jes", "up_lf", "up_hfstats1", "up_hfstats2",
@@ -82,39 +182,117 @@ fastlane::CSVHelper::weight(const std::vector<superslim::Jet>& jets, const std::
       "down_cferr1", "down_cferr2"
    };
 
+   const auto& use = flavor == BTagEntry::FLAV_B ? bsys : (flavor == BTagEntry::FLAV_C ? csys : lsys);
+   return std::find(use.begin(), use.end(), sys) != use.end();
+}
+
+const std::vector<std::string>&
+fastlane::CSVHelper::variations()
+{
+   static const std::vector<std::string> vars{
+      "up_hf", "up_hfstats1", "up_hfstats2",
+      "up_lf", "up_lfstats1", "up_lfstats2",
+      "up_cferr1", "up_cferr2",
+      "down_hf", "down_hfstats1", "down_hfstats2",
+      "down_lf", "down_lfstats1", "down_lfstats2",
+      "down_cferr1", "down_cferr2"
+   };
+   return vars;
+}
+
+float
+fastlane::CSVHelper::weight(const std::vector<superslim::Jet>& jets, const std::string& sys)
+{
    float w = 1.;
 
    for (const auto& j: jets) {
-      float jw = 1.;
-      if (std::abs(j.flavor()) == 5) {
-         std::string use = sys;
-         if (std::find(bsys.begin(), bsys.end(), sys) == bsys.end())
-            use = "central";
-         jw = reader_.eval_auto_bounds(use, BTagEntry::FLAV_B, j.eta(), j.pt(), j.csv());
-      } else if (std::abs(j.flavor()) == 4) {
-         std::string use = sys;
-         if (std::find(csys.begin(), csys.end(), sys) == csys.end())
-            use = "central";
-         jw = reader_.eval_auto_bounds(use, BTagEntry::FLAV_C, j.eta(), j.pt(), j.csv());
-      } else {
-         std::string use = sys;
-         if (std::find(lsys.begin(), lsys.end(), sys) == lsys.end())
-            use = "central";
-         jw = reader_.eval_auto_bounds(use, BTagEntry::FLAV_UDSG, j.eta(), j.pt(), j.csv());
-      }
-      w *= jw;
+      auto flavor = csv_flavor(j);
+      std::string use = csv_applies(flavor, sys) ? sys : "central";
+      w *= reader_.eval_auto_bounds(use, flavor, j.eta(), j.pt(), j.csv());
    }
 
    return w;
 }
 
-void
-get_hist(TFile& f, std::auto_ptr<TH2F>& ptr, const std::string& name)
+std::vector<float>
+fastlane::CSVHelper::weights(const std::vector<superslim::Jet>& jets, const std::string& sys)
+{
+   static const std::string central = "central";
+   const auto& vars = variations();
+
+   // Which variations apply to b, c, and light jets
+   static const auto applies = []() {
+      std::vector<std::vector<bool>> res;
+      for (const auto& flavor: {BTagEntry::FLAV_B, BTagEntry::FLAV_C, BTagEntry::FLAV_UDSG}) {
+         res.push_back({});
+         for (const auto& var: variations())
+            res.back().push_back(csv_applies(flavor, var));
+      }
+      return res;
+   }();
+
+   std::vector<float> ws(vars.size() + 1, 1.);
+
+   for (const auto& j: jets) {
+      auto flavor = csv_flavor(j);
+      float nominal = reader_.eval_auto_bounds(central, flavor, j.eta(), j.pt(), j.csv());
+
+      if (sys != central and csv_applies(flavor, sys))
+         ws[0] *= reader_.eval_auto_bounds(sys, flavor, j.eta(), j.pt(), j.csv());
+      else
+         ws[0] *= nominal;
+
+      for (unsigned int i = 0; i < vars.size(); ++i) {
+         if (applies[flavor][i])
+            ws[i + 1] *= reader_.eval_auto_bounds(vars[i], flavor, j.eta(), j.pt(), j.csv());
+         else
+            ws[i + 1] *= nominal;
+      }
+   }
+
+   return ws;
+}
+
+fastlane::Table2D
+get_table(TFile& f, const std::string& name)
 {
    TH2F *h;
    f.GetObject(name.c_str(), h);
-   ptr.reset(h);
-   ptr->SetDirectory(0);
+   if (!h)
+      throw std::runtime_error("can't find " + name + " in " + f.GetName());
+   fastlane::Table2D t(*h);
+   if (fastlane::tableValidation())
+      fastlane::validate(name, fastlane::compare(t, *h));
+   return t;
+}
+
+fastlane::Graph
+get_graph(TFile& f, const std::string& name)
+{
+   TGraphAsymmErrors *ptr;
+   f.GetObject(name.c_str(), ptr);
+   if (!ptr)
+      throw std::runtime_error("can't find " + name + " in " + f.GetName());
+   std::unique_ptr<TGraphAsymmErrors> g(ptr);
+   fastlane::Graph t(*g);
+   if (fastlane::tableValidation())
+      fastlane::validate(name, fastlane::compare(t, *g));
+   return t;
+}
+
+fastlane::Function
+get_function(TFile& f, const std::string& name)
+{
+   TF1 *ptr;
+   f.GetObject(name.c_str(), ptr);
+   if (!ptr)
+      throw std::runtime_error("can't find " + name + " in " + f.GetName());
+   std::unique_ptr<TF1> fct(ptr);
+   fastlane::Function t(*fct);
+   // Interpolated between sampled points
+   if (fastlane::tableValidation())
+      fastlane::validate(name, fastlane::compare(t, *fct), 1e-6);
+   return t;
 }
 
 fastlane::FakeHelper::FakeHelper(const std::string& id)
@@ -144,33 +322,23 @@ fastlane::FakeHelper::FakeHelper(const std::string& id)
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/FR_tau_2016.root").fullPath().c_str());
       for (unsigned int i = 0; i < dets.size(); ++i) {
-         TGraphAsymmErrors *graph;
-         f.GetObject((dets[i] + fakerate).c_str(), graph);
-         tau[i].reset(graph);
-         for (const auto& corr: correction) {
-            TF1 *fct;
-            f.GetObject((dets[i] + corr.second).c_str(), fct);
-            fct->Copy(ratio[i][corr.first]);
-         }
+         tau[i] = get_graph(f, dets[i] + fakerate);
+         for (const auto& corr: correction)
+            ratio[i][corr.first] = get_function(f, dets[i] + corr.second);
       }
    }
 
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/FR_data_ttH_mva.root").fullPath().c_str());
-      TH2F *hele, *hmu;
-      f.GetObject("FR_mva075_el_data_comb", hele);
-      f.GetObject("FR_mva075_mu_data_comb", hmu);
-      ele_fake.reset(hele);
-      ele_fake->SetDirectory(0);
-      mu_fake.reset(hmu);
-      mu_fake->SetDirectory(0);
+      ele_fake = get_table(f, "FR_mva075_el_data_comb");
+      mu_fake = get_table(f, "FR_mva075_mu_data_comb");
    }
 }
 
 float
 fastlane::FakeHelper::weight(const std::vector<superslim::Tau>& taus,
                              const std::vector<superslim::Lepton>& leptons,
-                             const std::string& sys)
+                             const std::string& sys) const
 {
    static const float barrel_cut = 1.479;
 
@@ -181,7 +349,7 @@ fastlane::FakeHelper::weight(const std::vector<superslim::Tau>& taus,
       if (t.isolationMVA03() >= id_)
          continue;
       int idx = std::abs(t.eta()) > barrel_cut;
-      float f = get_factor(tau[idx], t.pt()) * ratio[idx][sys].Eval(t.pt());
+      float f = get_factor(tau[idx], t.pt()) * ratio[idx].at(sys).eval(t.pt());
       w *= f / (1. - f);
       fake_count += 1;
    }
@@ -191,9 +359,9 @@ fastlane::FakeHelper::weight(const std::vector<superslim::Tau>& taus,
          continue;
       float f = 0.;
       if (l.muon())
-         f = mu_fake->GetBinContent(mu_fake->FindBin(std::min({l.conePt(), 99.99f}), std::abs(l.eta())));
+         f = mu_fake.value(std::min({l.conePt(), 99.99f}), std::abs(l.eta()));
       else
-         f = ele_fake->GetBinContent(ele_fake->FindBin(std::min({l.conePt(), 99.99f}), std::abs(l.eta())));
+         f = ele_fake.value(std::min({l.conePt(), 99.99f}), std::abs(l.eta()));
       w *= f / (1. - f);
       fake_count += 1;
    }
@@ -208,67 +376,49 @@ fastlane::LeptonHelper::LeptonHelper()
 {
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/leptonSF/lepMVAEffSF_e_3l.root").fullPath().c_str());
-      get_hist(f, tight_el_, "sf");
+      tight_el_ = get_table(f, "sf");
    }
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/leptonSF/lepMVAEffSF_m_3l.root").fullPath().c_str());
-      get_hist(f, tight_mu_, "sf");
+      tight_mu_ = get_table(f, "sf");
    }
 
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/leptonSF/el_scaleFactors_Moriond17.root").fullPath().c_str());
-      get_hist(f, reco_el1_, "GsfElectronToMVAVLooseFOIDEmuTightIP2D");
-      get_hist(f, reco_el2_, "MVAVLooseElectronToMini4");
-      get_hist(f, reco_el3_, "MVAVLooseElectronToConvVetoIHit1");
+      reco_el1_ = get_table(f, "GsfElectronToMVAVLooseFOIDEmuTightIP2D");
+      reco_el2_ = get_table(f, "MVAVLooseElectronToMini4");
+      reco_el3_ = get_table(f, "MVAVLooseElectronToConvVetoIHit1");
    }
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/leptonSF/egammaEffi.txt_EGM2D.root").fullPath().c_str());
-      get_hist(f, reco_el4_, "EGamma_SF2D");
+      reco_el4_ = get_table(f, "EGamma_SF2D");
    }
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/leptonSF/TnP_NUM_LooseID_DENOM_generalTracks_VAR_map_pt_eta.root").fullPath().c_str());
-      get_hist(f, reco_mu1_, "SF");
+      reco_mu1_ = get_table(f, "SF");
    }
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/leptonSF/TnP_NUM_MiniIsoLoose_DENOM_LooseID_VAR_map_pt_eta.root").fullPath().c_str());
-      get_hist(f, reco_mu2_, "SF");
+      reco_mu2_ = get_table(f, "SF");
    }
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/leptonSF/TnP_NUM_TightIP2D_DENOM_MediumID_VAR_map_pt_eta.root").fullPath().c_str());
-      get_hist(f, reco_mu3_, "SF");
+      reco_mu3_ = get_table(f, "SF");
    }
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/leptonSF/ratios_HIP_trkEff.root").fullPath().c_str());
-      TGraphAsymmErrors *g;
-      f.GetObject("ratio_eta", g);
-      reco_mu4_.reset(g);
+      reco_mu4_ = get_graph(f, "ratio_eta");
    }
 }
 
-fastlane::LeptonHelper::LeptonHelper(const LeptonHelper& other)
-{
-   tight_el_.reset(dynamic_cast<TH2F*>(tight_el_->Clone()));
-   tight_mu_.reset(dynamic_cast<TH2F*>(tight_mu_->Clone()));
-
-   reco_mu1_.reset(dynamic_cast<TH2F*>(reco_mu1_->Clone()));
-   reco_mu2_.reset(dynamic_cast<TH2F*>(reco_mu2_->Clone()));
-   reco_mu3_.reset(dynamic_cast<TH2F*>(reco_mu3_->Clone()));
-   reco_mu4_.reset(dynamic_cast<TGraphAsymmErrors*>(reco_mu4_->Clone()));
-
-   reco_el1_.reset(dynamic_cast<TH2F*>(reco_el1_->Clone()));
-   reco_el2_.reset(dynamic_cast<TH2F*>(reco_el2_->Clone()));
-   reco_el3_.reset(dynamic_cast<TH2F*>(reco_el3_->Clone()));
-   reco_el4_.reset(dynamic_cast<TH2F*>(reco_el4_->Clone()));
-}
-
 float
-fastlane::LeptonHelper::weight(const superslim::Lepton& l)
+fastlane::LeptonHelper::weight(const superslim::Lepton& l) const
 {
    return recoSF(l) * tightSF(l);
 }
 
 float
-fastlane::LeptonHelper::recoSF(const superslim::Lepton& l)
+fastlane::LeptonHelper::recoSF(const superslim::Lepton& l) const
 {
    if (l.electron()) {
       return
@@ -286,9 +436,9 @@ fastlane::LeptonHelper::recoSF(const superslim::Lepton& l)
 }
 
 float
-fastlane::LeptonHelper::tightSF(const superslim::Lepton& l)
+fastlane::LeptonHelper::tightSF(const superslim::Lepton& l) const
 {
-   auto& h = l.electron() ? tight_el_ : tight_mu_;
+   const auto& h = l.electron() ? tight_el_ : tight_mu_;
    return get_factor(h, l);
 }
 
@@ -296,155 +446,71 @@ fastlane::TriggerHelper::TriggerHelper(const std::string& id)
 {
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/Electron_Ele24_eff.root").fullPath().c_str());
-      TGraphAsymmErrors *eff_lep_mc_1;
-      TGraphAsymmErrors *eff_lep_mc_2;
-      TGraphAsymmErrors *eff_lep_mc_3;
-      TGraphAsymmErrors *eff_lep_data_1;
-      TGraphAsymmErrors *eff_lep_data_2;
-      TGraphAsymmErrors *eff_lep_data_3;
-      f.GetObject("ZMassEtaLt1p48_MC", eff_lep_mc_1);
-      f.GetObject("ZMassEta1p48to2p1_MC", eff_lep_mc_2);
-      f.GetObject("ZMassEtaGt2p1_MC", eff_lep_mc_3);
-      f.GetObject("ZMassEtaLt1p48_Data", eff_lep_data_1);
-      f.GetObject("ZMassEta1p48to2p1_Data", eff_lep_data_2);
-      f.GetObject("ZMassEtaGt2p1_Data", eff_lep_data_3);
-      eff_et_lep_leg_mc_[0].reset(eff_lep_mc_1);
-      eff_et_lep_leg_mc_[1].reset(eff_lep_mc_2);
-      eff_et_lep_leg_mc_[2].reset(eff_lep_mc_3);
-      eff_et_lep_leg_data_[0].reset(eff_lep_data_1);
-      eff_et_lep_leg_data_[1].reset(eff_lep_data_2);
-      eff_et_lep_leg_data_[2].reset(eff_lep_data_3);
+      eff_et_lep_leg_mc_[0] = get_graph(f, "ZMassEtaLt1p48_MC");
+      eff_et_lep_leg_mc_[1] = get_graph(f, "ZMassEta1p48to2p1_MC");
+      eff_et_lep_leg_mc_[2] = get_graph(f, "ZMassEtaGt2p1_MC");
+      eff_et_lep_leg_data_[0] = get_graph(f, "ZMassEtaLt1p48_Data");
+      eff_et_lep_leg_data_[1] = get_graph(f, "ZMassEta1p48to2p1_Data");
+      eff_et_lep_leg_data_[2] = get_graph(f, "ZMassEtaGt2p1_Data");
    }
 
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/Electron_Ele25WPTight_eff.root").fullPath().c_str());
-      TGraphAsymmErrors *eff_lep_mc_1;
-      TGraphAsymmErrors *eff_lep_mc_2;
-      TGraphAsymmErrors *eff_lep_mc_3;
-      TGraphAsymmErrors *eff_lep_data_1;
-      TGraphAsymmErrors *eff_lep_data_2;
-      TGraphAsymmErrors *eff_lep_data_3;
-      f.GetObject("ZMassEtaLt1p48_MC", eff_lep_mc_1);
-      f.GetObject("ZMassEta1p48to2p1_MC", eff_lep_mc_2);
-      f.GetObject("ZMassEtaGt2p1_MC", eff_lep_mc_3);
-      f.GetObject("ZMassEtaLt1p48_Data", eff_lep_data_1);
-      f.GetObject("ZMassEta1p48to2p1_Data", eff_lep_data_2);
-      f.GetObject("ZMassEtaGt2p1_Data", eff_lep_data_3);
-      eff_e_mc_[0].reset(eff_lep_mc_1);
-      eff_e_mc_[1].reset(eff_lep_mc_2);
-      eff_e_mc_[2].reset(eff_lep_mc_3);
-      eff_e_data_[0].reset(eff_lep_data_1);
-      eff_e_data_[1].reset(eff_lep_data_2);
-      eff_e_data_[2].reset(eff_lep_data_3);
+      eff_e_mc_[0] = get_graph(f, "ZMassEtaLt1p48_MC");
+      eff_e_mc_[1] = get_graph(f, "ZMassEta1p48to2p1_MC");
+      eff_e_mc_[2] = get_graph(f, "ZMassEtaGt2p1_MC");
+      eff_e_data_[0] = get_graph(f, "ZMassEtaLt1p48_Data");
+      eff_e_data_[1] = get_graph(f, "ZMassEta1p48to2p1_Data");
+      eff_e_data_[2] = get_graph(f, "ZMassEtaGt2p1_Data");
    }
 
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/Muon_Mu19leg_2016BtoH_eff.root").fullPath().c_str());
-      TGraphAsymmErrors *eff_lep_mc_1;
-      TGraphAsymmErrors *eff_lep_mc_2;
-      TGraphAsymmErrors *eff_lep_mc_3;
-      TGraphAsymmErrors *eff_lep_data_1;
-      TGraphAsymmErrors *eff_lep_data_2;
-      TGraphAsymmErrors *eff_lep_data_3;
-      f.GetObject("ZMassEtaLt0p9_MC", eff_lep_mc_1);
-      f.GetObject("ZMassEta0p9to1p2_MC", eff_lep_mc_2);
-      f.GetObject("ZMassEta1p2to2p1_MC", eff_lep_mc_3);
-      f.GetObject("ZMassEtaLt0p9_Data", eff_lep_data_1);
-      f.GetObject("ZMassEta0p9to1p2_Data", eff_lep_data_2);
-      f.GetObject("ZMassEta1p2to2p1_Data", eff_lep_data_3);
-      eff_mt_lep_leg_mc_[0].reset(eff_lep_mc_1);
-      eff_mt_lep_leg_mc_[1].reset(eff_lep_mc_2);
-      eff_mt_lep_leg_mc_[2].reset(eff_lep_mc_3);
-      eff_mt_lep_leg_data_[0].reset(eff_lep_data_1);
-      eff_mt_lep_leg_data_[1].reset(eff_lep_data_2);
-      eff_mt_lep_leg_data_[2].reset(eff_lep_data_3);
+      eff_mt_lep_leg_mc_[0] = get_graph(f, "ZMassEtaLt0p9_MC");
+      eff_mt_lep_leg_mc_[1] = get_graph(f, "ZMassEta0p9to1p2_MC");
+      eff_mt_lep_leg_mc_[2] = get_graph(f, "ZMassEta1p2to2p1_MC");
+      eff_mt_lep_leg_data_[0] = get_graph(f, "ZMassEtaLt0p9_Data");
+      eff_mt_lep_leg_data_[1] = get_graph(f, "ZMassEta0p9to1p2_Data");
+      eff_mt_lep_leg_data_[2] = get_graph(f, "ZMassEta1p2to2p1_Data");
    }
 
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/Muon_Mu22OR_eta2p1_eff.root").fullPath().c_str());
-      TGraphAsymmErrors *eff_lep_mc_1;
-      TGraphAsymmErrors *eff_lep_mc_2;
-      TGraphAsymmErrors *eff_lep_mc_3;
-      TGraphAsymmErrors *eff_lep_data_1;
-      TGraphAsymmErrors *eff_lep_data_2;
-      TGraphAsymmErrors *eff_lep_data_3;
-      f.GetObject("ZMassEtaLt0p9_MC", eff_lep_mc_1);
-      f.GetObject("ZMassEta0p9to1p2_MC", eff_lep_mc_2);
-      f.GetObject("ZMassEta1p2to2p1_MC", eff_lep_mc_3);
-      f.GetObject("ZMassEtaLt0p9_Data", eff_lep_data_1);
-      f.GetObject("ZMassEta0p9to1p2_Data", eff_lep_data_2);
-      f.GetObject("ZMassEta1p2to2p1_Data", eff_lep_data_3);
-      eff_m_mc_[0].reset(eff_lep_mc_1);
-      eff_m_mc_[1].reset(eff_lep_mc_2);
-      eff_m_mc_[2].reset(eff_lep_mc_3);
-      eff_m_data_[0].reset(eff_lep_data_1);
-      eff_m_data_[1].reset(eff_lep_data_2);
-      eff_m_data_[2].reset(eff_lep_data_3);
+      eff_m_mc_[0] = get_graph(f, "ZMassEtaLt0p9_MC");
+      eff_m_mc_[1] = get_graph(f, "ZMassEta0p9to1p2_MC");
+      eff_m_mc_[2] = get_graph(f, "ZMassEta1p2to2p1_MC");
+      eff_m_data_[0] = get_graph(f, "ZMassEtaLt0p9_Data");
+      eff_m_data_[1] = get_graph(f, "ZMassEta0p9to1p2_Data");
+      eff_m_data_[2] = get_graph(f, "ZMassEta1p2to2p1_Data");
    }
 
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/trigger_sf_et.root").fullPath().c_str());
-      TGraphAsymmErrors *eff_tau_data_b0;
-      TGraphAsymmErrors *eff_tau_data_b1;
-      TGraphAsymmErrors *eff_tau_data_b10;
-      TGraphAsymmErrors *eff_tau_data_e0;
-      TGraphAsymmErrors *eff_tau_data_e1;
-      TGraphAsymmErrors *eff_tau_data_e10;
-      f.GetObject(("data_genuine_barrel_" + id + "Iso_dm0").c_str(), eff_tau_data_b0);
-      f.GetObject(("data_genuine_barrel_" + id + "Iso_dm1").c_str(), eff_tau_data_b1);
-      f.GetObject(("data_genuine_barrel_" + id + "Iso_dm10").c_str(), eff_tau_data_b10);
-      f.GetObject(("data_genuine_endcap_" + id + "Iso_dm0").c_str(), eff_tau_data_e0);
-      f.GetObject(("data_genuine_endcap_" + id + "Iso_dm1").c_str(), eff_tau_data_e1);
-      f.GetObject(("data_genuine_endcap_" + id + "Iso_dm10").c_str(), eff_tau_data_e10);
-      eff_et_tau_leg_data_[0][0].reset(eff_tau_data_b0);
-      eff_et_tau_leg_data_[1][0].reset(eff_tau_data_b1);
-      eff_et_tau_leg_data_[10][0].reset(eff_tau_data_b10);
-      eff_et_tau_leg_data_[0][1].reset(eff_tau_data_e0);
-      eff_et_tau_leg_data_[1][1].reset(eff_tau_data_e1);
-      eff_et_tau_leg_data_[10][1].reset(eff_tau_data_e10);
+      for (const int dm: {0, 1, 10}) {
+         eff_et_tau_leg_data_[dm][0] = get_graph(f, "data_genuine_barrel_" + id + "Iso_dm" + std::to_string(dm));
+         eff_et_tau_leg_data_[dm][1] = get_graph(f, "data_genuine_endcap_" + id + "Iso_dm" + std::to_string(dm));
+      }
    }
 
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/tauleg_of_lepton_plus_tau_real_taus_skim_mc_v2.root").fullPath().c_str());
-      TGraphAsymmErrors *eff_tau_mc_b0;
-      TGraphAsymmErrors *eff_tau_mc_b1;
-      TGraphAsymmErrors *eff_tau_mc_b10;
-      TGraphAsymmErrors *eff_tau_mc_e0;
-      TGraphAsymmErrors *eff_tau_mc_e1;
-      TGraphAsymmErrors *eff_tau_mc_e10;
-      f.GetObject(("barrel_lowmt_zmass_sub_" + id + "Iso_dm0_HLT_LooseIso30_L1iso26/tau_pt").c_str(), eff_tau_mc_b0);
-      f.GetObject(("barrel_lowmt_zmass_sub_" + id + "Iso_dm1_HLT_LooseIso30_L1iso26/tau_pt").c_str(), eff_tau_mc_b1);
-      f.GetObject(("barrel_lowmt_zmass_sub_" + id + "Iso_dm10_HLT_LooseIso30_L1iso26/tau_pt").c_str(), eff_tau_mc_b10);
-      f.GetObject(("endcap_lowmt_zmass_sub_" + id + "Iso_dm0_HLT_LooseIso30_L1iso26/tau_pt").c_str(), eff_tau_mc_e0);
-      f.GetObject(("endcap_lowmt_zmass_sub_" + id + "Iso_dm1_HLT_LooseIso30_L1iso26/tau_pt").c_str(), eff_tau_mc_e1);
-      f.GetObject(("endcap_lowmt_zmass_sub_" + id + "Iso_dm10_HLT_LooseIso30_L1iso26/tau_pt").c_str(), eff_tau_mc_e10);
-      eff_et_tau_leg_mc_[0][0].reset(eff_tau_mc_b0);
-      eff_et_tau_leg_mc_[1][0].reset(eff_tau_mc_b1);
-      eff_et_tau_leg_mc_[10][0].reset(eff_tau_mc_b10);
-      eff_et_tau_leg_mc_[0][1].reset(eff_tau_mc_e0);
-      eff_et_tau_leg_mc_[1][1].reset(eff_tau_mc_e1);
-      eff_et_tau_leg_mc_[10][1].reset(eff_tau_mc_e10);
+      for (const int dm: {0, 1, 10}) {
+         eff_et_tau_leg_mc_[dm][0] = get_graph(f, "barrel_lowmt_zmass_sub_" + id + "Iso_dm" + std::to_string(dm) + "_HLT_LooseIso30_L1iso26/tau_pt");
+         eff_et_tau_leg_mc_[dm][1] = get_graph(f, "endcap_lowmt_zmass_sub_" + id + "Iso_dm" + std::to_string(dm) + "_HLT_LooseIso30_L1iso26/tau_pt");
+      }
    }
 
    {
       TFile f(edm::FileInPath("ttH/TauRoast/data/weights/trigger_sf_mt.root").fullPath().c_str());
-      TGraphAsymmErrors *eff_tau_mc_b;
-      TGraphAsymmErrors *eff_tau_mc_e;
-      TGraphAsymmErrors *eff_tau_data_b;
-      TGraphAsymmErrors *eff_tau_data_e;
-      f.GetObject(("mc_genuine_barrel_" + id + "Iso").c_str(), eff_tau_mc_b);
-      f.GetObject(("mc_genuine_endcap_" + id + "Iso").c_str(), eff_tau_mc_e);
-      f.GetObject(("data_genuine_barrel_" + id + "Iso").c_str(), eff_tau_data_b);
-      f.GetObject(("data_genuine_endcap_" + id + "Iso").c_str(), eff_tau_data_e);
-      eff_mt_tau_leg_mc_[0].reset(eff_tau_mc_b);
-      eff_mt_tau_leg_mc_[1].reset(eff_tau_mc_e);
-      eff_mt_tau_leg_data_[0].reset(eff_tau_data_b);
-      eff_mt_tau_leg_data_[1].reset(eff_tau_data_e);
+      eff_mt_tau_leg_mc_[0] = get_graph(f, "mc_genuine_barrel_" + id + "Iso");
+      eff_mt_tau_leg_mc_[1] = get_graph(f, "mc_genuine_endcap_" + id + "Iso");
+      eff_mt_tau_leg_data_[0] = get_graph(f, "data_genuine_barrel_" + id + "Iso");
+      eff_mt_tau_leg_data_[1] = get_graph(f, "data_genuine_endcap_" + id + "Iso");
    }
 }
 
 float
-fastlane::TriggerHelper::weight(const superslim::Event& e)
+fastlane::TriggerHelper::weight(const superslim::Event& e) const
 {
    static const std::vector<std::string> e_triggers{
        "HLT_Ele25_eta2p1_WPTight_Gsf_v",
@@ -470,14 +536,14 @@ fastlane::TriggerHelper::weight(const superslim::Event& e)
    std::vector<std::string> l_cross_triggers;
    std::vector<float> l_binning;
 
-   std::array<std::auto_ptr<TGraphAsymmErrors>, 2>* eff_lt_tau1_leg_mc = 0;
-   std::array<std::auto_ptr<TGraphAsymmErrors>, 2>* eff_lt_tau2_leg_mc = 0;
-   std::array<std::auto_ptr<TGraphAsymmErrors>, 2>* eff_lt_tau1_leg_data = 0;
-   std::array<std::auto_ptr<TGraphAsymmErrors>, 2>* eff_lt_tau2_leg_data = 0;
-   std::array<std::auto_ptr<TGraphAsymmErrors>, 3>* eff_lt_lep_leg_mc = 0;
-   std::array<std::auto_ptr<TGraphAsymmErrors>, 3>* eff_lt_lep_leg_data = 0;
-   std::array<std::auto_ptr<TGraphAsymmErrors>, 3>* eff_l_mc = 0;
-   std::array<std::auto_ptr<TGraphAsymmErrors>, 3>* eff_l_data = 0;
+   const std::array<Graph, 2>* eff_lt_tau1_leg_mc = 0;
+   const std::array<Graph, 2>* eff_lt_tau2_leg_mc = 0;
+   const std::array<Graph, 2>* eff_lt_tau1_leg_data = 0;
+   const std::array<Graph, 2>* eff_lt_tau2_leg_data = 0;
+   const std::array<Graph, 3>* eff_lt_lep_leg_mc = 0;
+   const std::array<Graph, 3>* eff_lt_lep_leg_data = 0;
+   const std::array<Graph, 3>* eff_l_mc = 0;
+   const std::array<Graph, 3>* eff_l_data = 0;
 
    if (e.leptons().size() < 1 or e.taus().size() < 2)
       return 0.;
@@ -530,51 +596,51 @@ fastlane::TriggerHelper::weight(const superslim::Event& e)
    float p_data = 0;
    float p_mc = 0;
 
-   float tau_leg_data = (1 - (1 - (*eff_lt_tau1_leg_data)[t1_bin]->Eval(t1_pt)) *
-                             (1 - (*eff_lt_tau2_leg_data)[t2_bin]->Eval(t2_pt)));
-   float tau_leg_mc = (1 - (1 - (*eff_lt_tau1_leg_mc)[t1_bin]->Eval(t1_pt)) *
-                           (1 - (*eff_lt_tau2_leg_mc)[t2_bin]->Eval(t2_pt)));
+   float tau_leg_data = (1 - (1 - (*eff_lt_tau1_leg_data)[t1_bin].eval(t1_pt)) *
+                             (1 - (*eff_lt_tau2_leg_data)[t2_bin].eval(t2_pt)));
+   float tau_leg_mc = (1 - (1 - (*eff_lt_tau1_leg_mc)[t1_bin].eval(t1_pt)) *
+                           (1 - (*eff_lt_tau2_leg_mc)[t2_bin].eval(t2_pt)));
 
    if (l_accepted and not l_cross_accepted) {
-      p_data = (*eff_l_data)[l_bin]->Eval(l_pt) -
-               std::min((*eff_l_data)[l_bin]->Eval(l_pt),
-                       (*eff_lt_lep_leg_data)[l_bin]->Eval(l_pt)) *
+      p_data = (*eff_l_data)[l_bin].eval(l_pt) -
+               std::min((*eff_l_data)[l_bin].eval(l_pt),
+                       (*eff_lt_lep_leg_data)[l_bin].eval(l_pt)) *
                tau_leg_data;
-      p_mc = (*eff_l_mc)[l_bin]->Eval(l_pt) -
-             std::min((*eff_l_mc)[l_bin]->Eval(l_pt),
-                     (*eff_lt_lep_leg_mc)[l_bin]->Eval(l_pt)) *
+      p_mc = (*eff_l_mc)[l_bin].eval(l_pt) -
+             std::min((*eff_l_mc)[l_bin].eval(l_pt),
+                     (*eff_lt_lep_leg_mc)[l_bin].eval(l_pt)) *
              tau_leg_mc;
       p_data = std::max(0.01f, p_data);
       p_mc = std::max(0.01f, p_mc);
    } else if (l_cross_accepted and not l_accepted) {
-      p_data = ((*eff_lt_lep_leg_data)[l_bin]->Eval(l_pt) - (*eff_l_data)[l_bin]->Eval(l_pt)) *
+      p_data = ((*eff_lt_lep_leg_data)[l_bin].eval(l_pt) - (*eff_l_data)[l_bin].eval(l_pt)) *
                tau_leg_data;
-      p_mc = ((*eff_lt_lep_leg_mc)[l_bin]->Eval(l_pt) - (*eff_l_mc)[l_bin]->Eval(l_pt)) *
+      p_mc = ((*eff_lt_lep_leg_mc)[l_bin].eval(l_pt) - (*eff_l_mc)[l_bin].eval(l_pt)) *
              tau_leg_mc;
       p_data = std::max(0.01f, p_data);
       p_mc = std::max(0.01f, p_mc);
    } else if (l_accepted and l_cross_accepted) {
       p_data = std::min(
-                  (*eff_l_data)[l_bin]->Eval(l_pt),
-                  (*eff_lt_lep_leg_data)[l_bin]->Eval(l_pt)
+                  (*eff_l_data)[l_bin].eval(l_pt),
+                  (*eff_lt_lep_leg_data)[l_bin].eval(l_pt)
                ) * tau_leg_data;
       p_mc = std::min(
-               (*eff_l_mc)[l_bin]->Eval(l_pt),
-               (*eff_lt_lep_leg_mc)[l_bin]->Eval(l_pt)
+               (*eff_l_mc)[l_bin].eval(l_pt),
+               (*eff_lt_lep_leg_mc)[l_bin].eval(l_pt)
              ) * tau_leg_mc;
    }
 
    // std::cout << ">>> " << e.event() << " :: " << l_accepted << ", " << l_cross_accepted << std::endl;
    // std::cout << ">> " << e.taus()[0].decayMode() << " --- " << e.taus()[1].decayMode() << std::endl;
 
-   // std::cout << "t1_data " << (*eff_lt_tau1_leg_data)[t1_bin]->Eval(t1_pt) << std::endl;
-   // std::cout << "t2_data " << (*eff_lt_tau2_leg_data)[t2_bin]->Eval(t2_pt) << std::endl;
-   // std::cout << "t1_mc " << (*eff_lt_tau1_leg_mc)[t1_bin]->Eval(t1_pt) << std::endl;
-   // std::cout << "t2_mc " << (*eff_lt_tau2_leg_mc)[t2_bin]->Eval(t2_pt) << std::endl;
-   // std::cout << "L_data " << (*eff_l_data)[l_bin]->Eval(l_pt) << std::endl;
-   // std::cout << "l_data " << (*eff_lt_lep_leg_data)[l_bin]->Eval(l_pt) << std::endl;
-   // std::cout << "L_mc " << (*eff_l_mc)[l_bin]->Eval(l_pt) << std::endl;
-   // std::cout << "l_mc " << (*eff_lt_lep_leg_mc)[l_bin]->Eval(l_pt) << std::endl;
+   // std::cout << "t1_data " << (*eff_lt_tau1_leg_data)[t1_bin].eval(t1_pt) << std::endl;
+   // std::cout << "t2_data " << (*eff_lt_tau2_leg_data)[t2_bin].eval(t2_pt) << std::endl;
+   // std::cout << "t1_mc " << (*eff_lt_tau1_leg_mc)[t1_bin].eval(t1_pt) << std::endl;
+   // std::cout << "t2_mc " << (*eff_lt_tau2_leg_mc)[t2_bin].eval(t2_pt) << std::endl;
+   // std::cout << "L_data " << (*eff_l_data)[l_bin].eval(l_pt) << std::endl;
+   // std::cout << "l_data " << (*eff_lt_lep_leg_data)[l_bin].eval(l_pt) << std::endl;
+   // std::cout << "L_mc " << (*eff_l_mc)[l_bin].eval(l_pt) << std::endl;
+   // std::cout << "l_mc " << (*eff_lt_lep_leg_mc)[l_bin].eval(l_pt) << std::endl;
 
    // std::cout << "eff_data " << p_data << std::endl;
    // std::cout << "eff_mc " << p_mc << std::endl;
@@ -583,35 +649,280 @@ fastlane::TriggerHelper::weight(const superslim::Event& e)
 }
 #endif
 
-bool
-fastlane::Cut::operator()(const std::string& process, const superslim::Event& e, const std::string& sys)
-{
-   auto passed = fct_(e, e.taus(), e.allTaus(), e.tauId(), e.leptons(), e.allLeptons(), e.leptonId(), e.jets(sys), e.met(sys));
-
-   if (passed) {
-      event_t id = std::make_tuple(e.run(), e.lumi(), e.event());
-      if (std::get<0>(id) == std::get<0>(last_) and
-            std::get<1>(id) == std::get<1>(last_) and
-            std::get<2>(id) == std::get<2>(last_))
-         return passed;
-      last_ = id;
-      counts_[process]++;
-      if (callback_) {
-         auto event = superslim::Event(e);
-
-         std::unordered_map<std::string, double> ws;
-         for (const auto& w: e.weights())
-            ws[lower(w.first)] = w.second;
+namespace {
+   std::mutex weight_lock;
+   std::unordered_map<std::string, int> weight_slots;
+   std::vector<std::string> weight_names;
+   std::vector<std::pair<fastlane::Weights::provider_t, std::vector<int>>> weight_providers;
+   std::atomic<unsigned int> provider_count(0);
+
+   int
+   intern(const std::string& name)
+   {
+      auto key = lower(name);
+      auto it = weight_slots.find(key);
+      if (it != weight_slots.end())
+         return it->second;
+      weight_names.push_back(key);
+      return weight_slots[key] = weight_names.size() - 1;
+   }
+}
+
+int
+fastlane::Weights::slot(const std::string& name)
+{
+   std::lock_guard<std::mutex> guard(weight_lock);
+   return intern(name);
+}
+
+void
+fastlane::Weights::provide(const std::vector<std::string>& names, provider_t p)
+{
+   std::lock_guard<std::mutex> guard(weight_lock);
+   std::vector<int> slots;
+   for (const auto& name: names)
+      slots.push_back(intern(name));
+   weight_providers.push_back(std::make_pair(p, slots));
+   ++provider_count;
+}
+
+void
+fastlane::Weights::grow(int slot)
+{
+   values_.resize(slot + 1, 0.);
+   sync();
+}
+
+void
+fastlane::Weights::sync()
+{
+   // Keep a copy of the providers to avoid locking when evaluating.
+   // Providers are only added, and their slots already interned, so that
+   // they never have to grow the values.
+   std::lock_guard<std::mutex> guard(weight_lock);
+   if (providers_.size() != weight_providers.size())
+      providers_ = weight_providers;
+   if (values_.size() < weight_names.size())
+      values_.resize(weight_names.size(), 0.);
+   provider_.assign(values_.size(), -1);
+   for (unsigned int p = 0; p < providers_.size(); ++p)
+      for (const auto& slot: providers_[p].second)
+         if (slot < static_cast<int>(provider_.size()))
+            provider_[slot] = p;
+   done_.resize(providers_.size(), false);
+}
+
+void
+fastlane::Weights::evaluate(int provider)
+{
+   done_[provider] = true;
+   if (not profile_enabled) {
+      providers_[provider].first(*this, providers_[provider].second);
+      return;
+   }
+
+   auto start = profile_clock::now();
+   providers_[provider].first(*this, providers_[provider].second);
+   // Named after the first weight calculated
+   auto& t = profile_local[reinterpret_cast<const void*>(providers_[provider].first)];
+   if (t.kind.empty()) {
+      std::lock_guard<std::mutex> guard(weight_lock);
+      t.kind = "weight";
+      t.name = weight_names[providers_[provider].second.front()];
+   }
+   record(t, start);
+}
+
+void
+fastlane::Weights::fill(const superslim::Event& e)
+{
+   // Events store their weights in the same order: remember the slots
+   // and only look up names that differ from the previous event.
+   static thread_local std::vector<std::pair<std::string, int>> known;
+
+   event_ = 0;
+   std::fill(values_.begin(), values_.end(), 0.);
+   unsigned int i = 0;
+   for (const auto& w: e.weights()) {
+      if (i >= known.size())
+         known.push_back(std::make_pair(w.first, slot(w.first)));
+      else if (known[i].first != w.first)
+         known[i] = std::make_pair(w.first, slot(w.first));
+      (*this)[known[i].second] = w.second;
+      ++i;
+   }
+}
+
+void
+fastlane::Weights::calculate(const superslim::Event& e, const std::string& process, const std::string& sys, const std::string& id)
+{
+   if (providers_.size() != provider_count)
+      sync();
+   std::fill(done_.begin(), done_.end(), false);
+   event_ = &e;
+   process_ = &process;
+   sys_ = &sys;
+   id_ = &id;
+}
+
+std::unordered_map<std::string, double>
+fastlane::Weights::map()
+{
+   if (event_)
+      for (unsigned int p = 0; p < providers_.size(); ++p)
+         if (not done_[p])
+            evaluate(p);
+
+   std::lock_guard<std::mutex> guard(weight_lock);
+   std::unordered_map<std::string, double> res;
+   for (unsigned int i = 0; i < weight_names.size(); ++i)
+      res[weight_names[i]] = i < values_.size() ? values_[i] : 0.;
+   return res;
+}
+
+namespace {
+   // Weights of the current event for debugging output, calculated once
+   // and shared by all cuts the event passes.
+   fastlane::Weights&
+   debug_weights(const std::string& process, const superslim::Event& e, const std::string& sys)
+   {
+      static const std::string tau_id = "Tight";
+      static thread_local fastlane::Weights weights;
+      static thread_local unsigned long generation = 0;
+      static thread_local std::string last_process;
+      static thread_local std::string last_sys;
+
+      if (generation != fastlane::event_generation() or process != last_process or sys != last_sys) {
+         generation = fastlane::event_generation();
+         last_process = process;
+         last_sys = sys;
+         weights.fill(e);
          if (process.compare(0, 10, "collisions"))
-            fastlane::update_weights(process, ws, e, sys, "Tight");
+            fastlane::update_weights(process, weights, e, sys, tau_id);
+      }
+      return weights;
+   }
+}
+
+bool
+fastlane::Cut::test(const superslim::Event& e, const std::string& sys) const
+{
+   return fct_(e, e.taus(), e.allTaus(), e.tauId(), e.leptons(), e.allLeptons(), e.leptonId(), e.jets(sys), e.met(sys));
+}
+
+void
+fastlane::Cut::count(const std::string& process, const superslim::Event& e, const std::string& sys)
+{
+   event_t id = std::make_tuple(e.run(), e.lumi(), e.event());
+   auto last = last_.find(process);
+   if (last != last_.end() and last->second == id)
+      return;
+   last_[process] = id;
+   counts_[process]++;
+   auto dump = dumps_.find(process);
+   if (dump != dumps_.end())
+      dump->second->write(e, debug_weights(process, e, sys));
+   auto callback = callbacks_.find(process);
+   if (callback != callbacks_.end()) {
+      auto event = superslim::Event(e);
+      auto ws = debug_weights(process, e, sys).map();
+
+      auto py_e = TPython::ObjectProxy_FromVoidPtr(dynamic_cast<void*>(&event), "superslim::Event");
+      auto py_w = TPython::ObjectProxy_FromVoidPtr(static_cast<void*>(&ws), "std::unordered_map<std::string,double>");
+      std::vector<TPyArg> args = {py_e, py_w};
+      TPyArg::CallMethod(callback->second, args);
+   }
+}
+
+void
+fastlane::Cut::setDump(const std::string& process, Dump* dump)
+{
+   if (dump)
+      dumps_[process] = dump;
+   else
+      dumps_.erase(process);
+}
+
+fastlane::Dump::Dump(const std::string& filename, int leptons, const std::string& sys) :
+   file_(std::fopen(filename.c_str(), "w")),
+   leptons_(leptons),
+   sys_(sys)
+{
+   if (not file_)
+      throw std::runtime_error("can't open " + filename + " for writing");
+   if (leptons_ < 1 or leptons_ > 2)
+      throw std::invalid_argument("invalid configuration with lepton count " + std::to_string(leptons_));
+   if (leptons_ == 1)
+      buffer_ = "run,lumi,event,"
+         "is_SL,is_DL,"
+         "lep1_pt,lep1_eta,lep1_phi,lep1_iso,lep1_pdgId,"
+         "lep2_pt,lep2_eta,lep2_phi,lep2_iso,lep2_pdgId,"
+         "mll,mll_passed,"
+         "jet1_pt,jet2_pt,jet3_pt,jet4_pt,"
+         "jet1_CSVv2,jet2_CSVv2,jet3_CSVv2,jet4_CSVv2,"
+         "MET_pt,MET_phi,met_passed,"
+         "n_jets,n_btags,bWeight,ttHFCategory\n";
+}
 
-         auto py_e = TPython::ObjectProxy_FromVoidPtr(dynamic_cast<void*>(&event), "superslim::Event");
-         auto py_w = TPython::ObjectProxy_FromVoidPtr(static_cast<void*>(&ws), "std::unordered_map<std::string,double>");
-         std::vector<TPyArg> args = {py_e, py_w};
-         TPyArg::CallMethod(callback_, args);
+fastlane::Dump::~Dump()
+{
+   flush();
+   std::fclose(file_);
+}
+
+void
+fastlane::Dump::flush()
+{
+   std::fwrite(buffer_.data(), 1, buffer_.size(), file_);
+   std::fflush(file_);
+   buffer_.clear();
+}
+
+void
+fastlane::Dump::write(const superslim::Event& e, fastlane::Weights& ws)
+{
+   char line[512];
+   const auto& leptons = e.leptons();
+   const auto& jets = e.jets(sys_);
+
+   if (leptons_ == 1) {
+      // Four decimals, with zero written as such
+      auto dtos = [](double d) {
+         char res[32];
+         std::snprintf(res, sizeof(res), "%.4f", d);
+         return std::string(res) == "0.0000" ? std::string("0") : std::string(res);
+      };
+      const auto& first = leptons.at(0);
+      const auto& met = e.met(sys_);
+
+      std::string jpts, jcsvs;
+      int btags = 0;
+      for (unsigned int i = 0; i < 4; ++i) {
+         jpts += (i < jets.size() ? dtos(jets[i].p4().pt()) : "0") + ",";
+         jcsvs += (i < jets.size() ? dtos(jets[i].csv()) : "0") + ",";
       }
+      for (const auto& j: jets)
+         btags += j.csv() > 0.8484;
+
+      std::snprintf(line, sizeof(line), "%ld,%ld,%ld,1,0,%s,%s,%s,%s,%d,0,0,0,0,0,0,0,%s%s%s,%s,0,%zu,%d,%s,%d\n",
+            e.run(), e.lumi(), e.event(),
+            dtos(first.p4().pt()).c_str(), dtos(first.p4().eta()).c_str(), dtos(first.p4().phi()).c_str(),
+            dtos(first.relativeIsolation()).c_str(), first.pdgId(),
+            jpts.c_str(), jcsvs.c_str(), dtos(met.pt()).c_str(), dtos(met.phi()).c_str(),
+            jets.size(), btags, dtos(ws["csvweight"]).c_str(), e.hfCategory());
+   } else {
+      const auto& first = leptons.at(0);
+      const auto& second = leptons.at(1);
+      std::snprintf(line, sizeof(line), "%6ld %6ld %10ld  %+2d  %6.2f %+4.2f %+4.2f   %+2d  %6.2f %+4.2f %+4.2f    %6.1f  %+4.2f    %zu \n",
+            e.run(), e.lumi(), e.event(),
+            first.pdgId(), first.p4().pt(), first.p4().eta(), first.p4().phi(),
+            second.pdgId(), second.p4().pt(), second.p4().eta(), second.p4().phi(),
+            e.met().pt(), e.met().phi(), e.jets().size());
    }
-   return passed;
+
+   buffer_ += line;
+   if (buffer_.size() > 1 << 20)
+      flush();
 }
 
 std::vector<std::string>
@@ -623,6 +934,20 @@ fastlane::Cut::processes() const
    return res;
 }
 
+void
+fastlane::Cut::merge(const Cut& other)
+{
+   for (const auto& p: other.counts_)
+      counts_[p.first] += p.second;
+}
+
+void
+fastlane::StaticCut::merge(const StaticCut& other)
+{
+   for (const auto& p: other.counts_)
+      counts_[p.first] += p.second;
+}
+
 std::vector<std::string>
 fastlane::StaticCut::processes() const
 {
@@ -633,15 +958,43 @@ fastlane::StaticCut::processes() const
 }
 
 std::vector<fastlane::BasicLeaf*> fastlane::BasicLeaf::leaves_;
-std::vector<superslim::Lepton> fastlane::BasicLeaf::cached_electrons_;
-std::vector<superslim::Lepton> fastlane::BasicLeaf::cached_muons_;
+
+std::vector<superslim::Lepton>&
+fastlane::BasicLeaf::cached_electrons()
+{
+   static thread_local std::vector<superslim::Lepton> cache;
+   return cache;
+}
+
+std::vector<superslim::Lepton>&
+fastlane::BasicLeaf::cached_muons()
+{
+   static thread_local std::vector<superslim::Lepton> cache;
+   return cache;
+}
+
+namespace {
+   thread_local unsigned long generation = 1;
+}
+
+unsigned long
+fastlane::event_generation()
+{
+   return generation;
+}
+
+void
+fastlane::next_event()
+{
+   ++generation;
+}
 
 void
 fastlane::BasicLeaf::update_cache(const superslim::Event& e)
 {
-   static int run = -1;
-   static int lumi = -1;
-   static int event = -1;
+   static thread_local int run = -1;
+   static thread_local int lumi = -1;
+   static thread_local int event = -1;
 
    if (e.run() == run and e.lumi() == lumi and e.event() == event)
       return;
@@ -650,89 +1003,114 @@ fastlane::BasicLeaf::update_cache(const superslim::Event& e)
    lumi = e.lumi();
    event = e.event();
 
-   cached_electrons_.clear();
-   cached_muons_.clear();
+   cached_electrons().clear();
+   cached_muons().clear();
 
-   std::copy_if(e.leptons().begin(), e.leptons().end(), std::back_inserter(cached_electrons_),
+   std::copy_if(e.leptons().begin(), e.leptons().end(), std::back_inserter(cached_electrons()),
          [](const superslim::Lepton& l) -> bool { return l.electron(); });
-   std::copy_if(e.leptons().begin(), e.leptons().end(), std::back_inserter(cached_muons_),
+   std::copy_if(e.leptons().begin(), e.leptons().end(), std::back_inserter(cached_muons()),
          [](const superslim::Lepton& l) -> bool { return l.muon(); });
 }
 
-template<> void fastlane::Leaf<std::vector<float>>::pick(const superslim::Event& e, std::unordered_map<std::string, double>& w, const std::string& sys)
+template<> void fastlane::Leaf<std::vector<float>>::pick(const superslim::Event& e, fastlane::Weights& w, const std::string& sys)
 {
    val_.clear();
-   fct_(e, e.taus(), e.allTaus(), e.leptons(), cached_electrons_, cached_muons_, e.allLeptons(), e.jets(sys), e.met(sys), w, val_);
+   fct_(e, e.taus(), e.allTaus(), e.leptons(), cached_electrons(), cached_muons(), e.allLeptons(), e.jets(sys), e.met(sys), w, val_);
 }
 
-template<> void fastlane::Leaf<std::vector<int>>::pick(const superslim::Event& e, std::unordered_map<std::string, double>& w, const std::string& sys)
+template<> void fastlane::Leaf<std::vector<int>>::pick(const superslim::Event& e, fastlane::Weights& w, const std::string& sys)
 {
    val_.clear();
-   fct_(e, e.taus(), e.allTaus(), e.leptons(), cached_electrons_, cached_muons_, e.allLeptons(), e.jets(sys), e.met(sys), w, val_);
+   fct_(e, e.taus(), e.allTaus(), e.leptons(), cached_electrons(), cached_muons(), e.allLeptons(), e.jets(sys), e.met(sys), w, val_);
 }
 
-void
-fastlane::update_weights(const std::string& process, std::unordered_map<std::string, double>& ws, const superslim::Event& e, const std::string& sys, const std::string& id)
-{
 #ifndef OLDCRAP
-   // =====================
-   // Constants for weights
-   // =====================
+// Providers of the calculated weights, setting them in the order they are
+// registered with in `update_weights`.
+
+// =====================
+// Constants for weights
+// =====================
 
-   static const float tau_efficiency_scale = 0.95;
-   static const float tau_efficiency = 0.05;
+static const float tau_efficiency_scale = 0.95;
+static const float tau_efficiency = 0.05;
 
-   // =====================
-   // Lepton and Trigger SF
-   // =====================
+// =====================
+// Lepton and Trigger SF
+// =====================
 
-   static TriggerHelper triggerhelper(id);
-   static LeptonHelper leptonhelper;
+// Scale factors are read-only tables, and shared between threads.
 
-   ws[lower("LeptonSF")] = leptonhelper.weight(e.leptons()[0]);
-   ws[lower("TriggerSF")] = triggerhelper.weight(e);
+void
+lepton_weights(fastlane::Weights& ws, const std::vector<int>& slots)
+{
+   static const fastlane::LeptonHelper leptonhelper;
+   ws[slots[0]] = leptonhelper.weight(ws.event().leptons()[0]);
+}
 
-   // ===========
-   // CSV weights
-   // ===========
+void
+trigger_weights(fastlane::Weights& ws, const std::vector<int>& slots)
+{
+   static const fastlane::TriggerHelper triggerhelper(ws.id());
+   ws[slots[0]] = triggerhelper.weight(ws.event());
+}
 
-   static auto csvhelper = CSVHelper();
+// ===========
+// CSV weights
+// ===========
+
+std::vector<std::string>
+csv_names()
+{
+   // Same order as CSVHelper::variations()
+   std::vector<std::string> res{"CSVWeight"};
+   for (const std::string& dir: {"up", "down"})
+      for (const std::string& name: {"HF", "HFStats1", "HFStats2", "LF", "LFStats1", "LFStats2", "cErr1", "cErr2"})
+         res.push_back("CMS_ttHl_btag_" + name + dir);
+   return res;
+}
+
+void
+csv_weights(fastlane::Weights& ws, const std::vector<int>& slots)
+{
+   static thread_local auto csvhelper = fastlane::CSVHelper();
 
    std::string csv_sys = "central";
-   if (lower(sys) == "cms_tthl_jesup") {
+   if (lower(ws.sys()) == "cms_tthl_jesup") {
       csv_sys = "up_jes";
-   } else if (lower(sys) == "cms_tthl_jesdown") {
+   } else if (lower(ws.sys()) == "cms_tthl_jesdown") {
       csv_sys = "down_jes";
    }
 
-   ws[lower("CSVWeight")] = csvhelper.weight(e.jets(), csv_sys);
-   for (const std::string& dir: {"up", "down"}) {
-      ws[lower("CMS_ttHl_btag_HF") + dir] = csvhelper.weight(e.jets(), dir + "_hf");
-      ws[lower("CMS_ttHl_btag_HFStats1") + dir] = csvhelper.weight(e.jets(), dir + "_hfstats1");
-      ws[lower("CMS_ttHl_btag_HFStats2") + dir] = csvhelper.weight(e.jets(), dir + "_hfstats2");
-      ws[lower("CMS_ttHl_btag_LF") + dir] = csvhelper.weight(e.jets(), dir + "_lf");
-      ws[lower("CMS_ttHl_btag_LFStats1") + dir] = csvhelper.weight(e.jets(), dir + "_lfstats1");
-      ws[lower("CMS_ttHl_btag_LFStats2") + dir] = csvhelper.weight(e.jets(), dir + "_lfstats2");
-      ws[lower("CMS_ttHl_btag_cErr1") + dir] = csvhelper.weight(e.jets(), dir + "_cferr1");
-      ws[lower("CMS_ttHl_btag_cErr2") + dir] = csvhelper.weight(e.jets(), dir + "_cferr2");
-   }
+   auto weights = csvhelper.weights(ws.event().jets(), csv_sys);
+   for (unsigned int i = 0; i < slots.size(); ++i)
+      ws[slots[i]] = weights[i];
+}
+
+// =========
+// PU weight
+// =========
 
-   // =========
-   // PU weight
-   // =========
-   static auto puhelper = PUWeightProducer(
+void
+pu_weights(fastlane::Weights& ws, const std::vector<int>& slots)
+{
+   static thread_local auto puhelper = PUWeightProducer(
          "MiniAOD/MiniAODHelper/data/puweights/MC/Summer16_NumTruePU.root",
          "hNumTruePUPdf",
          "MiniAOD/MiniAODHelper/data/puweights/Run2016/DataPileupHistogram_Run2016-Complete_MinBias69200.root",
          "pileup");
-   if (process.compare(0, 5, "fakes"))
-      ws[lower("PUWeight")] = puhelper(e.ntv());
+   if (ws.process().compare(0, 5, "fakes"))
+      ws[slots[0]] = puhelper(ws.event().ntv());
+}
 
-   // =================
-   // τ related weights
-   // =================
+// =================
+// τ related weights
+// =================
 
-   auto taus = e.taus();
+void
+tau_weights(fastlane::Weights& ws, const std::vector<int>& slots)
+{
+   const auto& taus = ws.event().taus();
    int real_taus = std::count_if(std::begin(taus), std::end(taus),
          [](const superslim::Tau& t) { return t.match() < 6; });
    // int real_electrons = std::count_if(std::begin(taus), std::end(taus),
@@ -740,114 +1118,753 @@ fastlane::update_weights(const std::string& process, std::unordered_map<std::str
    // int real_jets = std::count_if(std::begin(taus), std::end(taus),
    //       [](const superslim::Tau& t) { return t.match() == 6; });
 
-   ws[lower("tauIdEff")] = std::pow(tau_efficiency_scale, real_taus);
-   ws[lower("tauIdEffUp")] = std::pow(tau_efficiency_scale * (1 + tau_efficiency), real_taus);
-   ws[lower("tauIdEffDown")] = std::pow(tau_efficiency_scale * (1 - tau_efficiency), real_taus);
-   ws[lower("jetTauFakeUp")] = 1;
-   ws[lower("jetTauFakeDown")] = 1;
-   ws[lower("eTauFakeUp")] = 1;
-   ws[lower("eTauFakeDown")] = 1;
+   ws[slots[0]] = std::pow(tau_efficiency_scale, real_taus);
+   ws[slots[1]] = std::pow(tau_efficiency_scale * (1 + tau_efficiency), real_taus);
+   ws[slots[2]] = std::pow(tau_efficiency_scale * (1 - tau_efficiency), real_taus);
+   for (unsigned int i = 3; i < slots.size(); ++i)
+      ws[slots[i]] = 1;
+}
 
-   static FakeHelper fakerate(id);
+void
+fake_weights(fastlane::Weights& ws, const std::vector<int>& slots)
+{
+   static const fastlane::FakeHelper fakerate(ws.id());
+   static const std::vector<std::string> variations = {"central", "normUp", "normDown", "shapeUp", "shapeDown"};
 
-   auto wtaus = e.allTaus();
+   auto wtaus = ws.event().allTaus();
    wtaus.resize(std::min({wtaus.size(), 2ul}));
-   auto wleptons = e.leptons();
+   auto wleptons = ws.event().leptons();
    wleptons.resize(std::min({wleptons.size(), 1ul}));
 
-   ws[lower("fake")] = fakerate.weight(wtaus, wleptons);
-   ws[lower("CMS_ttHl_FRjt_normUp")] = fakerate.weight(wtaus, wleptons, "normUp");
-   ws[lower("CMS_ttHl_FRjt_normDown")] = fakerate.weight(wtaus, wleptons, "normDown");
-   ws[lower("CMS_ttHl_FRjt_shapeUp")] = fakerate.weight(wtaus, wleptons, "shapeUp");
-   ws[lower("CMS_ttHl_FRjt_shapeDown")] = fakerate.weight(wtaus, wleptons, "shapeDown");
+   for (unsigned int i = 0; i < slots.size(); ++i)
+      ws[slots[i]] = fakerate.weight(wtaus, wleptons, variations[i]);
+}
+
+void
+register_weights()
+{
+   using fastlane::Weights;
+   Weights::provide({"LeptonSF"}, &lepton_weights);
+   Weights::provide({"TriggerSF"}, &trigger_weights);
+   Weights::provide(csv_names(), &csv_weights);
+   Weights::provide({"PUWeight"}, &pu_weights);
+   Weights::provide({"tauIdEff", "tauIdEffUp", "tauIdEffDown",
+                     "jetTauFakeUp", "jetTauFakeDown", "eTauFakeUp", "eTauFakeDown"}, &tau_weights);
+   Weights::provide({"fake",
+                     "CMS_ttHl_FRjt_normUp", "CMS_ttHl_FRjt_normDown",
+                     "CMS_ttHl_FRjt_shapeUp", "CMS_ttHl_FRjt_shapeDown"}, &fake_weights);
+}
+#endif
+
+void
+fastlane::update_weights(const std::string& process, fastlane::Weights& ws, const superslim::Event& e, const std::string& sys, const std::string& id)
+{
+#ifndef OLDCRAP
+   static std::once_flag registered;
+   std::call_once(registered, register_weights);
+   ws.calculate(e, process, sys, id);
 #endif
 }
 
+int cut_reordering = 0;
+
+void
+fastlane::setCutReordering(int sample)
+{
+   cut_reordering = sample;
+}
+
+int
+fastlane::cutReordering()
+{
+   return cut_reordering;
+}
+
+// Cuts of a selection, evaluated in the declared order, except for groups
+// of commuting cuts.  These are measured on the first `sample` events
+// reaching them, and then evaluated by increasing cost per rejected event.
+// Counts are those of the declared order: when a reordered group fails,
+// the cuts declared before the failing one are evaluated as far as needed
+// to count them.
+class CutOrder {
+   public:
+      CutOrder(std::vector<fastlane::Cut*>& cuts, int sample, bool profile);
+
+      bool operator()(const std::string& process, const superslim::Event& e, const std::string& sys);
+      // First cut found to fail the last event
+      const fastlane::Cut* failed() const { return failed_; };
+   private:
+      struct Group {
+         unsigned int begin;
+         unsigned int end;
+         long seen;
+         std::vector<unsigned int> order;
+         std::vector<long> passed;
+         std::vector<double> seconds;
+      };
+
+      bool test(unsigned int i, const superslim::Event& e, const std::string& sys);
+      bool evaluate(Group& g, const std::string& process, const superslim::Event& e, const std::string& sys);
+
+      std::vector<fastlane::Cut*>& cuts_;
+      std::vector<Group> groups_;
+      int sample_;
+      bool profile_;
+
+      const fastlane::Cut* failed_;
+      // Results of the cuts of a group: 1 passed, -1 failed, 0 unknown
+      std::vector<int> known_;
+};
+
+CutOrder::CutOrder(std::vector<fastlane::Cut*>& cuts, int sample, bool profile) :
+   cuts_(cuts), sample_(sample), profile_(profile), failed_(0)
+{
+   if (sample_ <= 0)
+      return;
+
+   for (unsigned int i = 0; i < cuts_.size(); ++i) {
+      int group = cuts_[i]->group();
+      if (group == 0 or (i > 0 and cuts_[i - 1]->group() == group))
+         continue;
+
+      Group g;
+      g.begin = i;
+      g.end = i + 1;
+      while (g.end < cuts_.size() and cuts_[g.end]->group() == group)
+         ++g.end;
+      if (g.end - g.begin < 2)
+         continue;
+      g.seen = 0;
+      for (unsigned int j = 0; j < g.end - g.begin; ++j)
+         g.order.push_back(j);
+      g.passed.resize(g.end - g.begin, 0);
+      g.seconds.resize(g.end - g.begin, 0.);
+      groups_.push_back(g);
+   }
+}
+
+bool
+CutOrder::operator()(const std::string& process, const superslim::Event& e, const std::string& sys)
+{
+   failed_ = 0;
+
+   auto g = groups_.begin();
+   unsigned int i = 0;
+   while (i < cuts_.size()) {
+      if (g != groups_.end() and g->begin == i) {
+         if (not evaluate(*g, process, e, sys))
+            return false;
+         i = g->end;
+         ++g;
+      } else {
+         if (not test(i, e, sys)) {
+            failed_ = cuts_[i];
+            return false;
+         }
+         cuts_[i]->count(process, e, sys);
+         ++i;
+      }
+   }
+   return true;
+}
+
+bool
+CutOrder::test(unsigned int i, const superslim::Event& e, const std::string& sys)
+{
+   if (not profile_)
+      return cuts_[i]->test(e, sys);
+
+   auto start = profile_clock::now();
+   bool passed = cuts_[i]->test(e, sys);
+   record(timing(cuts_[i], "cut", cuts_[i]->name()), start, passed);
+   return passed;
+}
+
+bool
+CutOrder::evaluate(Group& g, const std::string& process, const superslim::Event& e, const std::string& sys)
+{
+   unsigned int size = g.end - g.begin;
+
+   if (g.seen < sample_) {
+      // Measure every cut of the group, counting in the declared order
+      bool passed = true;
+      for (unsigned int j = 0; j < size; ++j) {
+         auto start = profile_clock::now();
+         bool p = test(g.begin + j, e, sys);
+         g.seconds[j] += std::chrono::duration<double>(profile_clock::now() - start).count();
+         g.passed[j] += p;
+
+         if (passed and p) {
+            cuts_[g.begin + j]->count(process, e, sys);
+         } else if (passed) {
+            passed = false;
+            failed_ = cuts_[g.begin + j];
+         }
+      }
+
+      if (++g.seen == sample_) {
+         // Time spent per rejected event, assuming independent cuts
+         std::vector<double> cost;
+         for (unsigned int j = 0; j < size; ++j)
+            cost.push_back(g.seconds[j] / std::max(1l, g.seen - g.passed[j]));
+         std::stable_sort(g.order.begin(), g.order.end(),
+               [&](unsigned int a, unsigned int b) { return cost[a] < cost[b]; });
+      }
+      return passed;
+   }
+
+   known_.assign(size, 0);
+   for (const auto& j: g.order) {
+      known_[j] = test(g.begin + j, e, sys) ? 1 : -1;
+      if (known_[j] > 0)
+         continue;
+
+      failed_ = cuts_[g.begin + j];
+
+      // Only the counts of cuts declared before the failing one can
+      // change.
+      for (unsigned int k = 0; k < j; ++k) {
+         if (known_[k] == 0)
+            known_[k] = test(g.begin + k, e, sys) ? 1 : -1;
+         if (known_[k] < 0) {
+            failed_ = cuts_[g.begin + k];
+            break;
+         }
+         cuts_[g.begin + k]->count(process, e, sys);
+      }
+      return false;
+   }
+
+   for (unsigned int j = 0; j < size; ++j)
+      cuts_[g.begin + j]->count(process, e, sys);
+   return true;
+}
+
+bool
+passes(const std::string& process, CutOrder& cuts, const superslim::Event& e, const std::string& sys)
+{
+   // Event numbers in this vector will trigger debug output, printing
+   // when they fail a cut.
+   static const std::vector<long> debug{};
+
+   if (not cuts(process, e, sys)) {
+      auto cut = cuts.failed();
+      auto it = std::find(debug.begin(), debug.end(), e.event());
+      if (it != debug.end()) {
+         std::cout << "FAILED: " << *it << " MISSED " << cut->name() << std::endl;
+         const std::string labels("₁₂₃₄₅₆");
+         int i = 0;
+         for (const auto& l: e.allLeptons()) {
+            std::cout << "\tl" << labels.substr(i * 3, 3) << " pt " << l.pt()
+               << " :: l" << labels.substr(i * 3, 3) << " mva " << l.mvaRaw()
+               << " :: l" << labels.substr(i * 3, 3) << " id " << l.mva()
+               << " :: l" << labels.substr(i * 3, 3) << " csv " << l.nearestJetCSV()
+               << " :: l" << labels.substr(i * 3, 3) << " pdg " << l.pdgId()
+               << " :: l" << labels.substr(i * 3, 3) << " match " << l.match()
+               << std::endl;
+            i += 1;
+         }
+         i = 0;
+         for (const auto& t: e.allTaus()) {
+            std::cout << "\tτ" << labels.substr(i * 3, 3) << " pt " << t.pt()
+               << " :: τ" << labels.substr(i * 3, 3) << " mva " << t.isolationMVA03()
+               << " :: τ" << labels.substr(i * 3, 3) << " pdg " << t.pdgId()
+               << " :: τ" << labels.substr(i * 3, 3) << " match " << t.match()
+               << std::endl;
+            i += 1;
+         }
+         // std::cout << "\tTriggers:" << std::endl;
+         // for (const auto& t: e.trigger().triggers())
+         //    std::cout << "\t\t" << t << std::endl;
+      }
+      return false;
+   }
+   return true;
+}
+
 void
 fastlane::process(const std::string& process, const std::string& channel, const std::vector<std::string>& files, TTree& t, std::vector<fastlane::Cut*>& cuts, std::vector<fastlane::StaticCut*>& weights, const std::string& sys, const std::string& id, PyObject* log, int max, bool calculate_weights)
 {
-   fwlite::Handle<superslim::Event> handle;
-   fwlite::ChainEvent events(files);
+   std::vector<TTree*> all_trees{&t};
+   std::vector<std::vector<fastlane::Cut*>> all_cuts{cuts};
+   std::vector<std::vector<fastlane::StaticCut*>> all_weights{weights};
+   std::vector<std::string> all_sys{sys};
 
-   auto label = channel + "Taus";
+   fastlane::process(process, channel, files, all_trees, all_cuts, all_weights, all_sys, id, log, max, calculate_weights);
+}
 
-   int i = 0;
-   for (events.toBegin(); !events.atEnd() and (max < 0 or i < max); ++events, ++i) {
-      if (i % 10000 == 0) {
-         std::vector<TPyArg> args = {Int_t(i)};
-         TPyArg::CallMethod(log, args);
+void
+fastlane::process(const std::string& process, const std::string& channel, const std::vector<std::string>& files, std::vector<TTree*>& trees, std::vector<std::vector<fastlane::Cut*>>& cuts, std::vector<std::vector<fastlane::StaticCut*>>& weights, const std::vector<std::string>& sys, const std::string& id, PyObject* log, int max, bool calculate_weights)
+{
+   std::vector<std::string> processes(sys.size(), process);
+   std::vector<int> calculate(sys.size(), calculate_weights);
+
+   fastlane::process(processes, channel, files, trees, cuts, weights, sys, id, log, max, calculate, 1);
+}
+
+double sample_amount = 0.;
+unsigned int sample_seed = 0;
+long sample_block = 1000;
+long sampled_events = -1;
+std::unordered_map<std::string, long> known_entries;
+
+void
+fastlane::setSampling(double amount, unsigned int seed, long block)
+{
+   sample_amount = amount;
+   sample_seed = seed;
+   sample_block = block;
+}
+
+long
+fastlane::sampledEvents()
+{
+   return sampled_events;
+}
+
+void
+fastlane::setFileEntries(const std::vector<std::string>& files, const std::vector<long>& entries)
+{
+   if (files.size() != entries.size())
+      throw std::invalid_argument("need the number of entries of every file");
+   known_entries.clear();
+   for (unsigned int i = 0; i < files.size(); ++i)
+      known_entries[files[i]] = entries[i];
+}
+
+// Entries of a file to process, as ranges [first, last)
+struct FileSample {
+   long entries;
+   std::vector<std::pair<long, long>> ranges;
+};
+
+// Stable hash of the file name, to draw the same blocks of a file
+// independent of the order of the files.
+unsigned int
+name_hash(const std::string& fn)
+{
+   auto name = fn.substr(fn.rfind('/') + 1);
+   unsigned int res = 2166136261u;
+   for (const auto& c: name)
+      res = (res ^ static_cast<unsigned char>(c)) * 16777619u;
+   return res;
+}
+
+std::vector<FileSample>
+sample(const std::vector<std::string>& files)
+{
+   std::vector<FileSample> res;
+   long total = 0;
+   for (const auto& fn: files) {
+      res.push_back(FileSample());
+      auto known = known_entries.find(fn);
+      if (known != known_entries.end()) {
+         res.back().entries = known->second;
+      } else {
+         TFile f(fn.c_str());
+         auto t = dynamic_cast<TTree*>(f.Get("Events"));
+         if (not t)
+            throw std::runtime_error("can't read events of " + fn);
+         res.back().entries = t->GetEntries();
+         f.Close();
+      }
+      total += res.back().entries;
+   }
+
+   double fraction = sample_amount > 1. ? sample_amount / std::max(1l, total) : sample_amount;
+
+   if (sample_block <= 0) {
+      // Whole files, in a random order, until the fraction is reached
+      std::vector<unsigned int> order(files.size());
+      std::iota(order.begin(), order.end(), 0);
+      std::sort(order.begin(), order.end(),
+            [&](unsigned int a, unsigned int b) { return files[a] < files[b]; });
+      std::mt19937 rng(sample_seed);
+      std::shuffle(order.begin(), order.end(), rng);
+
+      long taken = 0;
+      for (const auto& n: order) {
+         if (taken >= fraction * total)
+            break;
+         res[n].ranges.push_back(std::make_pair(0l, res[n].entries));
+         taken += res[n].entries;
+      }
+      return res;
+   }
+
+   for (unsigned int n = 0; n < files.size(); ++n) {
+      std::seed_seq seq{sample_seed, name_hash(files[n])};
+      std::mt19937 rng(seq);
+
+      // Round the number of blocks randomly, to take the fraction on
+      // average also of small files
+      long blocks = (res[n].entries + sample_block - 1) / sample_block;
+      double wanted = std::min(1., fraction) * blocks;
+      long taken = long(wanted) + (std::uniform_real_distribution<double>()(rng) < wanted - long(wanted));
+
+      std::vector<long> chosen(blocks);
+      std::iota(chosen.begin(), chosen.end(), 0);
+      std::shuffle(chosen.begin(), chosen.end(), rng);
+      chosen.resize(taken);
+      std::sort(chosen.begin(), chosen.end());
+
+      for (const auto& b: chosen) {
+         long first = b * sample_block;
+         long last = std::min(first + sample_block, res[n].entries);
+         if (res[n].ranges.size() > 0 and res[n].ranges.back().second == first)
+            res[n].ranges.back().second = last;
+         else
+            res[n].ranges.push_back(std::make_pair(first, last));
+      }
+   }
+   return res;
+}
+
+TTree* skim_output = 0;
+std::vector<fastlane::Cut*> skim_cuts;
+superslim::Event* skim_event = 0;
+bool skim_input = false;
+
+void
+fastlane::setSkimOutput(TTree* tree, const std::vector<fastlane::Cut*>& cuts)
+{
+   skim_output = tree;
+   skim_cuts = cuts;
+   if (tree)
+      tree->Branch("event", &skim_event);
+}
+
+void
+fastlane::setSkimInput(bool skim)
+{
+   skim_input = skim;
+}
+
+// Events of ntuples, read with FWLite, or of skims
+class EventSource {
+   public:
+      EventSource(const std::vector<std::string>& files, const std::string& label, bool skim);
+
+      long size() const { return skim_ ? skim_->GetEntries() : events_->size(); };
+      const superslim::Event* get(long entry);
+   private:
+      std::string label_;
+      std::unique_ptr<fwlite::ChainEvent> events_;
+      fwlite::Handle<superslim::Event> handle_;
+      std::unique_ptr<TChain> skim_;
+      superslim::Event* event_;
+};
+
+EventSource::EventSource(const std::vector<std::string>& files, const std::string& label, bool skim) :
+   label_(label), event_(0)
+{
+   if (skim) {
+      skim_.reset(new TChain("skim"));
+      for (const auto& f: files)
+         skim_->Add(f.c_str());
+      skim_->SetBranchAddress("event", &event_);
+   } else {
+      events_.reset(new fwlite::ChainEvent(files));
+   }
+}
+
+const superslim::Event*
+EventSource::get(long entry)
+{
+   if (skim_) {
+      skim_->GetEntry(entry);
+      return event_;
+   }
+   events_->to(entry);
+   handle_.getByLabel(*events_, label_.c_str());
+   return handle_.ptr();
+}
+
+// Loop over the events in `files`, evaluating every selection.  `fill` is
+// called with the selection index whenever the leaves have been picked for
+// an event passing it, and `progress` with the event index.  Only the
+// entries in `samples` are read, if given.
+void
+scan(const std::vector<std::string>& processes, const std::string& label, const std::vector<std::string>& files, const std::vector<FileSample>& samples, const std::vector<bool>& store, std::vector<std::vector<fastlane::Cut*>>& cuts, std::vector<std::vector<fastlane::StaticCut*>>& weights, const std::vector<fastlane::BasicLeaf*>& leaves, const std::vector<std::string>& sys, const std::string& id, int max, const std::vector<int>& calculate_weights, std::function<void(unsigned int)> fill, std::function<void(int)> progress)
+{
+   EventSource events(files, label, skim_input);
+
+   // Systematics to write the skim for
+   std::vector<std::string> skim_sys;
+   if (skim_output) {
+      skim_sys = sys;
+      std::sort(skim_sys.begin(), skim_sys.end());
+      skim_sys.erase(std::unique(skim_sys.begin(), skim_sys.end()), skim_sys.end());
+   }
+
+   std::vector<std::vector<int>> slots;
+   for (const auto& sel: weights) {
+      slots.push_back(std::vector<int>());
+      for (const auto& w: sel)
+         slots.back().push_back(fastlane::Weights::slot(w->name()));
+   }
+   fastlane::Weights ws;
+
+   bool profile = fastlane::profiling();
+   std::vector<std::string> selections;
+   std::vector<CutOrder> orders;
+   for (unsigned int n = 0; n < processes.size(); ++n) {
+      selections.push_back(processes[n] + (sys[n] == "NA" ? "" : "_" + sys[n]));
+      orders.push_back(CutOrder(cuts[n], fastlane::cutReordering(), profile));
+   }
+
+   // Ranges of entries of the chain to read
+   std::vector<std::pair<long, long>> entries;
+   if (samples.empty()) {
+      entries.push_back(std::make_pair(0l, long(events.size())));
+   } else {
+      long offset = 0;
+      for (const auto& f: samples) {
+         for (const auto& r: f.ranges)
+            entries.push_back(std::make_pair(offset + r.first, offset + r.second));
+         offset += f.entries;
       }
+   }
 
-      handle.getByLabel(events, label.c_str());
-
-      // Event numbers in this vector will trigger debug output, printing
-      // when they fail a cut.
-      static const std::vector<long> debug{};
-
-      const auto e = handle.ptr();
-      bool failed = false;
-      for (auto& cut: cuts) {
-         if (not (*cut)(process, *e, sys)) {
-            auto it = std::find(debug.begin(), debug.end(), e->event());
-            if (it != debug.end()) {
-               std::cout << "FAILED: " << *it << " MISSED " << cut->name() << std::endl;
-               const std::string labels("₁₂₃₄₅₆");
-               int i = 0;
-               for (const auto& l: e->allLeptons()) {
-                  std::cout << "\tl" << labels.substr(i * 3, 3) << " pt " << l.pt()
-                     << " :: l" << labels.substr(i * 3, 3) << " mva " << l.mvaRaw()
-                     << " :: l" << labels.substr(i * 3, 3) << " id " << l.mva()
-                     << " :: l" << labels.substr(i * 3, 3) << " csv " << l.nearestJetCSV()
-                     << " :: l" << labels.substr(i * 3, 3) << " pdg " << l.pdgId()
-                     << " :: l" << labels.substr(i * 3, 3) << " match " << l.match()
-                     << std::endl;
-                  i += 1;
+   int i = 0;
+   for (const auto& range: entries) {
+      for (long entry = range.first; entry < range.second and (max < 0 or i < max); ++entry, ++i) {
+         progress(i);
+
+         const auto e = events.get(entry);
+         fastlane::next_event();
+
+         if (skim_output) {
+            bool passed = false;
+            for (const auto& s: skim_sys) {
+               passed = std::all_of(skim_cuts.begin(), skim_cuts.end(),
+                     [&](const fastlane::Cut* c) { return c->test(*e, s); });
+               if (passed)
+                  break;
+            }
+            if (passed) {
+               skim_event = const_cast<superslim::Event*>(e);
+               skim_output->Fill();
+            }
+         }
+
+         // Weights and leaves only depend on the systematic, if weights are
+         // calculated, and if the process is a fake estimate.  Selections
+         // sharing these can re-use the values of the previous one.
+         std::string last = "";
+         std::string picked = "";
+
+         for (unsigned int n = 0; n < processes.size(); ++n) {
+            const auto& process = processes[n];
+            if (not passes(process, orders[n], *e, sys[n]))
+               continue;
+
+            auto key = sys[n] + (calculate_weights[n] ? "/w" : "/-") + (process.compare(0, 5, "fakes") ? "" : "/f");
+            if (key != last) {
+               last = key;
+               ws.fill(*e);
+               if (calculate_weights[n]) {
+                  auto start = profile ? profile_clock::now() : profile_clock::time_point();
+                  fastlane::update_weights(process, ws, *e, sys[n], id);
+                  if (profile)
+                     record(timing(&ws, "weights", "update_weights"), start);
                }
-               i = 0;
-               for (const auto& t: e->allTaus()) {
-                  std::cout << "\tτ" << labels.substr(i * 3, 3) << " pt " << t.pt()
-                     << " :: τ" << labels.substr(i * 3, 3) << " mva " << t.isolationMVA03()
-                     << " :: τ" << labels.substr(i * 3, 3) << " pdg " << t.pdgId()
-                     << " :: τ" << labels.substr(i * 3, 3) << " match " << t.match()
-                     << std::endl;
-                  i += 1;
+            }
+
+            double weight = 1.;
+            for (unsigned int m = 0; m < weights[n].size(); ++m) {
+               if (calculate_weights[n])
+                  weight *= ws[slots[n][m]];
+               (*weights[n][m])[process] += weight;
+            }
+
+            if (not store[n])
+               continue;
+
+            if (key != picked) {
+               picked = key;
+               fastlane::BasicLeaf::update_cache(*e);
+               for (auto& leaf: leaves) {
+                  // std::cout << leaf->name() << std::endl;
+                  auto start = profile ? profile_clock::now() : profile_clock::time_point();
+                  try {
+                     leaf->pick(*e, ws, sys[n]);
+                  } catch (const std::out_of_range& e) {
+                  }
+                  if (profile)
+                     record(timing(leaf, "leaf", leaf->name()), start);
                }
-               // std::cout << "\tTriggers:" << std::endl;
-               // for (const auto& t: e->trigger().triggers())
-               //    std::cout << "\t\t" << t << std::endl;
             }
-            failed = true;
-            break;
+
+            if (profile) {
+               auto start = profile_clock::now();
+               fill(n);
+               record(timing(&selections[n], "fill", selections[n]), start);
+            } else {
+               fill(n);
+            }
          }
       }
+   }
 
-      if (failed)
-         continue;
+   if (profile)
+      flush_profile();
+}
+
+// Cuts, weights and leaves private to one worker thread, together with
+// the selections to fill, in order.
+struct Worker {
+   std::vector<std::vector<fastlane::Cut*>> cuts;
+   std::vector<std::vector<fastlane::StaticCut*>> weights;
+   std::vector<fastlane::BasicLeaf*> leaves;
+   std::vector<unsigned int> fills;
+
+   Worker(const std::vector<std::vector<fastlane::Cut*>>& cs, const std::vector<std::vector<fastlane::StaticCut*>>& ws)
+   {
+      for (const auto& sel: cs) {
+         cuts.push_back({});
+         for (const auto& c: sel)
+            cuts.back().push_back(c->fork());
+      }
+      for (const auto& sel: ws) {
+         weights.push_back({});
+         for (const auto& w: sel)
+            weights.back().push_back(w->fork());
+      }
+      for (const auto& leaf: fastlane::BasicLeaf::leaves())
+         leaves.push_back(leaf->clone());
+   };
+
+   ~Worker()
+   {
+      for (auto& sel: cuts)
+         for (auto& c: sel)
+            delete c;
+      for (auto& sel: weights)
+         for (auto& w: sel)
+            delete w;
+      for (auto& leaf: leaves)
+         delete leaf;
+   };
 
-      std::unordered_map<std::string, double> ws;
-      for (const auto& w: e->weights())
-         ws[lower(w.first)] = w.second;
-      if (calculate_weights)
-         fastlane::update_weights(process, ws, *e, sys, id);
-
-      double weight = 1.;
-      for (auto& w: weights) {
-         if (calculate_weights)
-            weight *= ws[lower(w->name())];
-         (*w)[process] += weight;
+   // Add counts to the original cuts and fill the trees with the stashed
+   // leaf values.
+   void merge(std::vector<std::vector<fastlane::Cut*>>& cs, std::vector<std::vector<fastlane::StaticCut*>>& ws, std::vector<TTree*>& trees)
+   {
+      for (unsigned int n = 0; n < cs.size(); ++n)
+         for (unsigned int m = 0; m < cs[n].size(); ++m)
+            cs[n][m]->merge(*cuts[n][m]);
+      for (unsigned int n = 0; n < ws.size(); ++n)
+         for (unsigned int m = 0; m < ws[n].size(); ++m)
+            ws[n][m]->merge(*weights[n][m]);
+
+      bool profile = fastlane::profiling();
+      auto& originals = fastlane::BasicLeaf::leaves();
+      for (unsigned int i = 0; i < fills.size(); ++i) {
+         for (unsigned int j = 0; j < originals.size(); ++j)
+            originals[j]->unstash(*leaves[j], i);
+         auto start = profile ? profile_clock::now() : profile_clock::time_point();
+         trees[fills[i]]->Fill();
+         if (profile)
+            record(timing(trees[fills[i]], "fill", trees[fills[i]]->GetName()), start);
       }
+      if (profile)
+         flush_profile();
+      fills.clear();
+      for (auto& leaf: leaves)
+         leaf->clear();
+   };
+};
+
+void
+fastlane::process(const std::vector<std::string>& processes, const std::string& channel, const std::vector<std::string>& files, std::vector<TTree*>& trees, std::vector<std::vector<fastlane::Cut*>>& cuts, std::vector<std::vector<fastlane::StaticCut*>>& weights, const std::vector<std::string>& sys, const std::string& id, PyObject* log, int max, const std::vector<int>& calculate_weights, int threads)
+{
+   auto size = processes.size();
+   if (trees.size() != size or cuts.size() != size or weights.size() != size or sys.size() != size or calculate_weights.size() != size)
+      throw std::invalid_argument("need one process, tree, cutflow, set of weights and systematic per selection");
+
+   auto label = channel + "Taus";
+
+   std::vector<bool> store;
+   for (const auto& t: trees)
+      store.push_back(t != 0);
+
+   // Debug callbacks call into python, dumps keep the order of events,
+   // and an event limit needs a single pass to be reproducible.  All
+   // require running serially, as does writing a skim.
+   bool serial = threads < 2 or files.size() < 2 or max >= 0 or skim_output;
+   for (const auto& sel: cuts)
+      for (const auto& c: sel)
+         serial = serial or c->hasCallback() or c->hasDump();
+
+   std::vector<FileSample> samples;
+   sampled_events = -1;
+   if (sample_amount > 0. and not skim_input) {
+      samples = sample(files);
+      sampled_events = 0;
+      for (const auto& f: samples)
+         for (const auto& r: f.ranges)
+            sampled_events += r.second - r.first;
+   }
+
+   auto report = [&](int i) {
+      std::vector<TPyArg> args = {Int_t(i)};
+      TPyArg::CallMethod(log, args);
+   };
+
+   if (serial) {
+      scan(processes, label, files, samples, store, cuts, weights, BasicLeaf::leaves(), sys, id, max, calculate_weights,
+            [&](unsigned int n) { trees[n]->Fill(); },
+            [&](int i) { if (i % 10000 == 0) report(i); });
+      return;
+   }
+
+   ROOT::EnableThreadSafety();
+
+   threads = std::min(threads, int(files.size()));
+
+   std::vector<std::unique_ptr<Worker>> workers;
+   std::vector<std::future<void>> futures;
+   std::atomic<int> processed(0);
+
+   for (int t = 0; t < threads; ++t) {
+      auto first = t * files.size() / threads;
+      auto last = (t + 1) * files.size() / threads;
+      std::vector<std::string> range(files.begin() + first, files.begin() + last);
+      std::vector<FileSample> subsample;
+      if (not samples.empty())
+         subsample.assign(samples.begin() + first, samples.begin() + last);
+      workers.emplace_back(new Worker(cuts, weights));
+      auto w = workers.back().get();
+      futures.push_back(std::async(std::launch::async, [&, w, range, subsample]() {
+         scan(processes, label, range, subsample, store, w->cuts, w->weights, w->leaves, sys, id, max, calculate_weights,
+               [w](unsigned int n) {
+                  for (auto& leaf: w->leaves)
+                     leaf->stash();
+                  w->fills.push_back(n);
+               },
+               [&](int) { ++processed; });
+      }));
+   }
 
-      BasicLeaf::update_cache(*e);
-      for (auto& leaf: BasicLeaf::leaves()) {
-         // std::cout << leaf->name() << std::endl;
-         try {
-            leaf->pick(*e, ws, sys);
-         } catch (const std::out_of_range& e) {
+   // Only the main thread may call back into python.
+   int reported = -1;
+   for (auto& f: futures) {
+      while (f.wait_for(std::chrono::seconds(1)) != std::future_status::ready) {
+         int current = processed;
+         if (reported < 0 or current / 10000 > reported / 10000) {
+            report(current);
+            reported = current;
          }
       }
-
-      t.Fill();
    }
+
+   // Merge in the order of the file ranges, so that the output does not
+   // depend on the scheduling of the threads.
+   for (auto& f: futures)
+      f.get();
+   for (auto& w: workers)
+      w->merge(cuts, weights, trees);
 }
 
 const TH1*
@@ -0,0 +1,169 @@
+#include <algorithm>
+#include <cmath>
+#include <stdexcept>
+
+#include "ttH/TauRoast/interface/FastlaneTables.h"
+
+fastlane::Axis::Axis(const TAxis& axis) : fixed_(axis.GetXbins()->GetSize() == 0)
+{
+   for (int i = 1; i <= axis.GetNbins(); ++i)
+      edges_.push_back(axis.GetBinLowEdge(i));
+   edges_.front() = axis.GetXmin();
+   edges_.push_back(axis.GetXmax());
+}
+
+int
+fastlane::Axis::find(double x) const
+{
+   // Same comparisons as TAxis::FindFixBin, to agree on edges
+   if (x < min())
+      return 0;
+   else if (not (x < max()))
+      return bins() + 1;
+   else if (fixed_)
+      return 1 + int(bins() * (x - min()) / (max() - min()));
+   return std::upper_bound(edges_.begin(), edges_.end(), x) - edges_.begin();
+}
+
+fastlane::Table2D::Table2D(const TH2& h) : x_(*h.GetXaxis()), y_(*h.GetYaxis())
+{
+   for (int y = 0; y <= y_.bins() + 1; ++y)
+      for (int x = 0; x <= x_.bins() + 1; ++x)
+         values_.push_back(h.GetBinContent(x, y));
+}
+
+double
+fastlane::Table2D::clamped(double x, double y) const
+{
+   int bx = std::max(1, std::min(x_.bins(), x_.find(x)));
+   int by = std::max(1, std::min(y_.bins(), y_.find(y)));
+   return content(bx, by);
+}
+
+fastlane::Graph::Graph(const TGraph& g) : min_(g.GetXaxis()->GetXmin()), max_(g.GetXaxis()->GetXmax())
+{
+   std::vector<std::pair<double, double>> points;
+   for (int i = 0; i < g.GetN(); ++i)
+      points.push_back(std::make_pair(g.GetX()[i], g.GetY()[i]));
+   std::stable_sort(points.begin(), points.end(),
+         [](const std::pair<double, double>& a, const std::pair<double, double>& b) { return a.first < b.first; });
+   for (const auto& p: points) {
+      x_.push_back(p.first);
+      y_.push_back(p.second);
+   }
+}
+
+double
+fastlane::Graph::eval(double x) const
+{
+   if (x_.size() == 0)
+      return 0.;
+   else if (x_.size() == 1)
+      return y_[0];
+
+   // Neighbouring points as chosen by TGraph::Eval, using the two
+   // outermost points to extrapolate
+   auto it = std::lower_bound(x_.begin(), x_.end(), x);
+   if (it != x_.end() and *it == x)
+      return y_[it - x_.begin()];
+
+   int up = std::min(std::max(int(it - x_.begin()), 1), int(x_.size()) - 1);
+   int low = up - 1;
+   if (x_[low] == x_[up])
+      return y_[low];
+   return y_[up] + (x - x_[up]) * (y_[low] - y_[up]) / (x_[low] - x_[up]);
+}
+
+fastlane::Function::Function(const TF1& f, unsigned int points)
+   : min_(f.GetXmin()), step_(0.), fct_(new TF1(f)), lock_(new std::mutex())
+{
+   if (f.GetXmax() > f.GetXmin() and points > 1) {
+      step_ = (f.GetXmax() - f.GetXmin()) / (points - 1);
+      for (unsigned int i = 0; i < points; ++i)
+         values_.push_back(f.Eval(min_ + i * step_));
+   }
+}
+
+double
+fastlane::Function::eval(double x) const
+{
+   double pos = (x - min_) / step_;
+   if (values_.size() == 0 or not (pos >= 0. and pos <= values_.size() - 1)) {
+      std::lock_guard<std::mutex> guard(*lock_);
+      return fct_->Eval(x);
+   }
+   unsigned int i = std::min(static_cast<unsigned int>(pos), static_cast<unsigned int>(values_.size() - 2));
+   return values_[i] + (pos - i) * (values_[i + 1] - values_[i]);
+}
+
+double
+fastlane::compare(const Table2D& t, const TH2& h)
+{
+   auto probes = [](const Axis& a) {
+      std::vector<double> res{a.min() - 1., a.max(), a.max() + 1.};
+      for (int i = 0; i < a.bins(); ++i) {
+         double low = a.min() + i * (a.max() - a.min()) / a.bins();
+         res.push_back(low);
+         res.push_back(low + .5 * (a.max() - a.min()) / a.bins());
+      }
+      return res;
+   };
+   // Variable bins: also probe the actual edges
+   auto add_edges = [](const TAxis& a, std::vector<double>& res) {
+      for (int i = 1; i <= a.GetNbins(); ++i) {
+         res.push_back(a.GetBinLowEdge(i));
+         res.push_back(a.GetBinCenter(i));
+      }
+   };
+
+   auto xs = probes(t.x());
+   auto ys = probes(t.y());
+   add_edges(*h.GetXaxis(), xs);
+   add_edges(*h.GetYaxis(), ys);
+
+   double res = 0.;
+   for (const auto& x: xs) {
+      for (const auto& y: ys) {
+         double ref = h.GetBinContent(h.GetXaxis()->FindFixBin(x), h.GetYaxis()->FindFixBin(y));
+         res = std::max(res, std::abs(t.value(x, y) - ref));
+      }
+   }
+   return res;
+}
+
+double
+fastlane::compare(const Graph& t, const TGraph& g)
+{
+   std::vector<double> xs{t.min(), t.max(), t.min() - 1., t.max() + 1.};
+   for (int i = 0; i < g.GetN(); ++i) {
+      xs.push_back(g.GetX()[i]);
+      if (i > 0)
+         xs.push_back(.5 * (g.GetX()[i - 1] + g.GetX()[i]));
+   }
+
+   double res = 0.;
+   for (const auto& x: xs)
+      res = std::max(res, std::abs(t.eval(x) - g.Eval(x)));
+   return res;
+}
+
+double
+fastlane::compare(const Function& t, const TF1& f)
+{
+   const int probes = 10007;
+   double width = f.GetXmax() - f.GetXmin();
+
+   double res = 0.;
+   for (int i = -10; i <= probes + 10; ++i) {
+      double x = f.GetXmin() + i * width / probes;
+      res = std::max(res, std::abs(t.eval(x) - f.Eval(x)));
+   }
+   return res;
+}
+
+void
+fastlane::validate(const std::string& name, double deviation, double tolerance)
+{
+   if (deviation > tolerance)
+      throw std::runtime_error("table " + name + " deviates by " + std::to_string(deviation) + " from ROOT");
+}
@@ -606,6 +606,7 @@ namespace superslim {
       run_(run), lumi_(lumi), event_(event),
       npv_(npv), ntv_(ntv), nmu_(nmu),
       hdecay_(-1),
+      hf_category_(0),
       pv_(pv),
       trigger_(trigger)
    {